@@ -0,0 +1,1141 @@
+# 최종결과.py의 계산기가 얼마나 빠른지 재보는 파일
+# 실행: python 벤치마크.py (최종결과.py와 같은 폴더에서)
+
+import argparse
+import asyncio
+import gc
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+import 최종결과
+from 최종결과 import *
+
+
+# 같은 수식을 repeat번 계산하는데 걸리는 시간(초)을 잼
+def measure(function, repeat):
+  return min(timeit.repeat(function, number=repeat, repeat=3))
+
+
+# 함수들을 번갈아 가며 rounds번에 나눠서 재고, 함수마다 repeat번 계산하는데 걸리는 시간(초)을 가장 빠른 것으로 어림함.
+# 몇 % 차이를 비교할 때 씀: 따로따로 재면 그 사이에 컴퓨터가 바빠지거나 한가해진 게 차이에 그대로 섞이니까
+def measureInterleaved(functions, repeat, rounds=1000):
+  number = max(1, repeat // rounds)
+  best = [float('inf')] * len(functions)
+  for _ in range(rounds):
+    for i, function in enumerate(functions):
+      best[i] = min(best[i], timeit.timeit(function, number=number))
+  return [seconds * rounds for seconds in best]
+
+
+# 글자만으로 된 이름: nameOf('v', 0) -> 'va', nameOf('v', 26) -> 'vaa'
+def nameOf(prefix: str, number: int) -> str:
+  name = ''
+  number += 1
+  while number:
+    number, rest = divmod(number - 1, 26)
+    name = chr(97 + rest) + name
+  return prefix + name
+
+
+# %%
+# interpret() vs compile(): 같은 수식을 입력만 바꿔가며 계산할 때
+def benchmarkCompile(repeat=100000):
+  code = 'Let f(t) = t * t - 1, sin(x) * f(x) + 3 * x ^ 2 - (x + 1) / 2'
+  node = parseMathToAst(code)
+  compiled = compile(node)
+  context = {'x': 0.5}
+
+  assert compiled(context) == interpret(node, context)
+
+  interpreted = measure(lambda: interpret(node, context), repeat)
+  compiledTime = measure(lambda: compiled(context), repeat)
+  print(f'[compile] {code}')
+  print(f'  interpret: {interpreted / repeat * 1e6:.2f}us/번')
+  print(f'  compile:   {compiledTime / repeat * 1e6:.2f}us/번 '
+        f'({interpreted / compiledTime:.1f}배 빠름)')
+
+
+# %%
+# 점 백만 개에서 f(x)를 계산할 때: compile()로 하나씩 vs vectorize()로 한꺼번에
+def benchmarkVectorize(points=1000000):
+  if np is None:
+    print('[vectorize] numpy가 없어서 건너뜀')
+    return
+
+  code = 'Let f(t) = sin(t) * t ^ 2 - ln(t + 2) / 3, f(x) + cos(x)'
+  node = parseMathToAst(code)
+  xs = np.linspace(0, 10, points)
+
+  # 하나씩 계산하는 건 너무 오래 걸려서 일부만 재고 곱함
+  compiled = compile(node)
+  sample = 20000
+  oneByOne = measure(lambda: [compiled({'x': x}) for x in xs[:sample]],
+                     1) * (points / sample)
+
+  vectorized = vectorize(node)
+  assert np.allclose(vectorized({'x': xs[:sample]}),
+                     [compiled({'x': x}) for x in xs[:sample]])
+  # 인수를 하나 더 받을 수 있는 ln(x, 밑)도 결과가 같은지
+  extra = parseMathToAst('ln(x + 1, 2) + ln(x + 1) + round(x)')
+  assert np.allclose(vectorize(extra)({'x': xs[:sample]}),
+                     [compile(extra)({'x': x}) for x in xs[:sample]])
+  arrays = measure(lambda: vectorized({'x': xs}), 1)
+  print(f'[vectorize] {code}, 점 {points}개')
+  print(f'  compile (하나씩): {oneByOne * 1000:.1f}ms')
+  print(f'  vectorize:       {arrays * 1000:.1f}ms '
+        f'({oneByOne / arrays:.1f}배 빠름)')
+
+
+# %%
+# 항 개수를 두 배씩 늘려가며 파싱 시간을 잼. 항 하나당 시간이 일정하면 선형으로 늘어나는 것
+def benchmarkParseScaling(sizes=(1000, 2000, 4000, 8000, 16000)):
+  print('[parse scaling] 1 * x + 2 * x - 3 / x + ...')
+  operators = ['+', '-', '*', '/']
+  for size in sizes:
+    terms = [f'{i} {operators[i % 4]} x' for i in range(size)]
+    code = ' + '.join(terms)
+
+    tokens = tokenize(code)
+    seconds = measure(lambda: parseToAst(tokens, 0, len(tokens)), 1)
+    print(f'  항 {size:6d}개: {seconds * 1000:8.2f}ms '
+          f'({seconds / size * 1e6:.2f}us/항)')
+
+
+# %%
+# Let 정의를 두 배씩 늘려가며 파싱 시간을 잼: Let va = 0, Let vb = 1, ..., 마지막 + 처음
+def benchmarkLetChain(sizes=(1000, 2000, 4000, 8000, 16000)):
+  print('[let chain] Let va = 0, Let vb = 1, ...')
+  for size in sizes:
+    names = [nameOf('v', i) for i in range(size)]
+    code = ', '.join(f'Let {name} = {i}' for i, name in enumerate(names))
+    code += f', {names[-1]} + {names[0]}'
+
+    tokens = tokenize(code)
+    seconds = measure(lambda: parseToAst(tokens, 0, len(tokens)), 1)
+    print(f'  정의 {size:6d}개: {seconds * 1000:8.2f}ms '
+          f'({seconds / size * 1e6:.2f}us/정의)')
+
+
+# %%
+# 같은 수식 몇 개를 계속 다시 파싱할 때: 매번 parseMathToAst vs ParseCache
+def benchmarkParseCache(repeat=20000):
+  codes = [f'sin(x * {i}) + {i} * x ^ 2 - ln(x + {i}) / 3' for i in range(100)]
+  cache = ParseCache(maxSize=1000)
+
+  direct = measure(lambda: [parseMathToAst(codes[i % 100]) for i in range(repeat)],
+                   1)
+  cached = measure(lambda: [cache.parse(codes[i % 100]) for i in range(repeat)],
+                   1)
+  print(f'[parse cache] 수식 100개를 {repeat}번 파싱')
+  print(f'  parseMathToAst: {direct * 1000:.1f}ms')
+  print(f'  ParseCache:     {cached * 1000:.1f}ms '
+        f'({direct / cached:.1f}배 빠름) {cache.stats()}')
+
+
+# %%
+# 긴 수식을 토큰으로 나누는 속도
+def benchmarkTokenizer(terms=50000):
+  code = ' + '.join(f'sin(x) * {i}.5 - abc / (3 != y)' for i in range(terms))
+  seconds = measure(lambda: tokenize(code), 1)
+  count = len(tokenize(code))
+  print(f'[tokenizer] {len(code)}글자, 토큰 {count}개')
+  print(f'  {seconds * 1000:.1f}ms ({len(code) / seconds / 1e6:.1f}M글자/초, '
+        f'{seconds / count * 1e9:.0f}ns/토큰)')
+
+
+# %%
+# 노드 10만 개짜리 트리가 노드 하나당 메모리를 얼마나 쓰는지 (토큰 목록은 빼고 트리만)
+def benchmarkNodeMemory(terms=20000):
+  code = ' + '.join(f'sin(x) * {i}' for i in range(terms))
+  tokens = tokenize(code)
+
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  node = parseToAst(tokens, 0, len(tokens))
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+
+  count = countNodes(node)
+  print(f'[node memory] 노드 {count}개')
+  print(f'  {(after - before) / 1024 / 1024:.1f}MB, '
+        f'{(after - before) / count:.0f}바이트/노드')
+
+
+# %%
+# 아주 긴 수식(기본 5MB)의 토큰을 Token 목록 vs TokenBuffer에 담을 때 시간/메모리
+def benchmarkTokenBuffer(megabytes=5):
+  term = 'sin(x) * 12.5 - abc / (3 + y) + '
+  code = term * (megabytes * 1024 * 1024 // len(term)) + '1'
+
+  for name, function in [('Token 목록', tokenize),
+                         ('TokenBuffer', TokenBuffer.fromCode)]:
+    seconds = measure(lambda: function(code), 1)
+    tracemalloc.start()
+    tokens = function(code)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'[token buffer] {name}: {len(code) / 1024 / 1024:.0f}MB, '
+          f'토큰 {len(tokens)}개')
+    print(f'  {seconds * 1000:.0f}ms, 최대 {peak / 1024 / 1024:.0f}MB '
+          f'({peak / len(tokens):.0f}바이트/토큰)')
+    del tokens
+
+
+# %%
+# 상수가 많은 수식을 optimize() 전/후로 계산할 때
+def benchmarkOptimize(repeat=50000):
+  code = '2 * pi / 360 * x * 1 + sin(pi / 4) * (3 + 4) ^ 1 - ln(e) * x + 0'
+  node = parseMathToAst(code)
+  stats = OptimizeStats()
+  optimized = optimize(node, stats)
+  context = {'x': 30}
+
+  before = measure(lambda: interpret(node, context), repeat)
+  after = measure(lambda: interpret(optimized, context), repeat)
+  print(f'[optimize] {code}')
+  print(f'  {stats}')
+  print(f'  interpret: {before / repeat * 1e6:.2f}us/번 -> '
+        f'{after / repeat * 1e6:.2f}us/번 ({before / after:.1f}배 빠름)')
+
+
+# %%
+# 같은 부분식이 잔뜩 반복되는 수식: interpret() vs 같은 부분식을 합친 DAG + interpretShared()
+def benchmarkSharedSubexpressions(repeat=2000):
+  inner = 'sin(x) * cos(x) + ln(x + 1)'
+  middle = f'({inner}) * ({inner}) + ({inner}) / ({inner}) - sin(x)'
+  code = f'({middle}) ^ 2 + ({middle}) * ({middle}) - cos(x) * sin(x)'
+  node = parseMathToAst(code)
+  dag = ExpressionDag()
+  shared = dag.intern(node)
+  context = {'x': 0.7}
+
+  assert interpret(node, context) == interpretShared(shared, context)
+  tree = measure(lambda: interpret(node, context), repeat)
+  graph = measure(lambda: interpretShared(shared, context), repeat)
+  print(f'[shared subexpressions] 노드 {countNodes(node)}개 -> {len(dag.table)}개')
+  print(f'  {dag.stats()}')
+  print(f'  interpret:       {tree / repeat * 1e6:.1f}us/번')
+  print(f'  interpretShared: {graph / repeat * 1e6:.1f}us/번 '
+        f'({tree / graph:.1f}배 빠름)')
+
+
+# %%
+# 무거운 사용자 함수를 몇 가지 인수로 계속 부를 때: 그냥 vs memoize()
+def benchmarkMemoize(repeat=200):
+  definition = parseMathToAst('Let h(t) = ' +
+                              ' + '.join(f'sin(t * {i}) * a' for i in range(30)))
+  calls = ' + '.join(f'h({i % 5})' for i in range(50))
+  node = parseMathToAst(calls)
+  plain = {'h': definition.target, 'a': 2}
+  memoized = {'h': memoize(definition.target), 'a': 2}
+
+  assert interpret(node, plain) == interpret(node, memoized)
+  before = measure(lambda: interpret(node, plain), repeat)
+  after = measure(lambda: interpret(node, memoized), repeat)
+  print(f'[memoize] 항 30개짜리 h(t)를 인수 5가지로 50번 호출')
+  print(f'  그냥:    {before / repeat * 1e6:.0f}us/번')
+  print(f'  memoize: {after / repeat * 1e6:.0f}us/번 '
+        f'({before / after:.1f}배 빠름) {memoized["h"].stats()}')
+
+
+# %%
+# 깊은 Let 사슬과 인수가 많은 함수: dict를 합치는 interpret()/compile() vs 자리 번호를 쓰는 resolve()
+def benchmarkResolve(repeat=2000):
+  chain = ', '.join(f'Let f{chr(97 + i)}(t) = t + {i}' for i in range(20))
+  calls = ' + '.join(f'f{chr(97 + i)}(x)' for i in range(20))
+  parameters = ', '.join(f'a{chr(97 + i)}' for i in range(12))
+  arguments = ', '.join(f'x + {i}' for i in range(12))
+  body = ' * '.join(f'a{chr(97 + i)}' for i in range(12))
+  scenarios = [
+      ('Let 20개 사슬', f'{chain}, {calls}'),
+      ('인수 12개 함수', f'Let g({parameters}) = {body}, ' +
+       ' + '.join([f'g({arguments})'] * 10)),
+  ]
+
+  for name, code in scenarios:
+    node = parseMathToAst(code)
+    compiled = compile(node)
+    resolved = resolve(node)
+    context = {'x': 0.5}
+    assert interpret(node, context) == compiled(context) == resolved(context)
+
+    interpreted = measure(lambda: interpret(node, context), repeat)
+    compiledTime = measure(lambda: compiled(context), repeat)
+    resolvedTime = measure(lambda: resolved(context), repeat)
+    print(f'[resolve] {name}')
+    print(f'  interpret: {interpreted / repeat * 1e6:.1f}us/번')
+    print(f'  compile:   {compiledTime / repeat * 1e6:.1f}us/번')
+    print(f'  resolve:   {resolvedTime / repeat * 1e6:.1f}us/번 '
+          f'(interpret보다 {interpreted / resolvedTime:.1f}배, '
+          f'compile보다 {compiledTime / resolvedTime:.1f}배 빠름)')
+
+
+# %%
+# 수식 파일 batch 계산: 프로세스 개수와 한 번에 보내는 줄 개수(chunk)에 따라
+def benchmarkBatch(lines=20000):
+  code = ''.join(f'Let f(t) = sin(t) * {i} + t ^ 2, f({i % 7}) - ln({i} + 1)\n'
+                 for i in range(lines))
+  cores = os.cpu_count()
+
+  print(f'[batch] 수식 {lines}줄, CPU 코어 {cores}개')
+  base = None
+  for jobs, chunkSize in sorted({(1, 1000), (2, 1), (2, 1000), (cores, 1000)}):
+    output = io.StringIO()
+    seconds = measure(
+        lambda: batchExpressions(io.StringIO(code), output, jobs, chunkSize), 1)
+    base = base or seconds
+    print(f'  프로세스 {jobs}개, chunk {chunkSize:4d}줄: {seconds * 1000:7.0f}ms '
+          f'({lines / seconds:.0f}줄/초, 1개일 때보다 {base / seconds:.1f}배)')
+
+
+# %%
+# 2차원 함수 값 표: 점마다 compile()로 계산 vs evaluateGrid()로 조각마다 배열째 여러 프로세스에서
+def benchmarkGrid(size=2048):
+  if np is None:
+    print('[grid] numpy가 없어서 건너뜀')
+    return
+
+  code = 'Let f(x, y) = sin(x) * cos(y) + x ^ 2 / (y + 20) - ln(x + 1)'
+  xs = np.linspace(0, 10, size)
+  ys = np.linspace(0, 10, size)
+
+  # 점마다 계산하는 건 너무 오래 걸려서 한 줄만 재고 곱함
+  body = compile(parseMathToAst(code).target.body)
+  oneByOne = measure(lambda: [body({'x': x, 'y': ys[0]}) for x in xs], 1) * size
+
+  print(f'[grid] {code}, {size}x{size}, CPU 코어 {os.cpu_count()}개')
+  print(f'  compile (점마다): {oneByOne * 1000:.0f}ms')
+  for jobs in sorted({1, os.cpu_count()}):
+    seconds = measure(lambda: evaluateGrid(code, xs, ys, jobs=jobs).close(), 1)
+    print(f'  evaluateGrid (프로세스 {jobs}개): {seconds * 1000:.0f}ms '
+          f'({oneByOne / seconds:.1f}배 빠름)')
+
+
+# %%
+# 변수 10개짜리 수식의 기울기(gradient): 중심 차분(2N + 1번 계산) vs 이중수로 한 번에
+def benchmarkGradient(repeat=2000):
+  names = [f'v{chr(97 + i)}' for i in range(10)]
+  code = 'Let f(t) = sin(t) * t ^ 2, ' + ' + '.join(
+      f'f({a}) * ln({b} + 2) / ({a} + 3)' for a, b in zip(names, names[1:] + names[:1]))
+  node = parseMathToAst(code)
+  context = {name: 0.1 * (i + 1) for i, name in enumerate(names)}
+  compiled = compile(node)
+  gradient = gradientOf(node, names)
+
+  def differences(h=1e-6):
+    result = {}
+    for name in names:
+      plus = compiled({**context, name: context[name] + h})
+      minus = compiled({**context, name: context[name] - h})
+      result[name] = (plus - minus) / (2 * h)
+    return compiled(context), result
+
+  value, exact = gradient(context)
+  estimated = differences()[1]
+  error = max(abs(exact[name] - estimated[name]) for name in names)
+
+  before = measure(differences, repeat)
+  after = measure(lambda: gradient(context), repeat)
+  print(f'[gradient] 변수 {len(names)}개, 중심 차분과의 최대 차이 {error:.1e}')
+  print(f'  중심 차분 (compile {2 * len(names) + 1}번): {before / repeat * 1e6:.0f}us/번')
+  print(f'  gradientOf (이중수 한 번):  {after / repeat * 1e6:.0f}us/번 '
+        f'({before / after:.1f}배 빠름)')
+
+
+# %%
+# 매개변수가 다른 방정식 여러 개 풀기: solve()로 하나씩 vs solveMany()로 배열째
+def benchmarkSolve(count=1000, manyCount=100000):
+  code = 'Let f(t) = t ^ 3 + a * t - cos(t), f(x) = b'
+  node = parseMathToAst(code)
+
+  # a는 0.5 ~ 5, b는 -20 ~ 20
+  def parameters(size):
+    return [(0.5 + 4.5 * i / size, -20 + 40 * i / size) for i in range(size)]
+
+  one = measure(
+      lambda: [solve(node, {'a': a, 'b': b}) for a, b in parameters(count)], 1)
+  print(f'[solve] {code}')
+  print(f'  solve (하나씩):          {count / one:8.0f}개/초')
+
+  if np is None:
+    print('  solveMany: numpy가 없어서 건너뜀')
+    return
+  a, b = np.array(parameters(manyCount)).T
+  roots = solveMany(node, {'a': a, 'b': b})
+  assert abs(roots[7] - solve(node, {'a': a[7], 'b': b[7]})) < 1e-9
+  seconds = measure(lambda: solveMany(node, {'a': a, 'b': b}), 1)
+  print(f'  solveMany ({manyCount}개): {manyCount / seconds:8.0f}개/초 '
+        f'({manyCount / seconds / (count / one):.0f}배), '
+        f'못 푼 것 {int(np.isnan(roots).sum())}개')
+
+
+def benchmarkIncremental(length=10000, edits=300):
+  random.seed(0)
+  terms = []
+  while sum(map(len, terms)) < length:
+    n = len(terms)
+    terms.append(
+        random.choice([
+            f'sin(x * {n}) * {n}.5', f'({n} + y) / (x - {n})', f'f({n}, x ^ 2)',
+            f'{n} * x'
+        ]))
+  parser = IncrementalParser(' + '.join(terms))
+  full = measure(lambda: parseMathToAst(parser.code), 5) / 5
+
+  # 숫자 안에 한 글자 넣기, 숫자 한 글자 바꾸기, ' + 1' 끼워 넣기
+  times = []
+  for _ in range(edits):
+    digits = [match.start() for match in re.finditer(r'\d', parser.code)]
+    at = random.choice(digits)
+    kind = random.random()
+    if kind < 0.5:
+      edit = (at, at, str(random.randint(0, 9)))
+    elif kind < 0.75:
+      edit = (at, at + 1, str(random.randint(1, 9)))
+    else:
+      edit = (at, at, ' + 1')
+    start = timeit.default_timer()
+    parser.edit(*edit)
+    times.append(timeit.default_timer() - start)
+  assert tokenCount(parser.node) == len(tokenize(parser.code))
+
+  times.sort()
+  median = times[len(times) // 2]
+  print(f'[고치면서 다시 파싱] 수식 길이 {len(parser.code)}글자')
+  print(f'  처음부터 다시 파싱:  {full * 1e3:8.2f}ms')
+  print(f'  한 번 고칠 때 (중간값): {median * 1e3:8.3f}ms ({full / median:.0f}배), '
+        f'95%: {times[int(len(times) * 0.95)] * 1e3:.2f}ms')
+  print(f'  {parser}')
+
+
+def benchmarkDefinitions(depth=16, uses=300):
+  # 정의마다 바로 앞의 것을 두 번 씀: 그냥 context로 계산하면 2^depth번 계산함
+  lines = ['Let x = 1.5', f'Let {nameOf("q", 0)} = x * x']
+  for i in range(1, depth):
+    lines.append(f'Let {nameOf("q", i)} = {nameOf("q", i - 1)} * 0.5 + '
+                 f'{nameOf("q", i - 1)} / 2')
+  lines.append('Let s = sin(x) * cos(x) + x ^ 2')
+  definitionNodes = [parseMathToAst(line) for line in lines]
+  last = parseMathToAst(nameOf('q', depth - 1))
+  many = parseMathToAst(' + '.join(['s'] * uses))
+
+  def plainContext():
+    context = {}
+    for node in definitionNodes:
+      context[node.name] = node.target
+    return context
+
+  definitions = Definitions()
+  for node in definitionNodes:
+    definitions.define(node.name, node.target)
+  assert interpret(last, definitions.context) == interpret(last, plainContext())
+
+  print(f'[Let 정의 기억하기] 앞의 정의를 두 번 쓰는 정의 {depth}개, 수식에 s가 {uses}번')
+  for name, context in [('그냥 context', plainContext()),
+                        ('Definitions', definitions.context)]:
+    chain = measure(lambda: interpret(last, context), 1)
+    repeated = measure(lambda: interpret(many, context), 1)
+    print(f'  {name:12}: 마지막 정의 {chain * 1e3:8.3f}ms, s {uses}번 {repeated * 1e3:8.3f}ms')
+
+  # x를 다시 정의하면 x를 쓰는 정의들만 다시 계산함
+  redefine = parseMathToAst('Let x = 2.5')
+
+  def changeAndRead():
+    definitions.define(redefine.name, redefine.target)
+    return interpret(last, definitions.context)
+
+  seconds = measure(changeAndRead, 1)
+  print(f'  x를 다시 정의하고 마지막 정의 읽기: {seconds * 1e3:.3f}ms')
+  print(f'  {definitions}')
+
+
+def benchmarkSnapshot(count=500):
+  random.seed(0)
+  names = [nameOf('q', i) for i in range(count)]
+  # 함수와 기호를 섞어서, 앞에서 정의한 기호를 하나씩 씀
+  lines = ['Let x = 1.5']
+  symbols = ['x']
+  for index, name in enumerate(names):
+    used = random.choice(symbols)
+    if index % 3 == 0:
+      lines.append(f'Let {name}(t, u) = sin(t * {index}) * {used} + '
+                   f'(u - {index}.5) ^ 2 / (1 + cos(u))')
+    else:
+      lines.append(f'Let {name} = ({used} + {index}) * {index}.25 - '
+                   f'(Let k = x * 2, k ^ 2 + tan(k)) / 3')
+      symbols.append(name)
+
+  def cold():
+    definitions = Definitions()
+    for line in lines:
+      node = optimize(parseMathToAst(line))
+      definitions.define(node.name, node.target)
+    return definitions
+
+  definitions = cold()
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'definitions.snapshot')
+    save = measure(lambda: saveSnapshot(definitions, path), 1)
+    loaded = loadSnapshot(path)
+    last = parseMathToAst(' + '.join(symbols))
+    assert interpret(last, loaded.context) == interpret(last, definitions.context)
+    assert loaded.graph() == definitions.graph()
+
+    parse = measure(cold, 1)
+    load = measure(lambda: loadSnapshot(path), 1)
+    print(f'[스냅샷] Let 정의 {len(lines)}개 ({sum(map(len, lines))}글자), '
+          f'파일 {os.path.getsize(path) / 1024:.0f}KB')
+    print(f'  파싱 + 최적화 + 정의: {parse * 1e3:8.2f}ms')
+    print(f'  스냅샷 저장:          {save * 1e3:8.2f}ms')
+    print(f'  스냅샷 불러오기:      {load * 1e3:8.2f}ms ({parse / load:.1f}배)')
+
+
+def benchmarkProfile(repeat=2000):
+  code = 'Let f(t) = t * 2 + sin(t), f(x) * cos(x) + x ^ 2 / (1 + x)'
+  node = parseMathToAst(code)
+  context = {'x': 1.5}
+  # 재는 동안 바꿔치기되는 건 모듈의 이름이라서 모듈을 통해 부름
+  evaluate = lambda: 최종결과.interpret(node, context)
+
+  off = measure(evaluate, repeat) / repeat
+  with profiling() as profile:
+    on = measure(evaluate, repeat) / repeat
+  assert 최종결과.interpret is interpret
+  print(f'[프로파일] {code}')
+  print(f'  끈 상태: {off * 1e6:7.2f}us/번 (원래 interpret 그대로)')
+  print(f'  켠 상태: {on * 1e6:7.2f}us/번 ({on / off:.1f}배)')
+  print(f'  노드 {sum(count for count, _, _ in profile.nodes.values())}개 계산, '
+        f'함수 호출 {profile.builtinCalls} {profile.userCalls}')
+
+  # 재귀 한도보다 깊은 수식은 처음부터 evaluateDeep()로 계산하고, 걸린 시간은 evaluate 단계에 들어감
+  deep = parseLargeMathToAst('(' * 5000 + 'x' + ')' * 5000)
+  with profiling() as deepProfile:
+    assert 최종결과.interpret(deep, context, Budget(maxSteps=10)) == context['x']
+  assert deepProfile.phases['evaluate'][0] == 1 and len(deepProfile.childTimes) == 1
+
+
+# 아주 깊이 중첩된 수식: 파서와 interpret()가 재귀 없이 돌아서 재귀 한도를 안 올려도 됨
+def benchmarkDeepNesting(depth=10**6):
+  context = {'x': 2.0, 'f': userFunction(['a'], parseMathToAst('a + 1'))}
+  shapes = [('괄호', '(' * depth + 'x' + ')' * depth, 2.0),
+            ('단항 연산자', '-' * depth + 'x', 2.0 if depth % 2 == 0 else -2.0),
+            ('함수 호출', 'f(' * depth + 'x' + ')' * depth, 2.0 + depth)]
+  print(f'[깊은 수식] {depth}겹 (재귀 한도 {sys.getrecursionlimit()})')
+  for name, code, expected in shapes:
+    tokens = TokenBuffer.fromCode(code)
+    start = timeit.default_timer()
+    node = parseToAst(tokens, 0, len(tokens))
+    parsed = timeit.default_timer()
+    value = interpret(node, context)
+    evaluated = timeit.default_timer()
+    assert value == expected
+    print(f'  {name:8}: 파싱 {parsed - start:6.2f}s, 계산 {evaluated - parsed:6.2f}s')
+
+
+# %%
+# 계산 한도: Budget을 줘도 보통 수식은 거의 안 느려지고, 끝나지 않을 만큼 긴 계산은 한도에서 바로 멈춤
+def benchmarkBudget(repeat=20000, levels=30):
+  code = 'Let f(t) = t * 2 + sin(t), f(x) * cos(x) + x ^ 2 / (1 + x)'
+  node = parseMathToAst(code)
+  context = {'x': 1.5}
+
+  cancel = threading.Event()
+  # 한도는 함수를 부르거나 정의를 펼칠 때 보고, 크기는 연산마다도 봄
+  counted = Budget(maxSteps=10**12, timeLimit=1e9, cancel=cancel)
+  bounded = Budget(maxSteps=10**12, timeLimit=1e9, maxMagnitude=1e100, cancel=cancel)
+  # 서버처럼 계산마다 한도를 새로 두는 것도 잼: evaluateRequests()처럼 restart()로 되돌려 쓰는 것과 매번 새로 만드는 것
+  reused = Budget(maxSteps=10**6, maxMagnitude=1e100, cancel=cancel)
+  plain, limited, checked, restarted, fresh = (seconds / repeat for seconds in measureInterleaved([
+      lambda: interpret(node, context),
+      lambda: interpret(node, context, counted),
+      lambda: interpret(node, context, bounded),
+      lambda: interpret(node, context, reused.restart(1.0)),
+      lambda: interpret(node, context,
+                        Budget(maxSteps=10**6, timeLimit=1.0, maxMagnitude=1e100,
+                               cancel=cancel))
+  ], repeat))
+  print(f'[계산 한도] {code}')
+  print(f'  Budget 없이             : {plain * 1e6:7.2f}us/번')
+  print(f'  걸음/시간/cancel        : {limited * 1e6:7.2f}us/번 ({limited / plain:.2f}배)')
+  print(f'  + 크기                  : {checked * 1e6:7.2f}us/번 ({checked / plain:.2f}배)')
+  print(f'  + 크기, 계산마다 restart: {restarted * 1e6:7.2f}us/번 ({restarted / plain:.2f}배)')
+  print(f'  + 크기, 계산마다 새로   : {fresh * 1e6:7.2f}us/번 ({fresh / plain:.2f}배)')
+  # 이 수식은 연산 7개에 함수 호출/정의 펼치기가 3번이라 한도를 보는 비율이 높은 편.
+  # 크기는 연산마다 비교를 한 번 더 하니까, 노드 하나가 비교 몇 번인 interpret()에서는 그만큼 더 느려짐
+  assert limited < plain * 1.10, '걸음/시간/cancel을 보느라 10% 넘게 느려졌어요'
+  assert checked < limited * 1.12, '연산마다 크기를 보느라 12% 넘게 느려졌어요'
+  # restart()나 새 Budget은 계산마다 시간을 처음부터 재니까(time.monotonic()) checked보다 조금은 느림
+  assert restarted - checked < (fresh - checked) / 2, 'restart()가 새로 만드는 것의 반보다 오래 걸렸어요'
+
+
+
+  # ga(x) = x + 1, gb(x) = ga(x) + ga(x), ...: 함수를 2^levels번 부름
+  names = [nameOf('g', i) for i in range(levels)]
+  definitions = [f'Let {names[0]}(x) = x + 1'] + [
+      f'Let {name}(x) = {previous}(x) + {previous}(x)'
+      for previous, name in zip(names, names[1:])
+  ]
+  runaway = parseMathToAst(', '.join(definitions) + f', {names[-1]}(1)')
+  for name, budget in [('걸음 10^5', Budget(maxSteps=10**5)),
+                       ('시간 0.2초', Budget(timeLimit=0.2)),
+                       ('0.2초 뒤 취소', Budget(cancel=cancel))]:
+    cancel.clear()
+    timer = threading.Timer(0.2, cancel.set)
+    timer.start()
+    start = timeit.default_timer()
+    try:
+      interpret(runaway, {}, budget)
+      raise Exception('한도에 안 걸렸어요')
+    except EvaluationLimitExceeded as e:
+      error = type(e).__name__
+    timer.cancel()
+    print(f'  2^{levels}번 부르는 수식, {name:9}: '
+          f'{timeit.default_timer() - start:5.3f}s 만에 {error} ({budget.steps}걸음)')
+
+
+# %%
+# 확인 (check)
+#
+# 벤치마크와 달리 시간은 안 재고, 항상 같아야 하는 결과를 assert로 확인함. 난수도 seed를 정해서 씀.
+# runAll()이 벤치마크보다 먼저 부르고, 이것만 돌릴 때는: python 벤치마크.py --check
+
+
+# 스크립트를 몇 글자씩 읽든 문장이 통째로 읽었을 때와 똑같이 나뉘는지 (조각 크기 1글자부터 스크립트 길이까지)
+def checkScriptChunks():
+  script = ('Let f(x, y) = x * y + 1\n'
+            '1 != 2, 3.25 + 4\n'
+            'f(2,\n   3) - 12.5 * (7 % 3)\n'
+            '\n'
+            'Let g(t) = t ^ 2, g(f(1, 2))   \n'
+            'sin(pi / 2) + abc123 * -0.5\n')
+  # 여는 괄호 없는 ')'는 조각 크기와 상관없이 같은 곳에서 오류가 나야 함 (뒤의 문장과 합쳐지면 안 됨)
+  unmatched = '1 + 2)\n3 + 4\n5\n'
+
+  def statements(code, size):
+    try:
+      return [(line, [token.code for token in tokens])
+              for line, tokens in scriptStatements(readChunks(io.StringIO(code), size))]
+    except Exception as e:
+      return str(e)
+
+  expected = statements(script, len(script))
+  assert expected[1] == (2, ['1', '!=', '2']), expected
+  expectedError = statements(unmatched, len(unmatched))
+  assert isinstance(expectedError, str), expectedError
+  for size in range(1, len(script) + 1):
+    assert statements(script, size) == expected, f'{size}글자씩 읽으면 문장이 달라요'
+    assert statements(unmatched, size) == expectedError, f'{size}글자씩 읽으면 오류가 달라요'
+  print(f'[확인] 스크립트 조각 크기 1~{len(script)}글자: 문장 {len(expected)}개가 모두 같음')
+
+
+# 두 트리가 같은지 비교할 수 있는 값: 노드 종류와 노드마다 가리키는 토큰들 (Let의 몸통까지)
+# repr의 함수 주소(at 0x...)는 빼고 비교함
+def nodeShape(node: Node):
+  shape = []
+  stack = [node]
+  while stack:
+    current = stack.pop()
+    tokens = current.tokens
+    shape.append((type(current).__name__,
+                  tuple(tokens[i].code for i in range(len(tokens)))))
+    if isinstance(current, Contexted):
+      for value in current.contexts.values():
+        if value.body is not None:
+          stack.append(value.body)
+    stack.extend(current.children())
+  return re.sub(r' at 0x[0-9a-f]+', '', repr(node)), shape
+
+
+# IncrementalParser로 조금씩 고친 트리가 매번 처음부터 parseMathToAst()로 파싱한 것과 같은지.
+# 파싱할 수 없게 고쳤으면 둘 다 오류가 나야 함
+def checkIncrementalParser(edits=3000):
+  rng = random.Random(0)
+  base = 'Let f(a, b) = a * b + 1, f(2, x) + sin(x) * (3 - y) / 4 - -5'
+  pieces = [
+      '', '1', '7.5', 'x', ' ', '+', ' - ', '*', '^', '(', ')', ',', 'sin(',
+      'f(1, 2)', '(x + 1)', 'Let g(t) = t, '
+  ]
+  parser = IncrementalParser(base)
+  parsed = 0
+  for _ in range(edits):
+    code = parser.code
+    if len(code) > 3 * len(base) or (parser.node is None and rng.random() < 0.3):
+      edit = (0, len(code), base)
+    elif rng.random() < 0.7:
+      # 모양이 유지되는 고치기: 숫자나 x, y를 바꾸거나 그 뒤에 끼워 넣기 (부분 트리만 다시 파싱하는 경우)
+      places = [match.start() for match in re.finditer(r'\d|\b[xy]\b', code)]
+      at = rng.choice(places or [0])
+      edit = rng.choice([(at, at + 1, str(rng.randint(1, 9))),
+                         (at, at, str(rng.randint(0, 9))),
+                         (at + 1, at + 1, rng.choice([' + 1', ' * (x - 2)', ' ^ y', ', 3']))])
+    else:
+      start = rng.randint(0, len(code))
+      edit = (start, min(len(code), start + rng.randint(0, 3)), rng.choice(pieces))
+
+    try:
+      node = parser.edit(*edit)
+    except Exception:
+      node = None
+    try:
+      expected = parseMathToAst(parser.code)
+    except Exception:
+      expected = None
+    assert (node is None) == (expected is None), f'{parser.code!r}: 한쪽만 파싱돼요'
+    if expected is not None:
+      assert nodeShape(node) == nodeShape(expected), f'{parser.code!r}: 트리가 달라요'
+      parsed += 1
+  assert parser.partialParses >= edits // 10, parser  # 부분 트리만 다시 파싱하는 경우도 충분히 확인했는지
+  print(f'[확인] IncrementalParser: 고치기 {edits}번, 파싱되는 {parsed}번 모두 처음부터 파싱한 것과 같음')
+  print(f'  {parser}')
+
+
+# 재귀 한도보다 깊은 수식을 계산하는 방법마다 결과가 같은지 (파서가 적어둔 깊이를 보고 재귀로 계산할지 반복문으로 계산할지 미리 고름)
+def checkDeepNesting(depth=5000):
+  context = {'x': 2.0, 'f': userFunction(['a'], parseMathToAst('a + 1'))}
+  # 앞의 것을 부르는 정의 depth개: 정의를 펼친 깊이가 depth
+  definitions = [f'Let {nameOf("g", 0)}(t) = t + 1'] + [
+      f'Let {nameOf("g", i)}(t) = {nameOf("g", i - 1)}(t) * 0.5 + 1'
+      for i in range(1, depth)
+  ]
+  shapes = [('괄호', '(' * depth + 'x' + ')' * depth),
+            ('단항 연산자', '-' * depth + 'x'),
+            ('함수 호출', 'f(' * depth + 'x' + ')' * depth),
+            ('왼쪽으로 깊은 연산', 'x' + ' - 1' * depth),
+            ('오른쪽으로 깊은 연산', '1 + (' * depth + 'x' + ')' * depth),
+            ('Let 안의 내장함수',
+             f'Let h(t) = {"sin(" * depth}t{")" * depth}, h(x)'),
+            ('정의 사슬',
+             ', '.join(definitions) + f', {nameOf("g", depth - 1)}(x)')]
+  for name, code in shapes:
+    node = parseMathToAst(code)
+    expected = interpret(node, context)
+    results = {
+        'compile': compile(node)(context),
+        'resolve': resolve(node)(context),
+        'interpretShared': interpretShared(node, context),
+        'optimize': interpret(optimize(node), context),
+        'Budget': interpret(node, context, Budget(maxSteps=10**6))
+    }
+    for method, value in results.items():
+      assert value == expected, f'{name}: {method}가 {value}, interpret가 {expected}'
+  print(f'[확인] {depth}겹 수식 {len(shapes)}개: interpret, {", ".join(results)}가 모두 같음')
+
+
+def runChecks():
+  checkScriptChunks()
+  checkIncrementalParser()
+  checkDeepNesting()
+
+
+# %%
+# 재현할 수 있는 벤치마크 모음 (suite)
+#
+# 위의 benchmarkXxx()들은 기능 하나씩 재보는 것이고, suite는 수식 모양별로 같은 세 단계를 재서
+# 두 버전을 비교하는 용도. 수식은 seed로 만든 난수로 만드니까 seed가 같으면 항상 같은 수식임.
+#   - flatSum:          항이 아주 많은 덧셈/뺄셈 (1 * x + 2 / y - ...)
+#   - nestedParentheses: 아주 깊이 중첩된 괄호 (((x + 1) * 2) - 3 ...)
+#   - letChain:         긴 Let 사슬 (Let va = ..., Let vb = ..., va + vb ...)
+#   - manyArguments:    인수가 많은 함수 호출 (Let f(pa, pb, ...) = ..., f(1, 2, ...) + ...)
+#   - trigonometry:     내장함수(삼각함수 등)가 많은 수식
+# 단계마다 시간(한 번에 걸리는 초), 늘어난 메모리 블록 개수(결과가 붙잡고 있는 것), 최대 메모리 사용량(바이트)을 잼.
+#   - tokenize:       Tokenizer로 토큰 나누기
+#   - parseMathToAst: 토큰 나누기 + 파싱
+#   - interpret:      파싱해둔 트리 계산하기
+#
+# python 벤치마크.py --suite --output new.json                    # 결과를 JSON으로 저장
+# python 벤치마크.py --suite --compare old.json --threshold 0.1   # old.json보다 10% 넘게 느려지거나 메모리를 더 쓰는 것을 알려줌
+suiteVersion = 1
+
+
+# 수식 만드는 함수들: (난수 생성기, 크기) -> (수식, 계산할 때 쓸 context)
+def flatSum(rng: random.Random, size: int):
+  terms = [
+      f'{rng.randint(1, 999)} {rng.choice("*/")} {rng.choice("xy")}'
+      for _ in range(size)
+  ]
+  code = terms[0]
+  for term in terms[1:]:
+    code += f' {rng.choice("+-")} {term}'
+  return code, {'x': 1.5, 'y': 2.5}
+
+
+def nestedParentheses(rng: random.Random, size: int):
+  parts = ['x']
+  for _ in range(size):
+    operator = rng.choice(['+', '-', '* 0.5 +'])
+    parts.append(f' {operator} {rng.randint(1, 9)})')
+  return '(' * size + ''.join(parts), {'x': 1.5}
+
+
+def letChain(rng: random.Random, size: int):
+  names = [nameOf('v', i) for i in range(size)]
+  definitions = []
+  for i, name in enumerate(names):
+    # 가끔은 바로 앞의 몇 개 중 하나를 씀 (기호를 읽을 때마다 우변을 계산하니까 너무 길게 이어지지는 않게)
+    if i and rng.random() < 0.3:
+      used = names[rng.randrange(max(0, i - 5), i)]
+      definitions.append(f'Let {name} = {used} + {rng.randint(1, 99)}')
+    else:
+      definitions.append(
+          f'Let {name} = {rng.randint(1, 99)} * x + {rng.randint(1, 99)}')
+  used = rng.sample(names, min(100, size))
+  return ', '.join(definitions) + ', ' + ' + '.join(used), {'x': 1.5}
+
+
+def manyArguments(rng: random.Random, size: int):
+  parameters = [nameOf('p', i) for i in range(size)]
+  body = ' + '.join(f'{parameter} * {rng.randint(1, 9)}'
+                    for parameter in parameters)
+  calls = [
+      'f(' + ', '.join(str(rng.randint(0, 99)) for _ in parameters) + ')'
+      for _ in range(100)
+  ]
+  return f'Let f({", ".join(parameters)}) = {body}, ' + ' + '.join(calls), {}
+
+
+def trigonometry(rng: random.Random, size: int):
+  functions = ['sin', 'cos', 'tan', 'atan', 'ln', 'log']
+  terms = []
+  for _ in range(size):
+    inner = f'{rng.choice("xy")} * {rng.randint(1, 9)}.{rng.randint(0, 9)}'
+    function = rng.choice(functions)
+    if function in ('ln', 'log'):
+      inner = f'1 + {inner}'  # 로그에는 양수만
+    terms.append(
+        f'{function}({inner}) {rng.choice("*/")} {rng.choice(functions[:2])}({rng.choice("xy")})'
+    )
+  return ' + '.join(terms), {'x': 0.5, 'y': 0.25}
+
+
+# (이름, 수식 만드는 함수, 기본 크기)
+suiteScenarios = [('flatSum', flatSum, 20000),
+                  ('nestedParentheses', nestedParentheses, 2000),
+                  ('letChain', letChain, 2000),
+                  ('manyArguments', manyArguments, 60),
+                  ('trigonometry', trigonometry, 2000)]
+
+
+# function 한 번의 시간, 결과가 붙잡고 있는 메모리 블록 개수, 최대 메모리 사용량
+def measurePhase(function) -> dict:
+  function()  # 처음 한 번은 빼고 잼
+
+  # 0.05초 이상 걸리게 횟수를 늘린 다음 가장 빠른 것
+  number = 1
+  while timeit.timeit(function, number=number) < 0.05:
+    number *= 2
+  seconds = min(timeit.repeat(function, number=number, repeat=5)) / number
+
+  gc.collect()
+  blocks = sys.getallocatedblocks()
+  result = function()
+  allocatedBlocks = sys.getallocatedblocks() - blocks
+  del result
+
+  gc.collect()
+  tracemalloc.start()
+  baseline = tracemalloc.get_traced_memory()[0]
+  result = function()
+  peakBytes = tracemalloc.get_traced_memory()[1] - baseline
+  tracemalloc.stop()
+  del result
+
+  return {
+      'seconds': seconds,
+      'allocatedBlocks': allocatedBlocks,
+      'peakBytes': peakBytes
+  }
+
+
+def runSuite(seed: int = 0, scale: float = 1.0) -> dict:
+  results = {}
+  for name, generate, size in suiteScenarios:
+    size = max(1, int(size * scale))
+    code, context = generate(random.Random(f'{seed}:{name}'), size)
+    tokens = tokenize(code)
+    node = parseMathToAst(code)
+    phases = {
+        'tokenize': measurePhase(lambda: tokenize(code)),
+        'parseMathToAst': measurePhase(lambda: parseMathToAst(code)),
+        'interpret': measurePhase(lambda: interpret(node, context))
+    }
+    results[name] = {
+        'size': size,
+        'characters': len(code),
+        'tokens': len(tokens),
+        'digest': hashlib.sha1(code.encode('utf-8')).hexdigest(),
+        'phases': phases
+    }
+    print(f'[suite] {name} (크기 {size}, {len(code)}글자, 토큰 {len(tokens)}개)')
+    for phase, measured in phases.items():
+      print(f'  {phase:15}: {measured["seconds"] * 1e3:10.3f}ms, '
+            f'블록 {measured["allocatedBlocks"]:8}개, '
+            f'최대 {measured["peakBytes"] / 1024:10.1f}KB')
+
+  return {
+      'version': suiteVersion,
+      'seed': seed,
+      'scale': scale,
+      'python': sys.version,
+      'scenarios': results
+  }
+
+
+# baseline과 비교해서 threshold(0.1이면 10%)보다 더 느려지거나 메모리를 더 쓴 것들을 돌려줌
+def compareSuite(baseline: dict, current: dict, threshold: float) -> List[str]:
+  if baseline.get('version') != current['version']:
+    raise Exception(f'suite 버전이 달라서 비교할 수 없어요: {baseline.get("version")}')
+
+  regressions = []
+  print(f'[suite 비교] 기준보다 {threshold:.0%} 넘게 나빠지면 표시함')
+  for name, result in current['scenarios'].items():
+    old = baseline['scenarios'].get(name)
+    if old is None:
+      print(f'  {name}: 기준 결과에 없음')
+      continue
+    if old['digest'] != result['digest']:
+      print(f'  {name}: 수식이 달라서 비교하지 않음 (seed나 크기가 다름)')
+      continue
+    for phase, measured in result['phases'].items():
+      before = old['phases'][phase]
+      # 늘어난 블록 개수는 0이나 음수(계산하다 다른 게 풀림)일 수도 있어서 양수일 때만 비율을 봄
+      for key, unit, scale, digits in [('seconds', 'ms', 1e3, 3),
+                                       ('allocatedBlocks', '개', 1, 0),
+                                       ('peakBytes', 'KB', 1 / 1024, 3)]:
+        ratio = measured[key] / before[key] if before[key] > 0 else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+          flag = '  <- 나빠짐'
+          regressions.append(f'{name}.{phase}.{key}')
+        print(f'  {name}.{phase}.{key}: {before[key] * scale:.{digits}f}{unit} -> '
+              f'{measured[key] * scale:.{digits}f}{unit} ({ratio:.2f}배){flag}')
+  return regressions
+
+
+# %%
+# 계산 서버 부하 테스트
+#
+# concurrency개의 연결이 각자 요청 하나를 보내고 응답이 오면 다음 요청을 보냄.
+# 요청마다 보내고 응답이 올 때까지 걸린 시간(지연 시간)의 p50/p99와 초당 요청 수를 잼.
+#   python 최종결과.py --serve 127.0.0.1:8765 &
+#   python 벤치마크.py --load-test 127.0.0.1:8765 --requests 20000 --concurrency 64
+#
+# 수식은 몇 개만 돌려쓰고 bindings만 바꿔서, 서버가 같은 수식을 모아서 계산할 수 있게 함
+loadTestExpressions = [
+    'x ^ 2 + sin(y)', 'Let f(t) = t * t - 1, f(x) / (1 + y ^ 2)',
+    'atan(y / x) * 180 / pi', 'ln(x) + log(y) * 2', '(x + y) * (x - y) / 3'
+]
+
+
+def loadTestLines(requests: int, seed: int) -> List[bytes]:
+  rng = random.Random(seed)
+  lines = []
+  for number in range(requests):
+    request = {
+        'id': number,
+        'expression': rng.choice(loadTestExpressions),
+        'bindings': {
+            'x': rng.uniform(0.1, 10),
+            'y': rng.uniform(0.1, 10)
+        }
+    }
+    lines.append(jsonLine(request).encode('utf-8'))
+  return lines
+
+
+def percentile(values: List[float], fraction: float) -> float:
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def loadTestAsync(address: str,
+                        requests: int = 10000,
+                        concurrency: int = 32,
+                        seed: int = 0) -> dict:
+  where = parseAddress(address)
+  lines = loadTestLines(requests, seed)
+  queue = iter(lines)  # 연결들이 나눠서 꺼내감
+  latencies = []
+  errors = []
+
+  async def connection():
+    if isinstance(where, str):
+      reader, writer = await asyncio.open_unix_connection(where)
+    else:
+      reader, writer = await asyncio.open_connection(*where)
+    try:
+      for line in queue:
+        start = time.perf_counter()
+        writer.write(line)
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append(time.perf_counter() - start)
+        if 'error' in response:
+          errors.append(response['error'])
+    finally:
+      writer.close()
+      await writer.wait_closed()
+
+  start = time.perf_counter()
+  await asyncio.gather(*(connection() for _ in range(concurrency)))
+  seconds = time.perf_counter() - start
+
+  latencies.sort()
+  return {
+      'requests': len(latencies),
+      'errors': len(errors),
+      'seconds': seconds,
+      'requestsPerSecond': len(latencies) / seconds,
+      'p50': percentile(latencies, 0.5),
+      'p99': percentile(latencies, 0.99),
+      'max': latencies[-1]
+  }
+
+
+def loadTest(address: str,
+             requests: int = 10000,
+             concurrency: int = 32,
+             seed: int = 0) -> dict:
+  return asyncio.run(loadTestAsync(address, requests, concurrency, seed))
+
+
+def printLoadTest(title: str, result: dict):
+  print(f'  {title}: {result["requestsPerSecond"]:8.0f}요청/초, '
+        f'p50 {result["p50"] * 1e3:7.2f}ms, p99 {result["p99"] * 1e3:7.2f}ms, '
+        f'최대 {result["max"] * 1e3:7.2f}ms, 오류 {result["errors"]}개')
+
+
+# 같은 프로세스에서 서버를 띄우고 부하 테스트: 같은 수식을 모으지 않을 때와 모을 때
+def benchmarkServer(requests=5000, concurrency=32):
+
+  async def run(batchDelay):
+    server = CalculatorServer(jobs=1, batchDelay=batchDelay)
+    await server.start('127.0.0.1:0')
+    try:
+      result = await loadTestAsync(server.address(), requests, concurrency)
+    finally:
+      await server.close()
+    return result, server
+
+  print(f'[계산 서버] 요청 {requests}개, 동시에 {concurrency}개, 계산 스레드 1개')
+  for title, batchDelay in [('모으지 않음     ', 0), ('2ms씩 모음      ', 0.002)]:
+    result, server = asyncio.run(run(batchDelay))
+    assert result['errors'] == 0
+    printLoadTest(title, result)
+    print(f'    {server}')
+
+
+def runAll():
+  runChecks()
+  benchmarkCompile()
+  benchmarkOptimize()
+  benchmarkSharedSubexpressions()
+  benchmarkMemoize()
+  benchmarkResolve()
+  benchmarkDefinitions()
+  benchmarkSnapshot()
+  benchmarkProfile()
+  benchmarkDeepNesting()
+  benchmarkBudget()
+  benchmarkGradient()
+  benchmarkSolve()
+  benchmarkBatch()
+  benchmarkServer()
+  benchmarkVectorize()
+  benchmarkGrid()
+  benchmarkTokenizer()
+  benchmarkParseScaling()
+  benchmarkLetChain()
+  benchmarkParseCache()
+  benchmarkIncremental()
+  benchmarkNodeMemory()
+  benchmarkTokenBuffer()
+
+
+def main(argv=None) -> int:
+  parser = argparse.ArgumentParser(description='최종결과.py 벤치마크')
+  parser.add_argument('--check',
+                      action='store_true',
+                      help='시간은 안 재고 결과가 맞는지만 확인함')
+  parser.add_argument('--suite',
+                      action='store_true',
+                      help='수식 모양별로 tokenize/parseMathToAst/interpret를 재는 suite만 실행')
+  parser.add_argument('--seed', type=int, default=0, help='수식을 만들 난수 seed')
+  parser.add_argument('--scale',
+                      type=float,
+                      default=1.0,
+                      help='수식 크기 배율 (빨리 돌려볼 때 0.1 등)')
+  parser.add_argument('--output', metavar='FILE', help='suite 결과를 저장할 JSON 파일')
+  parser.add_argument('--compare',
+                      metavar='FILE',
+                      help='비교할 기준 suite 결과 JSON 파일')
+  parser.add_argument('--threshold',
+                      type=float,
+                      default=0.1,
+                      help='이만큼(비율) 넘게 나빠지면 실패로 침 (기본: 0.1)')
+  parser.add_argument('--load-test',
+                      metavar='ADDRESS',
+                      help='이 주소의 계산 서버(python 최종결과.py --serve ...)에 부하 테스트만 함')
+  parser.add_argument('--requests',
+                      type=int,
+                      default=10000,
+                      help='부하 테스트에서 보낼 요청 개수 (기본: 10000)')
+  parser.add_argument('--concurrency',
+                      type=int,
+                      default=32,
+                      help='부하 테스트에서 동시에 여는 연결 개수 (기본: 32)')
+  args = parser.parse_args(argv)
+
+  if args.load_test is not None:
+    if args.suite:
+      parser.error('--load-test와 --suite는 같이 쓸 수 없어요')
+    if args.requests < 1 or args.concurrency < 1:
+      parser.error('--requests와 --concurrency는 1 이상이어야 해요')
+    result = loadTest(args.load_test, args.requests, args.concurrency,
+                      args.seed)
+    print(f'[부하 테스트] {args.load_test}: 요청 {result["requests"]}개, '
+          f'동시에 {args.concurrency}개, {result["seconds"]:.2f}초')
+    printLoadTest('결과', result)
+    return 1 if result['errors'] else 0
+
+  if args.check:
+    if args.suite:
+      parser.error('--check와 --suite는 같이 쓸 수 없어요')
+    runChecks()
+    return 0
+
+  if not args.suite:
+    if args.output or args.compare:
+      parser.error('--output/--compare는 --suite와 같이 써야 해요')
+    runAll()
+    return 0
+
+  baseline = None
+  if args.compare is not None:
+    with open(args.compare, encoding='utf-8') as file:
+      baseline = json.load(file)
+
+  results = runSuite(args.seed, args.scale)
+  if args.output is not None:
+    with open(args.output, 'w', encoding='utf-8') as file:
+      json.dump(results, file, ensure_ascii=False, indent=2)
+  if baseline is None:
+    return 0
+
+  regressions = compareSuite(baseline, results, args.threshold)
+  if regressions:
+    print(f'나빠진 것 {len(regressions)}개: {", ".join(regressions)}')
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
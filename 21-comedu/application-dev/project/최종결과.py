@@ -1,5 +1,29 @@
+import argparse
+import asyncio
+import bisect
+import contextvars
+import csv
+import json
+import math
+import mmap
+import operator
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from types import MappingProxyType
 from typing import *
 
+# typing에도 OrderedDict가 있어서 collections 것은 typing 다음에 가져옴
+from collections import OrderedDict, deque
+
 # 토큰들
 
 # %%
@@ -28,8 +52,8 @@ tOperatorPrecedences = {
 }
 # 이항 연산자: a + b처럼 이항연산을 하는 경우
 # binaryOperators = ['+', '-', '*', '/', '%', '^']
-# 단항 연산자: +a, -a처럼 머리에 붙어서 한 숫자와만 관여하는 경우
-# unaryOperators = ['+', '-']
+# 단항 연산자: +a, -a처럼 머리에 붙어서 한 숫자와만 관여하는 경우 (~a는 not a)
+tUnaryOperators = ['+', '-', '~']
 # 가능한 숫자의 종류: 123.45 같은거
 tDigits = '0123456789e.'
 
@@ -61,6 +85,51 @@ class Token:
 # %%
 
 
+# 토큰 하나를 찾는 정규표현식. 예전에는 글자를 하나씩 보면서 if문으로 종류를 골랐는데,
+# 긴 수식에서는 이게 꽤 느려서 종류별 패턴을 하나로 합친 정규표현식을 미리 컴파일해둠.
+# 이름 붙은 그룹(?P<종류>...) 중에 맞은 것이 곧 토큰의 종류고, 뒤따르는 띄어쓰기까지 같이 먹음.
+# 연산자는 긴 것('!=')부터 확인해야 '!'나 '='로 잘못 잘리지 않음
+def choicePattern(codes):
+  return '|'.join(
+      re.escape(code) for code in sorted(codes, key=len, reverse=True))
+
+
+tokenAlternatives = '|'.join([
+    f'(?P<operator>{choicePattern(tOperators1 + tOperators2)})',
+    r'(?P<group>\()',
+    r'(?P<group_close>\))',
+    f'(?P<terminator>{choicePattern(tTerminators)})',
+    rf'(?P<number>\d[{re.escape(tDigits)}]*)',
+    r'(?P<text>[^\W\d_]+)',  # 글자 (숫자, _를 뺀 \w)
+])
+tokenPattern = re.compile(f'(?:{tokenAlternatives})' + r'\s*')
+
+# 토큰 종류별 우선순위 (연산자는 tOperatorPrecedences에서 찾음)
+tKindPrecedences = {
+    'group': 1000,
+    'group_close': 1000,
+    'terminator': -100,
+    'number': 0,
+    'text': 0
+}
+
+# 연산자, 괄호, 구분자처럼 글자가 정해진 토큰은 매번 새로 만들 필요가 없어서 하나씩만 만들어두고 같이 씀
+fixedTokens = {
+    '(': Token(kind='group', code='(', precedence=tKindPrecedences['group']),
+    ')': Token(kind='group_close',
+               code=')',
+               precedence=tKindPrecedences['group_close'])
+}
+for code in tOperators1 + tOperators2:
+  fixedTokens[code] = Token(kind='operator',
+                            code=code,
+                            precedence=tOperatorPrecedences[code])
+for code in tTerminators:
+  fixedTokens[code] = Token(kind='terminator',
+                            code=code,
+                            precedence=tKindPrecedences['terminator'])
+
+
 # 그냥 글자 ('1 + 3 * 4' 같은)을 받아서 Token들로 바꿔주는 (숫자 1, 연산자 +, 숫자 3, 연산자 *, 숫자 4) 공장?
 class Tokenizer:
   index: int = 0
@@ -68,6 +137,8 @@ class Tokenizer:
 
   def __init__(self, code: str):
     self.code = code
+    # 맨 앞의 띄어쓰기는 미리 건너뜀 (토큰 뒤의 띄어쓰기는 advance()가 같이 먹음)
+    self.index = len(code) - len(code.lstrip())
 
   # 끝까지 다 봤는지 여부
   def eof(self):
@@ -75,53 +146,27 @@ class Tokenizer:
 
   # 다음 '토큰'을 불러오는 함수
   def advance(self):
-    while True:  # 띄어쓰기는 무시하기 때문에 띄어쓰기를 제외한 다음 토큰을 찾아서 반환함
-      start = self.index
-      c = self.code[start]
-      self.index += 1
-
-      def match2(index):
-        if index + 1 >= len(self.code):
-          return False
-
-        c2 = self.code[index + 1]
-        s = f'{c}{c2}'
-        return s in tOperators2
-
-      # match는 if .. else if .. else가 귀찮을 때 쓸 수 있음
-      # 아래 코드는 if c in tOperators: .. else if c in tDigits: .. else if c == '(': .. 와 같음
-      # 지금 텍스트가
-      if c == '(':  # 괄호 열기
-        return Token(kind='group', code=c, precedence=1000)
-      elif c == ')':  # 괄호 닫기
-        return Token(kind='group_close', code=c, precedence=1000)
-      elif c in tOperators1:  # 연산자
-        return Token(kind='operator',
-                     code=c,
-                     precedence=tOperatorPrecedences[c])
-      elif match2(start):
-        return Token(kind='operator',
-                     code=self.code[start:start + 1],
-                     precedence=tOperatorPrecedences[c])
-      elif c in tTerminators:
-        return Token(kind='terminator', code=c, precedence=-100)
-      elif c.isdigit():  # 숫자
-        # Parse number
-        while (not self.eof()) and self.code[self.index] in tDigits:
-          self.index += 1
-        return Token(kind='number',
-                     code=self.code[start:self.index],
-                     precedence=0)
-      elif c.isalpha():  # 글자
-        while (not self.eof()) and self.code[self.index].isalpha():
-          self.index += 1
-        return Token(kind='text',
-                     code=self.code[start:self.index],
-                     precedence=0)
-      else:
-        if c.isspace():  # 띄어쓰기는 무시
-          continue
-        raise Exception(f'Malformed expression: {c} at {start}')
+    match = tokenPattern.match(self.code, self.index)
+    if match is None:
+      c = self.code[self.index]
+      raise Exception(f'Malformed expression: {c} at {self.index}')
+
+    self.index = match.end()
+    kind = match.lastgroup
+    code = match.group(kind)
+    token = fixedTokens.get(code)
+    if token is not None:
+      return token
+    return Token(kind=kind, code=code, precedence=tKindPrecedences[kind])
+
+
+# 수식 전체를 토큰들로 바꿈
+def tokenize(code: str) -> List[Token]:
+  tokenizer = Tokenizer(code)
+  tokens = []
+  while not tokenizer.eof():
+    tokens.append(tokenizer.advance())
+  return tokens
 
 
 def debugTokens(tokens: List[Token]):
@@ -162,6 +207,88 @@ class TokenReference:
     return f'TokenReference({self.allTokens[self.start:self.end]})'
 
 
+# %%
+# 토큰 종류들. TokenBuffer에는 종류 이름 대신 여기서의 번호를 담아둠
+tKinds = ('operator', 'group', 'group_close', 'terminator', 'number', 'text')
+tKindIndices = {kind: index for index, kind in enumerate(tKinds)}
+
+# tokenPattern과 같지만, 토큰 앞의 띄어쓰기를 먹고 알 수 없는 글자는 error로 잡음.
+# finditer로 한 번에 훑을 때 쓰는데, 이러면 맞지 않는 글자를 건너뛰지 않고 error로 알 수 있음
+scanPattern = re.compile(r'\s*(?:' + tokenAlternatives + r'|(?P<error>\S))')
+
+
+# Token 객체를 토큰마다 만들지 않고, 종류/시작 위치/끝 위치/우선순위를 각각 배열(array) 하나씩에 담아둠.
+# 토큰의 글자('123', 'sin' 등)는 원래 수식에서 필요할 때만 잘라서 씀.
+# 수십 MB짜리 수식에서 토큰이 수천만 개가 되어도 작은 객체를 수천만 개 만들지 않아도 됨.
+# (토큰 하나에 11바이트: Token 객체 + 글자 문자열이면 100바이트가 넘음)
+#
+# buffer = TokenBuffer.fromCode('1 + sin(x)')
+# buffer.kindAt(2), buffer.codeAt(2)  # 'text', 'sin'
+# parseToAst(buffer, 0, len(buffer))  # Token 목록일 때와 같은 트리
+class TokenBuffer:
+  code: str  # 원래 수식
+  kinds: array  # tKinds에서의 번호
+  starts: array
+  ends: array
+  precedences: array
+
+  def __init__(self, code: str):
+    self.code = code
+    self.kinds = array('b')
+    self.starts = array('I')
+    self.ends = array('I')
+    self.precedences = array('h')
+
+  @staticmethod
+  def fromCode(code: str) -> 'TokenBuffer':
+    buffer = TokenBuffer(code)
+    kinds = buffer.kinds.append
+    starts = buffer.starts.append
+    ends = buffer.ends.append
+    precedences = buffer.precedences.append
+
+    for match in scanPattern.finditer(code):
+      kind = match.lastgroup
+      if kind == 'error':
+        raise Exception(
+            f'Malformed expression: {match.group(kind)} at {match.start(kind)}')
+
+      kinds(tKindIndices[kind])
+      starts(match.start(kind))
+      ends(match.end())
+      if kind == 'operator':
+        precedences(tOperatorPrecedences[match.group(kind)])
+      else:
+        precedences(tKindPrecedences[kind])
+
+    return buffer
+
+  def __len__(self):
+    return len(self.kinds)
+
+  def kindAt(self, index: int) -> str:
+    return tKinds[self.kinds[index]]
+
+  def codeAt(self, index: int) -> str:
+    return self.code[self.starts[index]:self.ends[index]]
+
+  def precedenceAt(self, index: int) -> int:
+    return self.precedences[index]
+
+  # buffer[index]처럼 쓰면 그때 Token을 만들어줌 (TokenReference나 디버깅용)
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(len(self)))]
+    if index < 0:
+      index += len(self)
+    return Token(kind=self.kindAt(index),
+                 code=self.codeAt(index),
+                 precedence=self.precedences[index])
+
+  def __repr__(self):
+    return f'TokenBuffer({len(self)}개)'
+
+
 # %% [markdown]
 # ### 노드들
 
@@ -172,18 +299,45 @@ class TokenReference:
 # 보통 이런 '노드'를 AST(Abstract Syntax Tree)라고 하는데, 구문(수학의 문법; 곱하기 나누기 같은 스타일이라 해야하나)을 추상적인 트리 형식으로 나타낸 것.
 # 예를 들어 1 + 2 * 3이라는 수식은 1 더하기 (2 곱하기 3)이라고 나타낼 수 있고, 이걸 '노드'를 통해 나타내면 대략적으로
 # Add(1, Multiply(2, 3))처럼 나타낼 수 있음. (실제로 이 코드에서는 조금 다름)
+#
+# 수식이 크면 노드가 수십만 개가 되니까 노드는 최대한 가볍게 만듦:
+# - __slots__: 노드마다 __dict__를 만들지 않고 정해진 칸에만 값을 담음
+# - kind: 노드마다 들고 있지 않고 클래스에 하나만 둠 (Group.kind == 'group')
+# - 토큰 범위: TokenReference를 노드마다 만들지 않고 전체 토큰 목록과 시작/끝 위치 숫자만 들고 있음.
+#   node.tokens를 읽으면 그때 TokenReference를 만들어줌
 class Node:
+  __slots__ = ('allTokens', 'start', 'end', 'depth')
   parent: Optional['Node']
-  tokens: TokenReference
+  allTokens: List[Token]
+  start: int
+  end: int
+  # 이 노드부터 가장 깊은 잎까지의 노드 수 (숫자 하나면 1). 파서가 적어두고, 아니면 nestingDepth()가 처음 셀 때 적음
+  depth: int
   kind: str
+  # 여러 곳에서 같이 쓰는 노드(ParseCache에 담긴 노드 등)는 freeze()로 얼려서 못 바꾸게 함
+  frozen: bool = False
 
   # 이 '노드'를 구성하는 토큰들이 원래 뭐였는지 포함하면 개발이 편할 것 같아서 tokens를 받게 해놨음
   def __init__(self, tokens):
-    self.tokens = tokens
+    self.allTokens = tokens.allTokens
+    self.start = tokens.start
+    self.end = tokens.end
+
+  @property
+  def tokens(self) -> TokenReference:
+    return TokenReference.ofEnd(allTokens=self.allTokens,
+                                start=self.start,
+                                end=self.end)
+
+  # 바로 아래 자식 노드들
+  def children(self) -> List['Node']:
+    return []
 
 
 # 그룹: 괄호로 묶인 부분
 class Group(Node):
+  __slots__ = ('node',)
+  kind = 'group'
   node: Node
 
   # 클래스를 '만들 때' 호출됨.
@@ -191,7 +345,6 @@ class Group(Node):
   def __init__(self, tokens, node):
     super().__init__(tokens)
     self.node = node
-    self.kind = 'group'
 
   # 참고: __repr__은 그 클래스의 값을 문자열로 바꿀 때 기본적으로 호출됨.
   # print(node)를 할 때 겁나 괴랄하게 출력된다면 버그 고치기 힘들 것 같아서 만들음.
@@ -202,9 +355,14 @@ class Group(Node):
   def code(self):
     return self.node.code()
 
+  def children(self):
+    return [self.node]
+
 
 # 이항 연산자: left + operator같은 것들
 class BinaryOperator(Node):
+  __slots__ = ('left', 'right', 'operator')
+  kind = 'binary_operator'
   left: Node
   right: Node
   operator: str
@@ -214,7 +372,6 @@ class BinaryOperator(Node):
     self.left = left
     self.right = right
     self.operator = operator
-    self.kind = 'binary_operator'
 
   def __repr__(self) -> str:
     return f'BinaryOperator({self.left}, "{self.operator}", {self.right})'
@@ -222,9 +379,14 @@ class BinaryOperator(Node):
   def code(self):  # left * right
     return f'({self.left} {self.operator} {self.right})'
 
+  def children(self):
+    return [self.left, self.right]
+
 
 # 단항 연산자: -value 같은 것
 class UnaryOperator(Node):
+  __slots__ = ('value', 'operator')
+  kind = 'unary_operator'
   value: Node
   operator: str
 
@@ -232,7 +394,6 @@ class UnaryOperator(Node):
     super().__init__(tokens)
     self.value = value
     self.operator = operator
-    self.kind = 'unary_operator'
 
   def __repr__(self) -> str:
     return f'UnaryOperator("{self.operator}", {self.value})'
@@ -240,15 +401,19 @@ class UnaryOperator(Node):
   def code(self):  # -123
     return f'({self.operator}{self.value})'
 
+  def children(self):
+    return [self.value]
+
 
 # 숫자 그 자체
 class Number(Node):
+  __slots__ = ('number',)
+  kind = 'number'
   number: float
 
   def __init__(self, tokens, number):
     super().__init__(tokens)
     self.number = number
-    self.kind = 'number'
 
   def __repr__(self) -> str:
     return f'{self.number}'
@@ -259,12 +424,13 @@ class Number(Node):
 
 # 문자: 'x'처럼 변수나 상수가 되는 것들
 class Symbol(Node):
+  __slots__ = ('symbol',)
+  kind = 'symbol'
   symbol: str
 
   def __init__(self, tokens, symbol):
     super().__init__(tokens)
     self.symbol = symbol
-    self.kind = 'symbol'
 
   def __repr__(self) -> str:
     return f'Symbol("{self.symbol}")'
@@ -276,6 +442,8 @@ class Symbol(Node):
 # 함숫값: 함수를 호출한 값을 나타냄
 # 예시: f(x), sin(2 * PI) 등
 class FunctionValue(Node):
+  __slots__ = ('name', 'args')
+  kind = 'function_value'
   name: str  # 함수 이름
   # targetFunction: Function # 함수를 호출할 때 호출하는 곳. sin, cos, tan같은 내장함수의 경우 자동으로 지정됨.
   args: List[Node]  # 인수들. 리스트로 둬서 다변수함수도 구현할 수 있음
@@ -284,7 +452,6 @@ class FunctionValue(Node):
     super().__init__(tokens)
     self.name = name
     self.args = args
-    self.kind = 'function_value'
 
   def __repr__(self) -> str:
     return f'FunctionValue("{self.name}", args={self.args})'
@@ -292,8 +459,13 @@ class FunctionValue(Node):
   def code(self):  # function_name(arg1, arg2, ...)
     return f'{self.name}({", ".join([str(arg) for arg in self.args])})'
 
+  def children(self):
+    return list(self.args)
+
 
 class Definition(Node):
+  __slots__ = ('name', 'target')
+  kind = 'definition'
   name: str
   target: Node
 
@@ -301,7 +473,6 @@ class Definition(Node):
     super().__init__(tokens)
     self.name = name
     self.target = target
-    self.kind = 'definition'
 
   def __repr__(self) -> str:
     return f'Definition(name={self.name}, target={self.target})'
@@ -311,6 +482,8 @@ class Definition(Node):
 
 
 class Contexted(Node):
+  __slots__ = ('contexts', 'node')
+  kind = 'contexted'
   contexts: dict
   node: Node
 
@@ -318,7 +491,6 @@ class Contexted(Node):
     super().__init__(tokens)
     self.contexts = contexts
     self.node = node
-    self.kind = 'contexted'
 
   def __repr__(self) -> str:
     return f'Contexted(contexts={self.contexts}, {self.node})'
@@ -327,6 +499,9 @@ class Contexted(Node):
     # raise Exception('TODO')
     return f'(TODO) {self}'
 
+  def children(self):
+    return [self.node]
+
 
 # %%
 class Context:
@@ -339,9 +514,20 @@ class Function(Context):
   # 계산하는 함수: (interpret 함수(다른 노드를 계산하는데 쓰임), 인수 목록, context) -> 값
   calculate: Callable[[Callable[[Node, dict], float], List[float], dict],
                       float]
-
-  def __init__(self, calculate):
+  # Let f(x, y) = ...으로 정의한 함수라면 인수 이름들(['x', 'y'])과 우변 노드. 내장함수는 None
+  parameters: Optional[List[str]]
+  body: Optional[Node]
+  # compile()이 body를 컴파일한 결과를 담아둠: backend 이름 -> 함수 (처음 호출될 때 만들어짐)
+  compiled: Dict[str, Callable[[dict], float]]
+  # body가 바깥 context에서 찾는 이름들 (freeNamesOf()가 처음 호출될 때 만들어짐)
+  freeNames: Optional[FrozenSet[str]]
+
+  def __init__(self, calculate, parameters=None, body=None):
     self.calculate = calculate
+    self.parameters = parameters
+    self.body = body
+    self.compiled = {}
+    self.freeNames = None
 
   def __repr__(self) -> str:
     return f'Function({self.calculate}'
@@ -349,14 +535,46 @@ class Function(Context):
 
 class SymbolValue(Context):
   value: Callable[[Callable[[Node, dict], float], dict], float]
+  # Let x = ...으로 정의했다면 우변 노드
+  body: Optional[Node]
+  compiled: Dict[str, Callable[[dict], float]]
+  freeNames: Optional[FrozenSet[str]]
 
-  def __init__(self, value):
+  def __init__(self, value, body=None):
     self.value = value
+    self.body = body
+    self.compiled = {}
+    self.freeNames = None
 
   def __repr__(self) -> str:
     return f'SymbolValue({self.value}'
 
 
+# 인수 이름들과 값들을 묶어서 context로 만듦: fromValues(['x', 'y'], [1, 2]) -> {'x': 1, 'y': 2}
+def fromValues(args, values):
+  context = {}
+  for i in range(len(args)):
+    name = args[i]
+    value = values[i]
+    context[name] = value
+  return context
+
+
+# Let f(x, y) = body로 정의한 함수
+def userFunction(names: List[str], body: Node) -> Function:
+
+  def calculate(interpret, args, context):
+    return interpret(body, {**context, **fromValues(names, args)})
+
+  return Function(calculate, parameters=names, body=body)
+
+
+# Let x = body로 정의한 기호
+def userSymbol(body: Node) -> SymbolValue:
+  return SymbolValue(lambda interpret, context: interpret(body, context),
+                     body=body)
+
+
 # %% [markdown]
 # ### 파서
 
@@ -370,25 +588,30 @@ class SymbolValue(Context):
   이게 골때림. 개발하는데 힘들었어요 ㅠㅠ
 - 오류 알려주기. 지금은 이게 잘 구현돼있지 않은데, 잘못된 수식을 보면 알려줘야 한다.
 
-따라서 이 함수는
-1.  괄호를 인식함
+처음에는 연산자 우선순위마다 토큰 전체를 한 번씩 다시 훑었는데 (우선순위 종류 x 토큰 개수만큼 일함),
+항이 수천 개인 긴 수식에서는 너무 느려서 '우선순위 등반(precedence climbing)' 방식으로 바꿨음.
+이제는 토큰을 앞에서부터 딱 한 번만 읽으면서 트리를 만듦.
+
+expression(최소 우선순위)는
+1.  피연산자 하나를 읽음 (숫자, 문자, 함수 호출, 괄호, 단항 연산자, Let)
     괄호를 본다면 급발작 스위치가 발동해서 괄호 부분을 먼저 파싱함
-2.  사용된 연산자들을 우선순위별로 분류함
-3.  우선순위가 높은 연산자부터 계산함
+2.  다음 토큰이 '최소 우선순위' 이상인 연산자라면
+    그 연산자보다 우선순위가 '높은' 것들만 오른쪽 피연산자로 읽고 (expression(우선순위 + 1))
+    지금까지 묶은 왼쪽과 묶은 다음 2번을 반복
+3.  아니라면 (우선순위가 낮은 연산자, 괄호 닫기, 쉼표, 끝) 지금까지 묶은 걸 돌려줌
 
 대략적인 작동방법을 보자면,
 코드:          1  +  2  *  (  3  +  4  *  5  )  +  6
-(괄호 먼저 계산)                                                    
-연산자 우선순위:                   2     1             <- 리스트에 현재 담겨있는 내용
-- 우선순위 = 1:                      A  A  A          (A = 4 * 5)
-- 우선순위 = 2:                B  B  B  B  B          (B = 3 + A)
-(괄호 밖)
-연산자 우선순위:    2     1  B  B  B  B  B  B  B  2   
-- 우선순위 = 1:    2  C  C  C  C  C  C  C  C  C  2    (C = 2 * B)
-- 우선순위 = 2:    D  D  D  D  D  D  D  D  D  D  2    (D = 1 + C) <- 1페이즈
-- 우선순위 = 2:    E  E  E  E  E  E  E  E  E  E  E  E (E = D + 6) <- 2페이즈
+- 1을 읽음
+- + (50): 오른쪽은 51 이상인 연산자만 → 2 * (...)까지 읽음 (*는 80이라 포함, +는 50이라 멈춤)
+  - 괄호 안: 3 + (4 * 5)                                     (B = 3 + A, A = 4 * 5)
+  - C = 2 * B
+  → D = 1 + C
+- + (50): 오른쪽 6 → E = D + 6
 완성된 AST: E = [{1 + (2 * {3 + (4 * 5)})} + 6]
 
+우선순위가 같다면 앞부터 묶이니까 (우선순위 + 1 이상만 오른쪽으로 가져감) 예전과 같은 모양의 트리가 나옴.
+
 
 tokens: 전체 토큰들
 start: .. 중에서 시작 위치,
@@ -396,349 +619,1121 @@ end: 끝 위치
 '''
 
 
-def parseToAst(tokens: List[Token], nodes, start: int, end: int) -> Node:
-  if start == end:
-    raise Exception(f'Unknown index: {start} to {end}')
+class Parser:
+  tokens: List[Token]
+  # 지금 읽고 있는 토큰의 위치
+  index: int
+  end: int
 
-  # 범위 내에서 첫번째 토큰이
-  firstToken = tokens[start]
-
-  def parseText(index, ahead):
-    s = index
-    text = tokens[index]
-    # 뒤에 괄호가 오면 함수 호출
-    if text.code == 'Let':
-      # 지금 지원하는 형태: Let f(x) = 3x + 5, ...
-      equation = parseToAst(tokens, nodes, start + 1, end)
-      assert isinstance(
-          equation, BinaryOperator
-      ), f'Let 이후 따라오는 값이 f(x) = ...와 같은 등식의 형태가 아닙니다. 받은 수식: {equation}'
-      assert equation.operator == '='
-
-      left = equation.left
-
-      if isinstance(left, FunctionValue):
-        name = left.name
-
-        # Let f(3 * x) = 5 * x 같은 형태는 아직 지원하지 않음, 즉 args는 각각 Symbol이여야 함
-        names = []
-        for node in left.args:
-          assert isinstance(
-              node, Symbol
-          ), '현재 함수를 정의할 때의 인수는 단순한 기호만 지원합니다. 즉, f(x, y, z)의 형태는 지원하지만 f(3 * x, 5 - y)와 같은 형태는 지원하지 않습니다.'
-          names.append(node.symbol)
-
-        def fromValues(args, values):
-          context = {}
-          for i in range(len(args)):
-            name = args[i]
-            value = values[i]
-            context[name] = value
-          return context
-
-        defined = Function(
-            lambda interpret, args, context: interpret(equation.right, {
-                **context,
-                **fromValues(names, args)
-            }))
-
-      elif isinstance(left, Symbol):
-        name = left.symbol
-        defined = SymbolValue(
-            lambda interpret, context: interpret(equation.right, context))
+  def __init__(self, tokens: List[Token], start: int, end: int):
+    self.tokens = tokens
+    self.index = start
+    self.end = end
 
-      else:
-        raise Exception(
-            f'지원되지 않는 정의 형식입니다. 현재는 f(x) = ...과 x = ...처럼 좌변에 함수나 문자 그 자체만 올 수 있습니다.'
-        )
-
-      # `count=1 + len(equation.tokens)`: 1를 더하는 이유는 ','/'.'(terminator)를 건너뜀
-      localEnd = index + 1 + len(equation.tokens)
-
-      if end != localEnd:
-        # 이 경우: Let f(x) = 3, f(5)처럼 Definition이 context로 작용해야 할 경우
-        if tokens[localEnd].kind == 'terminator':
-          node = parseToAst(tokens, nodes, localEnd + 1, end)
-          if isinstance(node, Contexted):
-            merged = Contexted(tokens=TokenReference.ofEnd(allTokens=tokens,
-                                                           start=index,
-                                                           end=localEnd + 1 +
-                                                           len(node.tokens)),
-                               contexts={
-                                   **node.contexts, name: defined
-                               },
-                               node=node.node)
-            return merged
+  # index번째 토큰의 종류/글자/우선순위.
+  # 토큰을 Token 객체 목록이 아닌 다른 모양으로 들고 있다면 (TokenBuffer 등) 이것들만 바꾸면 됨
+  def kindAt(self, index: int) -> str:
+    return self.tokens[index].kind
+
+  def codeAt(self, index: int) -> str:
+    return self.tokens[index].code
+
+  def precedenceAt(self, index: int) -> int:
+    return self.tokens[index].precedence
+
+  # 다음 토큰의 종류 (끝까지 다 읽었으면 None)
+  def peek(self) -> Optional[str]:
+    if self.index < self.end:
+      return self.kindAt(self.index)
+    return None
+
+  # start부터 지금 위치 직전까지의 토큰들
+  def reference(self, start: int):
+    return TokenReference.ofEnd(allTokens=self.tokens,
+                                start=start,
+                                end=self.index)
+
+  # 원래는 expression -> operand -> expression ...처럼 괄호, 단항 연산자, 함수 인수, Let마다 재귀했는데
+  # ((((...))))처럼 수천 겹만 돼도 파이썬 재귀 한도에 걸려서, 재귀 대신 '아직 덜 끝난 일'들을 stack에 쌓아둠.
+  # 하는 일과 순서는 재귀 버전과 똑같고, 함수를 다시 부르는 대신
+  #   (가) 새 expression(최소 우선순위)를 시작할 때: stack에 expression 칸을 쌓고 피연산자를 읽음.
+  #       괄호/단항 연산자/함수 호출/Let처럼 안쪽 수식을 먼저 읽어야 하면 그 칸도 쌓고 다시 (가)로
+  #   (나) 노드 하나가 완성됐을 때: 맨 위 칸을 보고 이어서 할 일을 함
+  #       (연산자 오른쪽이었다면 BinaryOperator로 묶기, 괄호 닫기 확인, 다음 인수 읽기 등).
+  #       칸이 끝났으면 빼고 완성된 노드를 그 아래 칸에 넘김
+  # 칸 하나는 리스트 하나라서 겹이 10^6개여도 파이썬 함수 호출 프레임보다 메모리를 적게 씀.
+  #
+  # stack의 칸들:
+  #   ['expression', 시작 위치, 최소 우선순위, 왼쪽 노드, 오른쪽을 기다리는 연산자 위치(없으면 None), 왼쪽 노드의 깊이]
+  #   ['group', 시작 위치]
+  #   ['unary', 시작 위치]
+  #   ['call', 시작 위치, 함수 이름, 지금까지 읽은 인수들, 가장 깊은 인수의 깊이]
+  #   ['let', 시작 위치, 지금 정의의 시작 위치, 지금까지 읽은 (이름, 정의)들, 마지막 수식을 읽는 중인지]
+  #
+  # 완성한 노드마다 깊이(node.depth)도 적어둠. 연산자 사슬은 stack 한 칸에서 묶으니까 stack 높이는 깊이가 아님.
+  # 계산하는 쪽은 이걸 보고 재귀로 계산할지 evaluateDeep()로 계산할지 미리 고름
+  def expression(self, minPrecedence: int = 0) -> Node:
+    stack = []
+
+    while True:
+      # (가) 새 수식 시작: 피연산자 하나를 읽음
+      start = self.index
+      stack.append(['expression', start, minPrecedence, None, None, 0])
+      kind = self.peek()
+      if kind is None:
+        raise Exception(f'Unknown index: {self.index} to {self.end}')
+
+      if kind == 'group':  # 괄호 열기: 괄호 안부터 읽음
+        self.index += 1
+        stack.append(['group', start])
+        minPrecedence = 0
+        continue
+
+      if kind == 'operator':  # 연산자: 피연산자 자리에 이게 오면 단항 연산자임
+        code = self.codeAt(start)
+        if code not in tUnaryOperators:  # * 3, 2 * / 3 같은 것
+          raise Exception(f'{code}는 피연산자 앞에 올 수 없어요: {start}번째 토큰')
+        self.index += 1
+        stack.append(['unary', start])
+        # -3 + 2는 (-3) + 2처럼, 그 연산자보다 우선순위가 높은 것까지만 묶음
+        minPrecedence = max(self.precedenceAt(start) + 1, minPrecedence)
+        continue
+
+      if kind == 'number':  # 숫자
+        self.index += 1
+        node = Number(self.reference(start), float(self.codeAt(start)))
+
+      elif kind == 'text':  # 글자
+        code = self.codeAt(start)
+        if code == 'Let':  # Let f(x) = ..., Let y = ..., 수식
+          self.index += 1  # 'Let'을 건너뜀
+          stack.append(['let', start, start, [], False])
+          minPrecedence = 0
+          continue
 
+        # 뒤에 괄호가 오면 함수 호출: 이름(인수1, 인수2, ...)
+        if start + 1 < self.end and self.kindAt(start + 1) == 'group':
+          self.index += 2  # 괄호 안부터 시작: 함수 이름, 괄호, 괄호 안(여기부터)
+          if self.peek() == 'group_close':  # f()
+            self.index += 1
+            node = FunctionValue(self.reference(start), name=code, args=[])
           else:
-            return Contexted(tokens=TokenReference.ofEnd(allTokens=tokens,
-                                                         start=index,
-                                                         end=localEnd + 1 +
-                                                         len(node.tokens)),
-                             contexts={name: defined},
-                             node=node)
+            stack.append(['call', start, code, [], 0])
+            minPrecedence = 0
+            continue
 
-        else:
-          raise Exception(
-              f'바른 수식이 아닙니다. Let f(x) = 3 * x처럼 입력한 후에는 온점(.)이나 쉼표(,)로 구분해줘야 합니다.'
-          )
+        else:  # 뒤에 괄호가 오지 않음. 단순한 변수/상수
+          self.index += 1
+          node = Symbol(self.reference(start), symbol=code)
 
       else:
-        # 이 경우: 정의 그 자체
-        return Definition(tokens=TokenReference.ofEnd(allTokens=tokens,
-                                                      start=index,
-                                                      end=localEnd),
-                          name=name,
-                          target=defined)
-
-    elif (not ahead) and index + 1 < end and tokens[index + 1].kind == 'group':
-      # 함수 호출
-
-      index += 2  # 괄호 안부터 시작: 함수 이름(index번째 토큰), 괄호, 괄호 안(index + 2번째: 여기부터)
-
-      # 인수들을 각자 파싱함
-      args = []
-      while index < end:
-        arg = parseToAst(tokens, nodes, index, end)
-        args.append(arg)
-        index += len(arg.tokens)
-
-        if tokens[index].code == ',':  # ,로 끝남
-          index += 1
-          continue
-        else:  # )로 끝남
-          index += 1
-          break
+        raise Exception(f'Malformed token: unknown token kind {kind}')
+
+      depth = 1
+      node.depth = depth
+
+      # (나) node가 완성됨: 쌓여있는 일을 이어서 함
+      while True:
+        frame = stack[-1]
+        what = frame[0]
+
+        if what == 'expression':
+          if frame[4] is not None:  # 연산자의 오른쪽을 다 읽었으면 왼쪽과 묶음
+            node = BinaryOperator(tokens=self.reference(frame[1]),
+                                  left=frame[3],
+                                  right=node,
+                                  operator=self.codeAt(frame[4]))
+            if frame[5] > depth:
+              depth = frame[5]
+            depth += 1
+            node.depth = depth
+          # 다음이 최소 우선순위 이상인 연산자라면
+          # 그 연산자보다 우선순위가 '높은' 것들만 오른쪽 피연산자로 읽음
+          if self.peek() == 'operator':
+            precedence = self.precedenceAt(self.index)
+            if precedence >= frame[2]:
+              frame[3] = node
+              frame[5] = depth
+              frame[4] = self.index
+              self.index += 1
+              minPrecedence = precedence + 1
+              break
+          stack.pop()
+          if not stack:
+            return node
+
+        elif what == 'group':
+          if self.peek() != 'group_close':
+            raise Exception(f'괄호가 닫히지 않았어요: {frame[1]}번째 토큰부터')
+          self.index += 1
+          node = Group(self.reference(frame[1]), node)
+          depth += 1
+          node.depth = depth
+          stack.pop()
+
+        elif what == 'unary':
+          node = UnaryOperator(self.reference(frame[1]), node,
+                               self.codeAt(frame[1]))
+          depth += 1
+          node.depth = depth
+          stack.pop()
+
+        elif what == 'call':
+          frame[3].append(node)
+          if depth > frame[4]:
+            frame[4] = depth
+          kind = self.peek()
+          if kind is None:
+            raise Exception(f'괄호가 닫히지 않았어요: {frame[1]}번째 토큰부터')
+          code = self.codeAt(self.index)
+          self.index += 1
+          if code == ',':  # ,로 끝남: 다음 인수를 읽음
+            minPrecedence = 0
+            break
+          elif kind == 'group_close':  # )로 끝남
+            node = FunctionValue(self.reference(frame[1]),
+                                 name=frame[2],
+                                 args=frame[3])
+            depth = frame[4] + 1
+            node.depth = depth
+            stack.pop()
+          else:
+            raise Exception(
+                f'함수 인수 뒤에는 쉼표(,)나 괄호 닫기가 와야 해요: {code}')
+
+        else:  # 'let'
+          # Let이 수천 개 이어져도 정의들을 차례로 읽어서 Contexted 하나에 모음.
+          # (예전에는 Let마다 나머지를 다시 파싱하고 {**node.contexts, name: defined}로 dict를 통째로 복사해서
+          #  정의 개수의 제곱만큼 느려졌음)
+          definitions = frame[3]
+          if not frame[4]:  # 등식 하나를 다 읽음
+            name, defined = self.definition(node)
+
+            kind = self.peek()
+            if kind is None:
+              # 이 경우: 정의 그 자체
+              node = Definition(tokens=self.reference(frame[2]),
+                                name=name,
+                                target=defined)
+              depth = 1
+              node.depth = depth
+            else:
+              if kind != 'terminator':
+                raise Exception(
+                    f'바른 수식이 아닙니다. Let f(x) = 3 * x처럼 입력한 후에는 온점(.)이나 쉼표(,)로 구분해줘야 합니다.'
+                )
+
+              # 이 경우: Let f(x) = 3, f(5)처럼 Definition이 context로 작용해야 할 경우
+              definitions.append((name, defined))
+              self.index += 1  # ','/'.'(terminator)를 건너뜀
+
+              # 다음도 Let이면 같은 블록에 이어서 모음. 아니면 마지막 수식을 읽음
+              frame[2] = self.index
+              if self.peek() == 'text' and self.codeAt(self.index) == 'Let':
+                self.index += 1
+              else:
+                frame[4] = True
+              minPrecedence = 0
+              break
+
+          stack.pop()
+          if definitions:
+            # 같은 이름을 여러 번 정의하면 앞의 것이 이김. 뒤에서부터 넣으면 앞의 것이 마지막에 덮어씀
+            contexts = {}
+            for name, defined in reversed(definitions):
+              contexts[name] = defined
+            node = Contexted(tokens=self.reference(frame[1]),
+                             contexts=contexts,
+                             node=node)
+            depth += 1
+            node.depth = depth
 
-      return FunctionValue(TokenReference.ofEnd(allTokens=tokens,
-                                                start=s,
-                                                end=index),
-                           name=text.code,
-                           args=args)
-
-    else:  # 뒤에 괄호가 오지 않음. 단순한 변수/상수
-      if ahead:
-        return None
-
-      return Symbol(TokenReference.ofCount(allTokens=tokens, start=s, count=1),
-                    symbol=text.code)
-
-  kind = firstToken.kind
-  if kind == 'group':  # 괄호 열기
-    node = parseToAst(tokens, nodes, start + 1, end)
-    return Group(
-        TokenReference.ofCount(allTokens=tokens,
-                               start=start,
-                               count=len(node.tokens) + 2), node)
-
-  if kind == 'operator':  # 연산자: 처음부터 이게 오면 단항 연산자임
-    value = parseToAst(tokens, nodes, start + 1, end)
-    return UnaryOperator(
-        TokenReference.ofCount(allTokens=tokens,
-                               start=start,
-                               count=len(value.tokens) + 1), value)
-
-  if kind == 'text':  # 글자
-    result = parseText(start, ahead=True)
-    if result != None:
-      return result
+  # Let 하나의 등식(f(x) = ...)에서 (이름, 정의)를 꺼냄
+  def definition(self, equation: Node) -> Tuple[str, Context]:
+    # 지금 지원하는 형태: Let f(x) = 3x + 5, ...
+    assert isinstance(
+        equation, BinaryOperator
+    ), f'Let 이후 따라오는 값이 f(x) = ...와 같은 등식의 형태가 아닙니다. 받은 수식: {equation}'
+    assert equation.operator == '='
 
-  if kind == 'number' or kind == 'text':  # 숫자/문자. 숫자나 문자가 처음에 오면 그냥 숫자가 끝일 수도 있지만 1 * 3 같은 식에서도 1이 맨 앞에 옴
-    # 따라서 뒤에 뭐가 따라오는지 확인해야 함
-
-    # 1. Check operator precedences
-    #   sort operators by precedence: create list -> put operator precedences in it
-    # 2. Parse expression
-    #   execute the operator with high precedence first, top-down
-    # 3. Return result
-
-    # 1. 연산자들의 우선순위 확인
-    # 노드/우선순위들을 임시로 담아두는 리스트
-    # nodes = [None] * nodesCount # elements: int = precedence, Node = parsed node
-    # 우선순위들을 모아놓은 집합
-    allPrecedences = set()
-
-    # 범위 안의 토큰들을 조사함
-    index = start
-    while index < end:
-      current = tokens[index]
-
-      curKind = current.kind
-
-      # In case of group
-      if curKind == 'group':  # 말했다시피 괄호를 보면 바로 발작함
-        # 괄호 안의 내용물을 파싱함
-        groupValue = parseToAst(tokens, nodes, index, end)
-
-        # 위 작동방법에서 그룹 전체를 'B'로 채우는 것과 같은 과정
-        for ii in range(index, index + len(groupValue.tokens)):
-          nodes[ii] = groupValue
-        index += len(groupValue.tokens)  # 그룹 + 그 안의 총 토큰 개수만큼 이동
-
-      elif curKind == 'group_close':  # 괄호닫기. 바로 위에서 그룹을 파싱할 때 이게 호출될 때까지 반복함
-        break  # while문에서 빠져나오기
-
-      elif curKind == 'text':
-        node = parseText(index, ahead=False)
-
-        # 위 작동방법에서 그룹 전체를 'B'로 채우는 것과 같은 과정
-        for ii in range(index, index + len(node.tokens)):
-          nodes[ii] = node
-        index += len(node.tokens)  # 그룹 + 그 안의 총 토큰 개수만큼 이동
-
-      elif curKind == 'operator':  # 연산자. nodes에 우선순위를 담아둠
-        precedence = current.precedence
-        nodes[index] = precedence
-        allPrecedences.add(precedence)
-        index += 1
-
-      elif curKind == 'number':  # 숫자. 숫자 노드를 nodes에 담아둠
-        nodes[index] = Number(
-            TokenReference.ofCount(allTokens=tokens, start=index, count=1),
-            float(current.code))
-        index += 1
-
-      elif curKind == 'terminator':  # 이 루프를 멈추러 왔다
-        break
+    left = equation.left
 
-      else:
-        index += 1
+    if isinstance(left, FunctionValue):
+      name = left.name
 
-    limit = index
+      # Let f(3 * x) = 5 * x 같은 형태는 아직 지원하지 않음, 즉 args는 각각 Symbol이여야 함
+      names = []
+      for node in left.args:
+        assert isinstance(
+            node, Symbol
+        ), '현재 함수를 정의할 때의 인수는 단순한 기호만 지원합니다. 즉, f(x, y, z)의 형태는 지원하지만 f(3 * x, 5 - y)와 같은 형태는 지원하지 않습니다.'
+        names.append(node.symbol)
 
-    # 2. Parse expression
-    #   execute the operator with high precedence first sequentially
-    # TODO: is there a way to optimize? This produces high complexity
+      return name, userFunction(names, equation.right)
 
-    # 높은 우선순위부터 차례대로 실행
-    for precedence in sorted(allPrecedences,
-                             reverse=True):  # from high to low precedence
-      index = start
+    elif isinstance(left, Symbol):
+      return left.symbol, userSymbol(equation.right)
 
-      # 순차적으로 실행
-      while index < limit:
-        node = nodes[index]
+    else:
+      raise Exception(
+          f'지원되지 않는 정의 형식입니다. 현재는 f(x) = ...과 x = ...처럼 좌변에 함수나 문자 그 자체만 올 수 있습니다.'
+      )
 
 
-        if type(node) == int:
-          # 지금 찾는 우선순위와 같은 우선순위 발견!
-          if node == precedence:
-            operator = tokens[index].code
+# TokenBuffer 위에서 도는 파서: 토큰 객체 없이 배열에서 바로 읽음
+class TokenBufferParser(Parser):
 
-            # 왼쪽 값
-            left = nodes[index - 1]
-            # 오른쪽 값
-            right = nodes[index + 1]
+  def kindAt(self, index: int) -> str:
+    return tKinds[self.tokens.kinds[index]]
 
-            # 위 '작동방식'에서 본 것처럼 A A A 같은 식으로 다 채워줌
-            localStart = index - len(left.tokens)
-            localEnd = index + len(right.tokens) + 1
-            operator = BinaryOperator(tokens=TokenReference.ofEnd(
-                allTokens=tokens, start=localStart, end=localEnd),
-                                      left=left,
-                                      right=right,
-                                      operator=operator)
-            
+  def codeAt(self, index: int) -> str:
+    return self.tokens.codeAt(index)
 
-            for indexToSet in range(localStart, localEnd):
-              nodes[indexToSet] = operator
+  def precedenceAt(self, index: int) -> int:
+    return self.tokens.precedences[index]
 
-            index = localEnd
-          else:
-            index += 1
-        else:
-          # 노드를 만나면
-          index += 1  # 그냥 계속해서 감
 
-    return nodes[start]
+# tokens: Token 목록이나 TokenBuffer
+def parseToAst(tokens: Union[List[Token], 'TokenBuffer'], start: int,
+               end: int) -> Node:
+  if start == end:
+    raise Exception(f'Unknown index: {start} to {end}')
 
-  else:
-    raise Exception(f'Malformed token: unknown token kind {firstToken.kind}')
+  if isinstance(tokens, TokenBuffer):
+    return TokenBufferParser(tokens, start, end).expression()
+  return Parser(tokens, start, end).expression()
 
 
 # %%
 def parseMathToAst(code: str):
-  tokenizer = Tokenizer(code)
-  tokens = []
+  tokens = tokenize(code)
+  return parseToAst(tokens=tokens, start=0, end=len(tokens))
+
+
+# 아주 긴 수식용: Token 객체 대신 TokenBuffer에 토큰을 담아서 파싱함
+def parseLargeMathToAst(code: str):
+  tokens = TokenBuffer.fromCode(code)
+  return parseToAst(tokens=tokens, start=0, end=len(tokens))
+
+
+# node의 깊이 (node.depth). 파서가 만들지 않은 노드(optimize(), 스냅샷 등)는 처음 물어볼 때 반복문으로 세서 적어둠.
+# 얼린 노드에도 적을 수 있게 object.__setattr__로 적음 (깊이는 모양에서 정해지는 값이라 같이 써도 됨)
+def nestingDepth(node: Node) -> int:
+  try:
+    return node.depth
+  except AttributeError:
+    pass
+
+  stack = [(node, False)]
+  while stack:
+    current, counted = stack.pop()
+    children = current.children()
+    if counted:  # 자식들을 다 셌음
+      depth = 0
+      for child in children:
+        if child.depth > depth:
+          depth = child.depth
+      object.__setattr__(current, 'depth', depth + 1)
+    elif not hasattr(current, 'depth'):
+      stack.append((current, True))
+      stack.extend((child, False) for child in children)
+  return node.depth
 
-  while not tokenizer.eof():
-    tokens.append(tokenizer.advance())
 
-  return parseToAst(tokens=tokens,
-                    nodes=[None] * len(tokens),
-                    start=0,
-                    end=len(tokens))
+# %% [markdown]
+# ### 파싱 결과 캐시
+
+# %%
+# 얼린 노드의 클래스: 원래 클래스를 상속하니까 isinstance는 그대로 되고, 속성을 바꾸려 하면 오류가 남.
+# (Node에 바로 __setattr__를 두면 파싱할 때 노드를 만들 때마다 느려져서, 얼릴 때만 클래스를 바꿔치기함)
+class FrozenNode:
+  __slots__ = ()
+  frozen = True
+
+  def __setattr__(self, name, value):
+    raise AttributeError(f'얼려둔 노드는 바꿀 수 없어요: {self}의 {name}')
+
+  def __delattr__(self, name):
+    raise AttributeError(f'얼려둔 노드는 바꿀 수 없어요: {self}의 {name}')
+
+
+frozenClasses = {}  # 원래 클래스 -> 얼린 클래스
+
+
+def frozenClassOf(cls):
+  if cls not in frozenClasses:
+    frozenClasses[cls] = type(cls.__name__, (FrozenNode, cls),
+                              {'__slots__': ()})
+  return frozenClasses[cls]
+
+
+# 노드 트리 전체를 얼림: 이후로는 속성을 바꾸려 하면 AttributeError가 남.
+# 인수 목록은 tuple로, Let 정의들은 읽기 전용 dict로 바꾸고 Let으로 정의한 함수의 우변까지 얼림
+def freeze(node: Node) -> Node:
+  stack = [node]
+  while stack:
+    current = stack.pop()
+    if current.frozen:
+      continue
+
+    if isinstance(current, FunctionValue):
+      current.args = tuple(current.args)
+    elif isinstance(current, Contexted):
+      current.contexts = MappingProxyType(dict(current.contexts))
+      for value in current.contexts.values():
+        if value.body is not None:
+          stack.append(value.body)
+    elif isinstance(current, Definition):
+      if current.target.body is not None:
+        stack.append(current.target.body)
+
+    stack.extend(current.children())
+    object.__setattr__(current, '__class__', frozenClassOf(type(current)))
+
+  return node
+
+
+# 공백은 토큰을 나누는 역할만 하니까 '1+2'와 '1 +  2'는 같은 수식임.
+# 다만 'a b'와 'ab'는 다르기 때문에 공백을 없애지는 않고 한 칸으로만 줄임
+def normalizeCode(code: str) -> str:
+  return ' '.join(code.split())
+
+
+# 같은 수식을 계속 다시 파싱하지 않도록 최근에 파싱한 결과를 maxSize개까지 담아둠.
+# 꽉 차면 가장 오래 안 쓴 것부터 버림 (LRU).
+# 여러 스레드에서 같이 써도 되고, 돌려주는 노드는 여러 곳에서 같이 쓰니까 얼려서(freeze) 줌.
+class ParseCache:
+  maxSize: int
+  hits: int
+  misses: int
+  evictions: int
+
+  def __init__(self, maxSize: int = 4096):
+    self.maxSize = maxSize
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.entries = OrderedDict()  # 정규화된 수식 -> 노드
+    self.lock = threading.Lock()
+
+  def parse(self, code: str) -> Node:
+    key = normalizeCode(code)
+
+    with self.lock:
+      node = self.entries.get(key)
+      if node is not None:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return node
+      self.misses += 1
+
+    # 파싱은 시간이 걸리니까 lock 밖에서 함. 다른 스레드가 같은 수식을 동시에 파싱해도 결과는 같음
+    node = freeze(parseMathToAst(key))
+
+    with self.lock:
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        return self.entries[key]
+      self.entries[key] = node
+      self.evict()
+    return node
+
+  # 크기 제한을 넘은 만큼 오래된 것부터 버림 (lock을 잡은 상태에서 호출해야 함)
+  def evict(self):
+    while len(self.entries) > max(self.maxSize, 0):
+      self.entries.popitem(last=False)
+      self.evictions += 1
+
+  def resize(self, maxSize: int):
+    with self.lock:
+      self.maxSize = maxSize
+      self.evict()
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+
+  def stats(self) -> dict:
+    with self.lock:
+      return {
+          'size': len(self.entries),
+          'maxSize': self.maxSize,
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions
+      }
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __repr__(self) -> str:
+    return f'ParseCache({self.stats()})'
+
+
+# 기본으로 쓰는 캐시
+parseCache = ParseCache()
+
+
+def parseMathToAstCached(code: str) -> Node:
+  return parseCache.parse(code)
+
+
+# %% [markdown]
+# ### 고치면서 다시 파싱하기
+
+# %%
+# 긴 수식을 한 글자씩 고칠 때마다 tokenize()와 parseToAst()를 처음부터 다시 하면 매번 수식 길이만큼 일함.
+# IncrementalParser는 지난번 토큰들과 트리를 들고 있다가, 고친 곳 근처만 다시 토큰으로 나누고
+# 바뀐 토큰들을 감싸는 가장 작은 부분 트리만 다시 파싱해서 원래 트리에 끼워 넣음.
+#
+# 다시 토큰으로 나누기: 고친 곳에 닿는 토큰부터 다시 읽다가, 고친 곳을 지나서 예전 토큰의 시작 위치와 딱 맞으면 멈춤.
+#   토큰 하나는 그 자리부터의 글자만 보고 정해지니까, 거기서부터는 예전 토큰들과 똑같음
+# 다시 파싱하기: 바뀐 토큰들을 감싸는 노드 중 가장 안쪽 것부터, 그 노드 자리의 토큰들만 다시 파싱해봄.
+#   - 괄호 안, 함수 인수, Let 뒤의 수식처럼 '수식 하나'가 통째로 들어가는 자리이거나
+#   - 숫자, 기호, 괄호, 함수 호출처럼 앞뒤 연산자와 상관없이 딱 잘리는 노드가 또 그런 노드로 바뀌었다면
+#   그 자리에 그대로 끼워 넣어도 처음부터 파싱한 것과 같은 트리가 됨. 아니라면 한 단계 위의 노드로 올라가서 다시 해봄.
+#   맨 위까지 올라가면 전체를 다시 파싱함 (수식 맨 끝에 연산자를 붙일 때, Let 정의의 우변을 고칠 때 등)
+#
+# 노드의 start, end는 그 노드의 allTokens 안에서의 위치라서, 고친 곳과 상관없는 노드들은 예전 토큰 목록을
+# 그대로 가리키게 두고 (다 고치면 결국 수식 길이만큼 일해야 하니까) 고친 곳을 감싸는 조상 노드들만 새 토큰 목록으로 옮김.
+# 그래서 노드의 '지금 위치'는 루트에서부터 자식들의 토큰 개수를 더해가며 구함 (childPositions)
+#
+# parser = IncrementalParser('sin(x) * 2 + 3')
+# parser.edit(13, 14, '30')  # 'sin(x) * 2 + 30'으로 고치고 새 트리를 돌려줌
+
+
+# code[start:]를 토큰으로 나누면서 (토큰, 시작 위치, 끝 위치)를 하나씩 돌려줌
+def scanTokens(code: str, start: int = 0):
+  for match in scanPattern.finditer(code, start):
+    kind = match.lastgroup
+    if kind == 'error':
+      raise Exception(
+          f'Malformed expression: {match.group(kind)} at {match.start(kind)}')
+    text = match.group(kind)
+    token = fixedTokens.get(text)
+    if token is None:
+      token = Token(kind=kind, code=text, precedence=tKindPrecedences[kind])
+    yield token, match.start(kind), match.end(kind)
+
+
+def tokenCount(node: Node) -> int:
+  return node.end - node.start
+
+
+# 자식 노드들과 그 자식이 지금 토큰 목록에서 시작하는 위치, 부모에서의 자리(속성 이름이나 args의 번호)
+# start는 node가 지금 토큰 목록에서 시작하는 위치
+def childPositions(node: Node, start: int):
+  if isinstance(node, BinaryOperator):  # 왼쪽 연산자 오른쪽
+    yield node.left, start, 'left'
+    yield node.right, start + tokenCount(node.left) + 1, 'right'
+  elif isinstance(node, UnaryOperator):  # 연산자 값
+    yield node.value, start + 1, 'value'
+  elif isinstance(node, Group):  # ( 수식 )
+    yield node.node, start + 1, 'node'
+  elif isinstance(node, FunctionValue):  # 이름 ( 인수 , 인수 )
+    position = start + 2
+    for index, arg in enumerate(node.args):
+      yield arg, position, index
+      position += tokenCount(arg) + 1
+  elif isinstance(node, Contexted):  # Let ... , 수식 (수식이 맨 끝)
+    yield node.node, start + tokenCount(node) - tokenCount(node.node), 'node'
+
+
+def containsDefinition(node: Node) -> bool:
+  stack = [node]
+  while stack:
+    current = stack.pop()
+    if isinstance(current, Definition):
+      return True
+    if isinstance(current, Contexted):
+      for value in current.contexts.values():
+        if value.body is not None:
+          stack.append(value.body)
+    stack.extend(current.children())
+  return False
+
+
+# 앞뒤 연산자와 상관없이 딱 잘리는 노드들
+closedNodeTypes = (Number, Symbol, Group, FunctionValue)
+
+
+class IncrementalParser:
+  code: str
+  tokens: Optional[List[Token]]  # 지금 수식의 토큰들 (토큰으로 나눌 수 없는 수식이면 None)
+  starts: List[int]  # 토큰마다 code에서의 시작 위치
+  ends: List[int]
+  node: Optional[Node]  # 지금 수식의 트리 (파싱할 수 없는 수식이면 None)
+  edits: int
+  partialParses: int  # 부분 트리만 다시 파싱한 횟수
+  fullParses: int
+  relexedTokens: int  # 다시 읽은 토큰 개수
+  reparsedTokens: int  # 다시 파싱한 토큰 개수
+
+  # 노드들이 가리키는 예전 토큰 목록이 쌓이지 않게, 이만큼 고칠 때마다 모든 노드를 지금 토큰 목록으로 옮김
+  rebaseEvery = 64
+
+  def __init__(self, code: str):
+    self.edits = 0
+    self.partialParses = 0
+    self.fullParses = 0
+    self.relexedTokens = 0
+    self.reparsedTokens = 0
+    self.reset(code)
+
+  # 처음부터 다시 토큰으로 나누고 파싱함
+  def reset(self, code: str) -> Node:
+    self.code = code
+    self.tokens = None
+    self.node = None
+
+    tokens, starts, ends = [], [], []
+    for token, start, end in scanTokens(code):
+      tokens.append(token)
+      starts.append(start)
+      ends.append(end)
+    self.tokens, self.starts, self.ends = tokens, starts, ends
+    self.relexedTokens += len(tokens)
+    return self.parseAll()
+
+  def parseAll(self) -> Node:
+    self.node = None
+    self.fullParses += 1
+    self.reparsedTokens += len(self.tokens)
+    self.sinceRebase = 0
+    self.node = parseToAst(self.tokens, 0, len(self.tokens))
+    return self.node
+
+  # code[start:end]를 text로 바꾸고 새 트리를 돌려줌
+  def edit(self, start: int, end: int, text: str) -> Node:
+    if not 0 <= start <= end <= len(self.code):
+      raise Exception(f'고칠 범위가 수식 밖이에요: {start} ~ {end} (수식 길이 {len(self.code)})')
+    code = self.code[:start] + text + self.code[end:]
+    self.edits += 1
+    if self.tokens is None:
+      return self.reset(code)
+    self.code = code
+
+    tokens, starts, ends = self.tokens, self.starts, self.ends
+    delta = len(text) - (end - start)
+    editEnd = start + len(text)
+
+    # 고친 곳에 닿는 첫 토큰부터 다시 읽음 (바로 붙어 있는 토큰은 새 글자와 합쳐질 수 있음)
+    first = bisect.bisect_left(ends, start)
+    position = min(starts[first], start) if first < len(tokens) else start
+    last = len(tokens)  # 예전 토큰들 중 이 앞까지가 바뀜
+    lexed, lexedStarts, lexedEnds = [], [], []
+    try:
+      for token, tokenStart, tokenEnd in scanTokens(code, position):
+        if tokenStart >= editEnd:
+          old = bisect.bisect_left(starts, tokenStart - delta, first)
+          if old < len(tokens) and starts[old] == tokenStart - delta:
+            last = old
+            break
+        lexed.append(token)
+        lexedStarts.append(tokenStart)
+        lexedEnds.append(tokenEnd)
+    except Exception:
+      self.tokens = None
+      self.node = None
+      raise
+
+    self.relexedTokens += len(lexed)
+    self.tokens = tokens[:first] + lexed + tokens[last:]
+    self.starts = starts[:first] + lexedStarts + [s + delta for s in starts[last:]]
+    self.ends = ends[:first] + lexedEnds + [e + delta for e in ends[last:]]
+
+    if self.node is None or not self.tokens:
+      return self.parseAll()
+    if [token.code for token in lexed] == [token.code for token in tokens[first:last]]:
+      return self.node  # 띄어쓰기만 바뀜
+
+    path = self.pathTo(first, last)
+    change = len(lexed) - (last - first)
+    for depth in range(len(path) - 1, 0, -1):
+      node, nodeStart, parent, slot = path[depth]
+      nodeEnd = nodeStart + tokenCount(node) + change
+      replaced = self.reparse(node, nodeStart, nodeEnd, parent)
+      if replaced is None:
+        continue
+
+      if isinstance(slot, int):
+        parent.args[slot] = replaced
+      else:
+        setattr(parent, slot, replaced)
+      for ancestor, ancestorStart, _, _ in path[:depth]:
+        ancestor.end = ancestorStart + tokenCount(ancestor) + change
+        ancestor.start = ancestorStart
+        ancestor.allTokens = self.tokens
+      # 바뀐 자리부터 루트까지 깊이를 다시 셈 (다른 자식들은 적어둔 깊이를 그대로 씀)
+      for ancestor, _, _, _ in reversed(path[:depth]):
+        ancestor.depth = 1 + max(
+            nestingDepth(child) for child in ancestor.children())
+
+      self.partialParses += 1
+      self.reparsedTokens += nodeEnd - nodeStart
+      self.sinceRebase += 1
+      if self.sinceRebase >= self.rebaseEvery:
+        self.rebase()
+      return self.node
+
+    return self.parseAll()
+
+  # 예전 토큰 first ~ last를 감싸는 노드들: 루트부터 [(노드, 시작 위치, 부모, 부모에서의 자리)]
+  def pathTo(self, first: int, last: int) -> list:
+    path = [(self.node, 0, None, None)]
+    node, start = self.node, 0
+    while True:
+      for child, childStart, slot in childPositions(node, start):
+        if childStart <= first and last <= childStart + tokenCount(child):
+          path.append((child, childStart, node, slot))
+          node, start = child, childStart
+          break
+      else:
+        return path
+
+  # node 자리의 토큰들(지금 토큰 목록의 start ~ end)만 다시 파싱함. 그 자리에 그대로 끼워 넣을 수 없으면 None
+  def reparse(self, node: Node, start: int, end: int,
+              parent: Node) -> Optional[Node]:
+    # '수식 하나'가 통째로 들어가는 자리
+    wholeExpression = isinstance(parent, (Group, FunctionValue, Contexted))
+    # 연산자 사슬의 중간 노드는 다시 파싱해봐야 끼워 넣을 수 없으니 파싱하기 전에 건너뜀
+    if not wholeExpression and not isinstance(node, closedNodeTypes):
+      return None
+
+    parser = Parser(self.tokens, start, end)
+    try:
+      replaced = parser.expression()
+    except Exception:
+      return None
+    if parser.index != end:  # 토큰이 남음: 이 자리만으로는 수식 하나가 안 됨
+      return None
+
+    # Let은 뒤따르는 토큰까지 보고 모양이 정해짐: 이 자리 끝에서 멈춘 Let(정의만 있는 것)은 원래 자리에서는
+    # 뒤의 ,나 )를 보고 다르게 파싱되고, Let 뒤의 수식 자리에 또 Let이 오면 앞의 Let과 이어짐
+    if containsDefinition(replaced):
+      return None
+    if isinstance(replaced, Contexted) and isinstance(parent, Contexted):
+      return None
+
+    if wholeExpression:
+      return replaced
+
+    if isinstance(replaced, closedNodeTypes):
+      tokens = self.tokens
+      if isinstance(replaced, Symbol) and end < len(tokens) and tokens[
+          end].kind == 'group':
+        return None  # 뒤에 괄호가 있으면 함수 호출이 됨
+      if isinstance(replaced,
+                    Group) and start > 0 and tokens[start - 1].kind == 'text':
+        return None  # 앞에 이름이 있으면 함수 호출의 괄호가 됨
+      return replaced
+
+    return None
+
+  # 모든 노드가 지금 토큰 목록을 가리키게 함
+  def rebase(self):
+    self.sinceRebase = 0
+    stack = [(self.node, 0)]
+    while stack:
+      node, start = stack.pop()
+      node.end = start + tokenCount(node)
+      node.start = start
+      node.allTokens = self.tokens
+      for child, childStart, _ in childPositions(node, start):
+        stack.append((child, childStart))
+
+  def stats(self) -> dict:
+    return {
+        'edits': self.edits,
+        'partialParses': self.partialParses,
+        'fullParses': self.fullParses,
+        'relexedTokens': self.relexedTokens,
+        'reparsedTokens': self.reparsedTokens
+    }
+
+  def __repr__(self) -> str:
+    return f'IncrementalParser({self.stats()})'
 
 
 # %% [markdown]
 # ### 인터프리터
 
 # %%
-import math
+# 내장함수들: 이름 -> 실제로 계산하는 파이썬 함수
+builtinCallables = {
+    'sin': math.sin,
+    'cos': math.cos,
+    'tan': math.tan,
+    'asin': math.asin,
+    'asinh': math.asinh,
+    'acos': math.acos,
+    'acosh': math.acosh,
+    'atan': math.atan,
+    'atan2': math.atan2,
+    'atanh': math.atanh,
+    'ceil': math.ceil,
+    'floor': math.floor,
+    'round': round,
+    'log': math.log10,
+    'ln': math.log
+}
 
 builtinFunctions = {
-    'sin':
-    Function(lambda _interpret, args, _context: math.sin(args[0])),
-    'cos':
-    Function(lambda _interpret, args, _context: math.cos(args[0])),
-    'tan':
-    Function(lambda _interpret, args, _context: math.tan(args[0])),
-    'asin':
-    Function(lambda _interpret, args, _context: math.asin(args[0])),
-    'asinh':
-    Function(lambda _interpret, args, _context: math.asinh(args[0])),
-    'acos':
-    Function(lambda _interpret, args, _context: math.acos(args[0])),
-    'acosh':
-    Function(lambda _interpret, args, _context: math.acosh(args[0])),
-    'atan':
-    Function(lambda _interpret, args, _context: math.atan(args[0])),
-    'atan2':
-    Function(lambda _interpret, args, _context: math.atan(args[0], args[1])),
-    'atanh':
-    Function(lambda _interpret, args, _context: math.atanh(args[0])),
-    'ceil':
-    Function(lambda _interpret, args, _context: math.ceil(args[0])),
-    'floor':
-    Function(lambda _interpret, args, _context: math.floor(args[0])),
-    'round':
-    Function(lambda _interpret, args, _context: round(args[0])),
-    'log':
-    Function(lambda _interpret, args, _context: math.log10(args[0])),
-    'ln':
-    Function(lambda _interpret, args, _context: math.log(args[0]))
+    name: Function(lambda _interpret, args, _context, function=function:
+                   function(*args))
+    for name, function in builtinCallables.items()
 }
 
 builtinSymbols = {'pi': math.pi, 'e': math.e}
 
 
 # %%
-def interpret(node: Node, context: dict):
-  if isinstance(node, Number):
+# 계산 한도 (budget)
+#
+# Let f(x) = f(x)처럼 끝나지 않는 수식이나 floor(9) ^ floor(999999999)처럼 값이 터무니없이 커지는 수식은
+# interpret() 하나가 프로세스를 계속 붙잡음. 서버처럼 남이 보낸 수식을 계산할 때는 Budget을 넘겨서 한도를 둠.
+#   budget = Budget(maxSteps=10**6, timeLimit=0.5, maxMagnitude=1e100, cancel=threading.Event())
+#   interpret(node, context, budget)
+# - maxSteps: 함수를 부르거나(내장함수도) Let으로 정의한 함수/기호를 펼친 횟수.
+#   끝나지 않는 계산은 전부 정의를 계속 펼치는 것이고, 그 사이에 계산하는 연산 개수는 수식 크기를 넘지 않으니까 연산은 안 셈
+# - maxDepth: Let으로 정의한 함수/기호를 펼친 깊이 (f를 계산하다 g를 부르면 2). 안 주면 defaultMaxDepth
+# - timeLimit: 처음 계산을 시작한 뒤로 쓸 수 있는 시간(초)
+# - maxMagnitude: 중간값(연산 + - * / % ^의 결과, 함수의 값, 펼친 정의의 값)과 최종 결과의 절댓값.
+#   x * x * x * x / (x * x * x)처럼 최종 결과는 작아도 중간에 커지는 값이 있으면 거기서 멈춤.
+#   거듭제곱은 계산하기 전에 결과 크기를 어림해서 막음 (정수 거듭제곱은 파이썬이 한 번에 계산해서, 시작하면 시간 한도로도 중간에 못 멈추니까).
+#   내장함수는 float 범위 안의 값을 내거나 인수를 그대로 돌려주니까(floor, round 등) 값을 보지 않음
+# - cancel: threading.Event 등 is_set()이 있는 것. 바깥(스케줄러 등)에서 set하면 멈춤 (evaluateGrid의 cancel과 같음)
+# 한도마다 다른 오류(StepLimitExceeded 등)가 나고, 오류의 tokens에 그때 계산하던 부분의 TokenReference가 담김.
+#
+# 한도는 노드마다 보면 느려지니까 걸음을 세다가 checkInterval걸음마다 걸음 수, 시간, cancel을 봄 (maxSteps는 그 걸음에서 바로 봄).
+# budget 때문에 느려지는 건 함수를 부르거나 정의를 펼칠 때와, maxMagnitude가 있을 때 연산마다 결과를 한 번 비교하는 것뿐임.
+# Budget에는 쓴 걸음 수가 쌓이니까 계산마다 새로 만들거나 restart()로 되돌림 (그냥 여러 계산에 같이 쓰면 합쳐서 셈).
+# Budget이 없어도 정의를 펼친 깊이는 defaultMaxDepth까지만 허용함.
+# (예전 재귀 버전에서는 Let x = x + 1, x가 재귀 한도에 걸려서 바로 오류가 났으니까, 지금도 메모리를 다 쓰기 전에 멈추게)
+
+defaultMaxDepth = 100000
+
+
+# 토큰 범위의 글자. 길면 앞부분만
+def spanText(tokens: TokenReference, limit: int = 12) -> str:
+  count = len(tokens)
+  text = ' '.join(tokens[i].code for i in range(min(count, limit)))
+  return text if count <= limit else text + ' ...'
+
+
+class EvaluationLimitExceeded(Exception):
+  tokens: TokenReference  # 한도를 넘었을 때 계산하던 부분
+
+  def __init__(self, message: str, tokens: TokenReference):
+    super().__init__(f'{message} (계산하던 부분: {spanText(tokens)})')
+    self.tokens = tokens
+
+
+class StepLimitExceeded(EvaluationLimitExceeded):
+  pass
+
+
+class CallDepthExceeded(EvaluationLimitExceeded):
+  pass
+
+
+class TimeLimitExceeded(EvaluationLimitExceeded):
+  pass
+
+
+class MagnitudeLimitExceeded(EvaluationLimitExceeded):
+  pass
+
+
+class EvaluationCancelled(EvaluationLimitExceeded):
+  pass
+
+
+class Budget:
+  __slots__ = ('maxSteps', 'maxDepth', 'timeLimit', 'maxMagnitude', 'cancel',
+               'steps', 'depth', 'started', 'nextCheck')
+
+  maxSteps: Optional[int]
+  maxDepth: int  # 안 주면 defaultMaxDepth
+  timeLimit: Optional[float]
+  maxMagnitude: Optional[float]
+  cancel: Optional[Any]
+  steps: int  # 지금까지 간 걸음 수
+  depth: int  # 지금 정의를 펼친 깊이 (interpret 안에서 interpret를 또 부르면 이어서 셈)
+  started: Optional[float]  # 처음 계산을 시작한 time.monotonic()
+  nextCheck: int  # 걸음 수가 이만큼 되면 check()로 한도를 봄
+
+  checkInterval = 256
+
+  def __init__(self,
+               maxSteps: Optional[int] = None,
+               maxDepth: Optional[int] = None,
+               timeLimit: Optional[float] = None,
+               maxMagnitude: Optional[float] = None,
+               cancel=None):
+    self.maxSteps = maxSteps
+    self.maxDepth = defaultMaxDepth if maxDepth is None else maxDepth
+    self.timeLimit = timeLimit
+    self.maxMagnitude = maxMagnitude
+    self.cancel = cancel
+    self.steps = 0
+    self.depth = 0
+    self.started = None
+    # 처음 checkInterval걸음까지는 한도를 안 봄 (maxSteps가 더 작으면 그 다음 걸음에 봄).
+    # 계산마다 Budget을 새로 만드는 곳이 많아서 min()도 안 부름
+    if maxSteps is None or maxSteps >= self.checkInterval:
+      self.nextCheck = self.checkInterval
+    else:
+      self.nextCheck = maxSteps + 1
+
+  # 같은 한도로 계산을 처음부터 다시 셈: 쓴 걸음 수와 시작 시간을 되돌리고 timeLimit을 새로 둠.
+  # 키워드 인수로 클래스를 부르는 것만으로도 작은 수식 하나 계산하는 시간의 10%가 넘게 걸려서,
+  # 서버처럼 요청마다 한도를 새로 두는 곳은 Budget(...)을 요청마다 만들지 않고 하나를 되돌려 씀
+  def restart(self, timeLimit: Optional[float] = None) -> 'Budget':
+    self.timeLimit = timeLimit
+    self.steps = 0
+    self.depth = 0
+    self.started = None
+    if self.maxSteps is None or self.maxSteps >= self.checkInterval:
+      self.nextCheck = self.checkInterval
+    else:
+      self.nextCheck = self.maxSteps + 1
+    return self
+
+  # node에서 함수를 부르거나 정의를 펼치기 전에 부름 (evaluateNode() 등 자주 부르는 곳은 같은 걸 직접 함)
+  def step(self, node: Node):
+    self.steps += 1
+    if self.steps >= self.nextCheck:
+      self.check(node)
+
+  # 한도를 넘었으면 오류를 냄
+  def check(self, node: Node):
+    steps = self.steps
+    if self.maxSteps is not None and steps > self.maxSteps:
+      raise StepLimitExceeded(f'함수를 부르거나 정의를 펼친 게 {self.maxSteps}번을 넘었어요',
+                              node.tokens)
+    if self.cancel is not None and self.cancel.is_set():
+      raise EvaluationCancelled('계산이 취소됐어요', node.tokens)
+    if self.timeLimit is not None and time.monotonic(
+    ) - self.started > self.timeLimit:
+      raise TimeLimitExceeded(f'계산이 {self.timeLimit:g}초 넘게 걸렸어요', node.tokens)
+
+    self.nextCheck = steps + self.checkInterval
+    if self.maxSteps is not None:
+      self.nextCheck = min(self.nextCheck, self.maxSteps + 1)
+
+  # value의 절댓값이 maxMagnitude를 넘으면 오류를 냄 (maxMagnitude가 있을 때만 부름).
+  # magnitudeExceeds()와 같은데, 보통은 숫자니까 함수를 하나 더 부르지 않고 바로 비교함
+  def checkMagnitude(self, value, node: Node):
+    limit = self.maxMagnitude
+    try:
+      if not (value > limit or value < -limit):
+        return
+    except (TypeError, ValueError):  # 복소수, 이중수, 배열 등
+      if not magnitudeExceeds(value, limit):
+        return
+    raise MagnitudeLimitExceeded(f'값의 크기가 {limit:g}를 넘어요', node.tokens)
+
+  # calculate()/value()에 interpret 대신 넘김: memoize(f) 등이 안에서 계산하는 것도 이 budget으로 셈
+  def evaluate(self, node: Node, context: dict):
+    return interpret(node, context, self)
+
+  def stats(self) -> dict:
+    return {
+        'steps': self.steps,
+        'depth': self.depth,
+        'seconds': 0.0 if self.started is None else time.monotonic() -
+                   self.started
+    }
+
+  def __repr__(self) -> str:
+    return f'Budget({self.stats()})'
+
+
+# 값의 절댓값이 limit을 넘는지. 숫자만 보고 배열/이중수 등은 넘기지 않음
+def magnitudeExceeds(value, limit: float) -> bool:
+  try:
+    return value > limit or value < -limit
+  except (TypeError, ValueError):  # 복소수/이중수는 크기 비교가 안 되고, 배열은 참/거짓이 하나로 안 정해짐
+    return isinstance(value, complex) and abs(value) > limit
+
+
+# 정수 left ^ right의 절댓값이 limit을 넘는지 계산하지 않고 어림함.
+# float 거듭제곱은 바로 끝나지만(너무 크면 OverflowError), 정수 거듭제곱은 자릿수가 얼마든 끝까지 계산하니까 정수끼리만 봄
+def powerExceeds(left: int, right: int, limit: float) -> bool:
+  if right <= 0 or -1 <= left <= 1:
+    return False
+  try:
+    return right * math.log(abs(left)) > math.log(limit)
+  except OverflowError:  # 지수가 float으로도 안 될 만큼 큰 정수
+    return True
+
+
+# %%
+# 노드마다 자기를 재귀로 불러서 계산함. ((((...))))나 --...-x처럼 수천 겹이면 재귀 한도에 걸리는데,
+# 모든 노드를 반복문으로 계산하면(evaluateDeep, 컴파일러 아래) 할 일을 리스트에 넣고 빼느라 보통 수식이 30%쯤 느려짐.
+# 그래서 파서가 적어둔 깊이(nestingDepth)가 recursionRoom() 안이면 재귀로, 넘으면 처음부터 evaluateDeep()로 계산함.
+# 재귀로 계산하다 Let으로 정의한 함수/기호를 펼칠 때도 쌓인 깊이(levels)에 몸통의 깊이를 더해보고, 넘치면 그 몸통부터 evaluateDeep()로 계산함.
+# (예전에는 재귀 한도에 걸리면 처음부터 다시 계산했는데, 그러면 memoize(f)의 hits나 profiling()의 횟수가
+#  두 번 세지고 timeLimit도 버린 계산에 써버림)
+#
+# budget을 주면 그 한도 안에서만 계산함 (위의 '계산 한도' 참고). calculate()/value()에 넘기는 interpret도
+# 같은 budget을 쓰게 해서, memoize(f)나 Definitions의 기호 안에서 계산하는 것도 같이 셈.
+def interpret(node: Node, context: dict, budget: Optional[Budget] = None):
+  try:  # nestingDepth(node)를 함수를 부르지 않고 읽음
+    levels = node.depth
+  except AttributeError:  # 파서가 만들지 않은 노드
+    levels = nestingDepth(node)
+  if budget is None:
+    if levels > shallowDepth and levels > recursionRoom():
+      return evaluateDeep(node, context, pythonBackend)
+    return evaluateNode(node, context, None, levels)
+
+  if budget.started is None:  # 처음이면 시간을 재기 시작함 (한도는 걸음을 셀 때 봄)
+    budget.started = time.monotonic()
+  depth = budget.depth
+  try:
+    if levels > shallowDepth and levels > recursionRoom():
+      value = evaluateDeep(node, context, pythonBackend, budget)
+    else:
+      value = evaluateNode(node, context, budget, levels)
+  finally:  # 오류가 나서 중간에 멈췄어도 Budget을 다시 쓸 수 있게 펼친 깊이를 되돌림
+    budget.depth = depth
+
+  # 연산의 결과는 evaluateNode()가 이미 봤으니, context에 있던 값 등 연산을 거치지 않은 값만 여기서 봄
+  if budget.maxMagnitude is not None and node.kind != 'binary_operator':
+    budget.checkMagnitude(value, node)
+  return value
+
+
+# 재귀로 계산해도 되는 깊이. 노드 한 겹에 파이썬 프레임을 둘까지 쓰고
+# (compile()의 사용자 함수 호출, profiling()이 감싼 evaluateNode), 부른 쪽의 프레임도 남겨야 해서 재귀 한도의 1/5만 씀
+def recursionRoom() -> int:
+  return sys.getrecursionlimit() // 5
+
+
+# 이 깊이까지는 recursionRoom()을 부르지 않고 재귀로 계산함 (재귀 한도를 320보다 낮추지 않았다면 늘 그 안임)
+shallowDepth = 64
+
+
+# interpret()가 노드 하나를 계산하는 재귀 함수.
+# isinstance를 차례로 부르는 대신 클래스마다 있는 kind 문자열로 노드 종류를 고름 (얼린 노드도 kind는 같음).
+# budget은 함수를 부르거나 정의를 펼칠 때 보고, 연산은 maxMagnitude가 있을 때만 결과의 크기를 봄.
+# levels는 이 노드를 계산하는 동안 재귀로 쌓일 수 있는 깊이: 루트의 깊이에 지금까지 펼친 정의들의 깊이를 더한 것
+def evaluateNode(node: Node, context: dict, budget: Optional[Budget],
+                 levels: int):
+  kind = node.kind
+  if kind == 'number':
     return node.number
 
-  elif isinstance(node, BinaryOperator):
-    left = interpret(node.left, context)
-    right = interpret(node.right, context)
+  elif kind == 'binary_operator':
+    left = evaluateNode(node.left, context, budget, levels)
+    right = evaluateNode(node.right, context, budget, levels)
     operator = node.operator
 
+    if budget is None or budget.maxMagnitude is None:
+      if operator == '+':
+        return left + right
+      elif operator == '-':
+        return left - right
+      elif operator == '*':
+        return left * right
+      elif operator == '/':
+        return left / right
+      elif operator == '%':
+        return left % right
+      elif operator == '^':
+        return left**right
+      else:
+        raise Exception(f'Unknown binary operator {operator}')
+
+    # maxMagnitude가 있으면 연산마다 결과의 크기를 봄 (x * x * x / x처럼 중간에만 커지는 값도 막게)
+    limit = budget.maxMagnitude
     if operator == '+':
-      return left + right
+      value = left + right
     elif operator == '-':
-      return left - right
+      value = left - right
     elif operator == '*':
-      return left * right
+      value = left * right
     elif operator == '/':
-      return left / right
+      value = left / right
     elif operator == '%':
-      return left % right
+      value = left % right
     elif operator == '^':
-      return left**right
+      if type(left) is int and type(right) is int and powerExceeds(
+          left, right, limit):
+        raise MagnitudeLimitExceeded(f'값의 크기가 {limit:g}를 넘어요', node.tokens)
+      value = left**right
     else:
       raise Exception(f'Unknown binary operator {operator}')
+    try:  # budget.checkMagnitude()와 같음
+      if not (value > limit or value < -limit):
+        return value
+    except (TypeError, ValueError):  # 복소수, 이중수, 배열 등
+      if not magnitudeExceeds(value, limit):
+        return value
+    raise MagnitudeLimitExceeded(f'값의 크기가 {limit:g}를 넘어요', node.tokens)
+
+  elif kind == 'symbol':
+    symbol = node.symbol
+    if symbol in builtinSymbols:
+      return builtinSymbols[symbol]
+    elif symbol in context:
+      value = context[symbol]
+      if not isinstance(value, SymbolValue):
+        return value
+      if type(value) is SymbolValue and value.body is not None:
+        # Let x = ...로 정의한 기호 (userSymbol): 같은 context에서 우변을 계산 (아래에서 펼침)
+        body, inner = value.body, context
+      else:
+        if budget is None:
+          return value.value(interpret, context)
+        budget.step(node)
+        value = value.value(budget.evaluate, context)
+        if budget.maxMagnitude is not None:
+          budget.checkMagnitude(value, node)
+        return value
+    else:
+      raise Exception(f'{symbol}라는 기호가 없어요.')
+
+  elif kind == 'function_value':
+    # 리스트 컴프리헨션으로 쓰면 context/budget을 클로저 셀에 담느라 노드마다(함수 호출이 아닌 노드도) 느려져서 반복문으로 씀
+    args = []
+    for arg in node.args:
+      args.append(evaluateNode(arg, context, budget, levels))
+    name = node.name
+
+    if name in builtinFunctions:
+      if budget is None:
+        return builtinCallables[name](*args)
+      budget.steps += 1  # budget.step(node)와 같음
+      if budget.steps >= budget.nextCheck:
+        budget.check(node)
+      return builtinCallables[name](*args)
+    elif name in context:
+      function = context[name]
+      if type(function) is Function and function.body is not None:
+        # Let f(x) = ...로 정의한 함수 (userFunction): calculate()를 거치지 않고 인수를 넣은 context에서 몸통을 계산 (아래에서 펼침)
+        body, inner = function.body, {
+            **context,
+            **fromValues(function.parameters, args)
+        }
+      else:
+        if budget is None:
+          return function.calculate(interpret, args, context)
+        budget.step(node)
+        value = function.calculate(budget.evaluate, args, context)
+        if budget.maxMagnitude is not None:
+          budget.checkMagnitude(value, node)
+        return value
+    else:
+      raise Exception(f'{name}이라는 함수가 없어요.')
 
-  elif isinstance(node, UnaryOperator):
-    value = interpret(node.value, context)
+  elif kind == 'unary_operator':
+    value = evaluateNode(node.value, context, budget, levels)
     operator = node.operator
 
     if operator == '-':
@@ -750,51 +1745,3847 @@ def interpret(node: Node, context: dict):
     else:
       raise Exception(f'Unknown unary operator {operator}')
 
-  elif isinstance(node, FunctionValue):
-    values = [interpret(arg, context) for arg in node.args]
+  elif kind == 'contexted':
+    return evaluateNode(node.node, {**context, **node.contexts}, budget, levels)
 
-    if node.name in builtinFunctions:
-      return builtinFunctions[node.name].calculate(interpret, values, context)
-    elif node.name in context:
-      function = context[node.name]
-      return function.calculate(interpret, values, context)
-    else:
-      raise Exception(f'{node.name}이라는 함수가 없어요.')
+  elif kind == 'group':
+    return evaluateNode(node.node, context, budget, levels)
+
+  else:
+    raise Exception(f'Unknown node type {type(node)}')
+
+  # Let으로 정의한 기호/함수의 우변(body)을 inner에서 펼침. 쌓인 깊이가 recursionRoom()을 넘으면 evaluateDeep()로 계산함.
+  # budget이 있으면 걸음을 세고, 펼친 깊이를 하나 늘렸다가 되돌리고, 펼친 값의 크기를 봄
+  try:
+    levels += body.depth
+  except AttributeError:
+    levels += nestingDepth(body)
+  if budget is None:
+    if levels > shallowDepth and levels > recursionRoom():
+      return evaluateDeep(body, inner, pythonBackend)
+    return evaluateNode(body, inner, None, levels)
+
+  budget.steps += 1
+  if budget.steps >= budget.nextCheck:
+    budget.check(node)
+  depth = budget.depth
+  if depth >= budget.maxDepth:
+    raise CallDepthExceeded(f'정의를 {budget.maxDepth}번 넘게 겹쳐서 펼쳤어요',
+                            node.tokens)
+  budget.depth = depth + 1
+  if levels > shallowDepth and levels > recursionRoom():
+    value = evaluateDeep(body, inner, pythonBackend, budget)
+  else:
+    value = evaluateNode(body, inner, budget, levels)
+  budget.depth = depth
+  # 몸통이 연산이면 그 결과의 크기는 이미 봤음
+  if budget.maxMagnitude is not None and body.kind != 'binary_operator':
+    budget.checkMagnitude(value, node)
+  return value
+
+
+# %% [markdown]
+# ### 컴파일러
+
+# %%
+# interpret()는 계산할 때마다 노드 종류를 하나하나 확인하고, 연산자도 문자열로 비교함.
+# 같은 수식을 값만 바꿔서 수백만 번 계산하면 이 확인 과정이 매번 반복되니까 낭비가 큼.
+# 그래서 compile()은 트리를 딱 한 번만 훑으면서 노드마다 '파이썬 함수(클로저)'를 만들어 둠.
+# 연산자나 내장함수를 고르는 건 컴파일할 때 끝나고, 계산할 때는 만들어둔 함수들을 호출하기만 함.
+#
+# compiled = compile(parseMathToAst('x * 2 + sin(x)'))
+# compiled({'x': 1})  # interpret(node, {'x': 1})과 결과가 같음
+
+# 연산자 -> 계산하는 함수
+binaryOperatorFunctions = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '%': operator.mod,
+    '^': operator.pow
+}
+
+unaryOperatorFunctions = {
+    '-': operator.neg,
+    '+': operator.pos,
+    '~': operator.not_
+}
+
+# 연산자 -> (왼쪽 함수, 오른쪽 함수)를 받아서 계산 함수를 만드는 함수
+compiledBinaryOperators = {
+    '+': lambda left, right: lambda context: left(context) + right(context),
+    '-': lambda left, right: lambda context: left(context) - right(context),
+    '*': lambda left, right: lambda context: left(context) * right(context),
+    '/': lambda left, right: lambda context: left(context) / right(context),
+    '%': lambda left, right: lambda context: left(context) % right(context),
+    '^': lambda left, right: lambda context: left(context)**right(context)
+}
+
+compiledUnaryOperators = {
+    '-': lambda value: lambda context: -value(context),
+    '+': lambda value: lambda context: +value(context),
+    '~': lambda value: lambda context: not value(context)
+}
+
+
+# 계산을 '무엇으로' 할지 모아둔 것.
+# 같은 트리라도 파이썬 float으로 계산할 수도, numpy 배열로 한꺼번에 계산할 수도 있음
+class Backend:
+  name: str
+  # 내장함수 이름 -> 계산하는 함수 (builtinCallables와 같은 모양)
+  functions: dict
+  binaryOperators: dict
+  unaryOperators: dict
+  binaryFunctions: dict
+  unaryFunctions: dict
+
+  def __init__(self,
+               name,
+               functions,
+               binaryOperators=compiledBinaryOperators,
+               unaryOperators=compiledUnaryOperators):
+    self.name = name
+    self.functions = functions
+    self.binaryOperators = binaryOperators
+    self.unaryOperators = unaryOperators
+    # 값을 바로 계산하는 함수들 (evaluateDeep()가 씀): binaryFunctions['+']((1, 2)) == 3
+    # 클로저를 만드는 함수에 context 대신 (왼쪽 값, 오른쪽 값)을 받아서 하나씩 꺼내는 함수를 넣어서 만듦
+    first, second = operator.itemgetter(0), operator.itemgetter(1)
+    self.binaryFunctions = {
+        code: make(first, second) for code, make in binaryOperators.items()
+    }
+    self.unaryFunctions = {
+        code: make(first) for code, make in unaryOperators.items()
+    }
+
+  def __repr__(self) -> str:
+    return f'Backend({self.name})'
+
+
+pythonBackend = Backend('python', builtinCallables)
+
+
+# interpret()/compile()/resolve()가 재귀 한도에 걸릴 만큼 깊은 수식을 계산하는 반복문 버전.
+# 나중에 할 일(tasks)과 계산한 값(values)을 리스트에 쌓아두고 반복문으로 계산함.
+# 1. 내려가기: 연산자/함수 호출이면 [노드, combineTask, 나머지 자식들]을 쌓아두고 첫 자식으로 내려감.
+#    숫자/기호처럼 바로 값이 나오면 values에 넣고 2로
+# 2. 올라오기: tasks에서 꺼낸 게 combineTask면 자식 값들을 values에서 꺼내서 계산한 값을 넣음.
+#    계산할 노드(아직 안 한 오른쪽 자식 등)가 나오면 그걸로 1을 다시 함
+# Let x = ...의 x나 Let f(x) = ...의 f를 부를 때도 몸통으로 내려가서, 사용자 함수가 깊이 부르고 불려도 재귀하지 않음
+# (내장함수, memoize(f) 등 다른 것들은 calculate()를 그대로 부름).
+# 연산자와 내장함수, 정의를 펼치는 규칙은 그 backend로 compile()한 것과 같고 (pythonBackend면 interpret()와 같음),
+# 왼쪽부터 계산하는 순서와 오류 메시지도 같음. budget은 interpret()에서 넘어온 것
+combineTask = object()  # 바로 밑의 노드는 자식들을 다 계산했으니 values에서 꺼내서 합침
+restoreTask = object()  # 바로 밑의 노드(Let 블록, 펼친 기호/함수)를 다 계산했으니 그 밑의 context와 펼친 깊이로 되돌림
+
+
+def evaluateDeep(node: Node,
+                 context: dict,
+                 backend: Backend,
+                 budget: Optional[Budget] = None):
+  functions = backend.functions
+  binaryFunctions = backend.binaryFunctions
+  unaryFunctions = backend.unaryFunctions
+  # 기억해둔 결과(memoize, Definitions)는 숫자끼리만 맞으니까 배열/이중수는 원래 본문으로 계산함 (compile()과 같음)
+  remembered = backend is pythonBackend
+  tasks = []
+  values = []
+
+  if budget is None:
+    evaluate = interpret
+    depth = 0
+    maxDepth = defaultMaxDepth
+    maxMagnitude = None
+  else:
+    evaluate = budget.evaluate
+    depth = budget.depth
+    maxDepth = budget.maxDepth
+    maxMagnitude = budget.maxMagnitude
+
+  while True:
+    # 1. 내려가기
+    while True:
+      if isinstance(node, Number):
+        values.append(node.number)
+        break
+
+      elif isinstance(node, BinaryOperator):
+        tasks.append(node)
+        tasks.append(combineTask)
+        tasks.append(node.right)
+        node = node.left
+
+      elif isinstance(node, Symbol):
+        if node.symbol in builtinSymbols:
+          values.append(builtinSymbols[node.symbol])
+        elif node.symbol in context:
+          value = context[node.symbol]
+          if not isinstance(value, SymbolValue):
+            values.append(value)
+          elif value.body is None or (remembered and
+                                      isinstance(value, ReactiveSymbol)):
+            if budget is not None:
+              budget.step(node)
+              budget.depth = depth
+            values.append(value.value(evaluate, context))
+            if maxMagnitude is not None:
+              budget.checkMagnitude(values[-1], node)
+          else:
+            # Let x = ...로 정의한 기호 (userSymbol): 같은 context에서 우변을 계산
+            if budget is not None:
+              budget.step(node)
+            if depth >= maxDepth:
+              raise CallDepthExceeded(f'정의를 {maxDepth}번 넘게 겹쳐서 펼쳤어요',
+                                      node.tokens)
+            tasks.append(depth)
+            tasks.append(context)
+            tasks.append(node)
+            tasks.append(restoreTask)
+            depth += 1
+            node = value.body
+            continue
+        else:
+          raise Exception(f'{node.symbol}라는 기호가 없어요.')
+        break
+
+      elif isinstance(node, FunctionValue):
+        tasks.append(node)
+        tasks.append(combineTask)
+        if not node.args:
+          break
+        tasks.extend(reversed(node.args))
+        node = tasks.pop()
+
+      elif isinstance(node, Group):
+        node = node.node
+
+      elif isinstance(node, UnaryOperator):
+        tasks.append(node)
+        tasks.append(combineTask)
+        node = node.value
+
+      elif isinstance(node, Contexted):
+        tasks.append(depth)
+        tasks.append(context)
+        tasks.append(node)
+        tasks.append(restoreTask)
+        context = {**context, **node.contexts}
+        node = node.node
+
+      else:
+        raise Exception(f'Unknown node type {type(node)}')
+
+    # 2. 올라오기
+    while True:
+      if not tasks:
+        if budget is not None:
+          budget.depth = depth
+        return values.pop()
+      node = tasks.pop()
+
+      if node is combineTask:
+        node = tasks.pop()
+
+        if isinstance(node, BinaryOperator):
+          right = values.pop()
+          left = values[-1]
+          operator = node.operator
+          if operator not in binaryFunctions:
+            raise Exception(f'Unknown binary operator {operator}')
+          if (operator == '^' and maxMagnitude is not None and
+              type(left) is int and type(right) is int and
+              powerExceeds(left, right, maxMagnitude)):
+            raise MagnitudeLimitExceeded(f'값의 크기가 {maxMagnitude:g}를 넘어요',
+                                         node.tokens)
+          values[-1] = binaryFunctions[operator]((left, right))
+          if maxMagnitude is not None:  # evaluateNode()처럼 연산마다 결과의 크기를 봄
+            budget.checkMagnitude(values[-1], node)
+
+        elif isinstance(node, UnaryOperator):
+          if node.operator not in unaryFunctions:
+            raise Exception(f'Unknown unary operator {node.operator}')
+          values[-1] = unaryFunctions[node.operator]((values[-1],))
+
+        else:  # FunctionValue
+          first = len(values) - len(node.args)
+          args = values[first:]
+          del values[first:]
+
+          if node.name in functions:
+            if budget is not None:
+              budget.step(node)
+            values.append(functions[node.name](*args))
+          elif node.name in context:
+            function = context[node.name]
+            if function.body is None or (remembered and
+                                         isinstance(function, MemoizedFunction)):
+              if budget is not None:
+                budget.step(node)
+                budget.depth = depth
+              values.append(function.calculate(evaluate, args, context))
+              if maxMagnitude is not None:
+                budget.checkMagnitude(values[-1], node)
+            else:
+              # Let f(x) = ...로 정의한 함수 (userFunction): 인수를 넣은 context에서 몸통을 계산하고 되돌아옴
+              if budget is not None:
+                budget.step(node)
+              if depth >= maxDepth:
+                raise CallDepthExceeded(f'정의를 {maxDepth}번 넘게 겹쳐서 펼쳤어요',
+                                        node.tokens)
+              tasks.append(depth)
+              tasks.append(context)
+              tasks.append(node)
+              tasks.append(restoreTask)
+              depth += 1
+              context = {**context, **fromValues(function.parameters, args)}
+              node = function.body
+              break
+          else:
+            raise Exception(f'{node.name}이라는 함수가 없어요.')
+
+      elif node is restoreTask:
+        node = tasks.pop()
+        context = tasks.pop()
+        if tasks[-1] != depth and maxMagnitude is not None:  # 펼친 정의의 값 (interpret()와 같음)
+          budget.checkMagnitude(values[-1], node)
+        depth = tasks.pop()
+
+      else:  # 아직 계산 안 한 노드
+        break
+
+
+# 오류는 interpret()와 똑같이 '계산할 때' 나도록 미뤄둠
+def compileError(message):
+
+  def fail(context):
+    raise Exception(message)
+
+  return fail
+
+
+# compile()/resolve()로 만든 함수가 지금 스레드(contextvars의 컨텍스트)에서 재귀로 펼치고 있는 정의들의 깊이를 더한 것.
+# 클로저는 context(frame)만 받아서 interpret()처럼 쌓인 깊이(levels)를 인수로 넘길 수 없으니까 여기에 둠.
+# 펼칠 때마다 ContextVar.set()을 부르면 느려서, 컨텍스트마다 [깊이] 칸을 하나 만들어두고 그 안의 값만 바꿈
+expandedDepth: contextvars.ContextVar = contextvars.ContextVar('expandedDepth',
+                                                               default=None)
+
+
+def expansionCell() -> list:
+  cell = expandedDepth.get()
+  if cell is None:
+    cell = [0]
+    expandedDepth.set(cell)
+  return cell
+
+
+# Let 정의의 우변(body)을 펼치는 함수: 컴파일한 우변(compiled)을 부르고, 펼친 깊이가 recursionRoom()을 넘으면
+# (또는 우변이 너무 깊어서 compiled가 None이면) 그 우변부터 deep으로 계산함 (evaluateDeep()를 부르는 함수)
+def expansionOf(body: Node, compiled: Optional[Callable], deep: Callable):
+  depth = nestingDepth(body)
+
+  def expand(argument):  # context나 frame
+    cell = expandedDepth.get() or expansionCell()
+    levels = cell[0]
+    expanded = levels + depth
+    if compiled is None or (expanded > shallowDepth and
+                            expanded > recursionRoom()):
+      return deep(argument)
+    cell[0] = expanded
+    try:
+      return compiled(argument)
+    finally:
+      cell[0] = levels
+
+  return expand
+
+
+# Let으로 정의한 함수/기호의 우변을 펼치는 함수를 만들어서 value.compiled에 담아둠 (backend마다 한 번만)
+def compiledBody(value, backend):
+  if backend.name not in value.compiled:
+    body = value.body
+    compiled = None
+    if nestingDepth(body) <= recursionRoom():
+      compiled = compileNode(body, backend)
+    value.compiled[backend.name] = expansionOf(
+        body, compiled, lambda context: evaluateDeep(body, context, backend))
+  return value.compiled[backend.name]
+
+
+# 클로저는 노드마다 재귀로 만들고, 계산할 때도 자식 클로저를 재귀로 부름.
+# 그래서 interpret()처럼 수식이 recursionRoom()보다 깊으면(수천 겹 중첩된 수식) 처음부터 evaluateDeep()로 계산하고,
+# 아주 깊이 부르는 사용자 함수는 펼친 깊이가 넘치는 데부터 evaluateDeep()로 계산함 (expansionOf)
+def compile(node: Node,
+            backend: Backend = pythonBackend) -> Callable[[dict], float]:
+  if nestingDepth(node) > recursionRoom():
+    return lambda context: evaluateDeep(node, context, backend)
+  return compileNode(node, backend)
+
+
+def compileNode(node: Node, backend: Backend) -> Callable[[dict], float]:
+  if isinstance(node, Number):
+    number = node.number
+    return lambda context: number
+
+  elif isinstance(node, BinaryOperator):
+    left = compileNode(node.left, backend)
+    right = compileNode(node.right, backend)
+    if node.operator in backend.binaryOperators:
+      return backend.binaryOperators[node.operator](left, right)
+    return compileError(f'Unknown binary operator {node.operator}')
+
+  elif isinstance(node, UnaryOperator):
+    value = compileNode(node.value, backend)
+    if node.operator in backend.unaryOperators:
+      return backend.unaryOperators[node.operator](value)
+    return compileError(f'Unknown unary operator {node.operator}')
+
+  elif isinstance(node, FunctionValue):
+    name = node.name
+    args = [compileNode(arg, backend) for arg in node.args]
+
+    if name in backend.functions:  # 내장함수는 지금 바로 찾아둘 수 있음
+      function = backend.functions[name]
+      if len(args) == 1:
+        arg = args[0]
+        return lambda context: function(arg(context))
+      return lambda context: function(*[arg(context) for arg in args])
+
+    # 사용자 함수는 context에 따라 달라지니까 계산할 때 찾음
+    def call(context):
+      values = [arg(context) for arg in args]
+      if name not in context:
+        raise Exception(f'{name}이라는 함수가 없어요.')
+      function = context[name]
+      # 기억해둔 결과(memoize)는 숫자끼리만 맞으니까 배열/이중수는 원래 본문으로 계산함
+      if function.body is None or (isinstance(function, MemoizedFunction) and
+                                   backend is pythonBackend):
+        return function.calculate(interpret, values, context)
+      return compiledBody(function, backend)({
+          **context,
+          **fromValues(function.parameters, values)
+      })
+
+    return call
 
   elif isinstance(node, Symbol):
-    if node.symbol in builtinSymbols:
-      return builtinSymbols[node.symbol]
-    elif node.symbol in context:
-      value = context[node.symbol]
+    name = node.symbol
+    if name in builtinSymbols:
+      constant = builtinSymbols[name]
+      return lambda context: constant
+
+    def symbol(context):
+      if name not in context:
+        raise Exception(f'{name}라는 기호가 없어요.')
+      value = context[name]
       if isinstance(value, SymbolValue):
-        return value.value(interpret, context)
-      else:
-        return value
-    else:
-      raise Exception(f'{node.symbol}라는 기호가 없어요.')
+        # 기억해둔 값(Definitions)도 숫자만 맞으니까 배열/이중수는 원래 본문으로 계산함
+        if value.body is None or (isinstance(value, ReactiveSymbol) and
+                                  backend is pythonBackend):
+          return value.value(interpret, context)
+        return compiledBody(value, backend)(context)
+      return value
+
+    return symbol
 
   elif isinstance(node, Contexted):
-    return interpret(node.node, {**context, **node.contexts})
+    contexts = node.contexts
+    inner = compileNode(node.node, backend)
+    return lambda context: inner({**context, **contexts})
 
   elif isinstance(node, Group):
-    return interpret(node.node, context)
+    return compileNode(node.node, backend)
+
   else:
-    raise Exception(f'Unknown node type {type(node)}')
+    return compileError(f'Unknown node type {type(node)}')
 
 
-def main():
-  context = {}
+# %% [markdown]
+# ### numpy로 한꺼번에 계산하기
+
+# %%
+# x에 숫자 하나 대신 numpy 배열을 넣으면 f(x)를 배열 전체에 대해 한 번에 계산함.
+# +, -, *, / 같은 연산자는 numpy 배열에도 그대로 쓸 수 있으니까, 내장함수만 numpy 함수(ufunc)로 바꿔주면 됨.
+# 이러면 트리는 딱 한 번만 훑고 실제 계산은 numpy가 C로 해줌. (점 백만 개 = 트리 한 번)
+#
+# f = vectorize(parseMathToAst('Let f(t) = sin(t) * t, f(x) + 1'))
+# f({'x': np.linspace(0, 1, 1000000)})  # 길이 1000000짜리 배열
+#
+# 주의: numpy는 0으로 나누거나 asin(2)처럼 정의역을 벗어나도 오류 대신 inf/nan을 돌려줌
+try:
+  import numpy as np
+except ImportError:  # numpy가 없어도 나머지 기능은 쓸 수 있게
+  np = None
+
+if np is not None:
+  numpyBackend = Backend(
+      'numpy',
+      {
+          'sin': np.sin,
+          'cos': np.cos,
+          'tan': np.tan,
+          'asin': np.arcsin,
+          'asinh': np.arcsinh,
+          'acos': np.arccos,
+          'acosh': np.arccosh,
+          'atan': np.arctan,
+          'atan2': np.arctan2,
+          'atanh': np.arctanh,
+          'ceil': np.ceil,
+          'floor': np.floor,
+          'round': np.round,
+          'log': np.log10,
+          # ln(x, 밑)도 되게 builtinCallables의 math.log와 맞춤 (np.log에 인수를 하나 더 주면 결과를 담을 배열(out)로 받음)
+          'ln': lambda x, base=None: np.log(x)
+                if base is None else np.log(x) / np.log(base)
+      },
+      unaryOperators={
+          **compiledUnaryOperators,
+          # not은 배열에 쓸 수 없음
+          '~': lambda value: lambda context: np.logical_not(value(context))
+      })
+else:
+  numpyBackend = None
+
+
+def vectorize(node: Node) -> Callable[[dict], Any]:
+  if numpyBackend is None:
+    raise Exception('배열로 계산하려면 numpy가 필요해요. (pip install numpy)')
+
+  compiled = compile(node, numpyBackend)
+
+  def evaluate(context):
+    # 리스트로 넘겨줘도 numpy 배열로 바꿔서 계산함
+    arrays = {}
+    for name, value in context.items():
+      if isinstance(value, (list, tuple)):
+        value = np.asarray(value, dtype=float)
+      arrays[name] = value
+    return compiled(arrays)
+
+  return evaluate
+
+
+# %% [markdown]
+# ### 자동 미분 (이중수)
+
+# %%
+# 수식을 x로 미분한 값이 필요할 때 (f(x + h) - f(x - h)) / 2h처럼 구하면 변수마다 두 번씩 더 계산해야 하고,
+# h를 얼마로 잡느냐에 따라 오차도 생김.
+# 이중수(dual number) a + a'ε (ε² = 0)로 계산하면 한 번에 값과 미분값을 정확하게 같이 구할 수 있음:
+#   (a + a'ε) * (b + b'ε) = ab + (a'b + ab')ε  <- 곱의 미분법 그대로
+# Dual은 값(value)과 '고른 기호마다의 미분값'(derivatives)을 들고 다니고,
+# 연산자와 내장함수가 미분 공식대로 다음 Dual을 만듦. 사용자 함수는 본문을 그대로 이중수로 계산하면 됨.
+#
+# value, gradient = differentiate(parseMathToAst('Let f(t) = t ^ 2, f(x) * y'),
+#                                 {'x': 3, 'y': 2}, ['x', 'y'])
+# value = 18, gradient = {'x': 12, 'y': 9}
+#
+# x, y에 numpy 배열을 넣으면 배열 전체의 값과 미분값을 한꺼번에 구함 (vectorize()처럼)
+
+
+class Dual:
+  __slots__ = ('value', 'derivatives')
+  # numpy 배열 + Dual을 numpy가 원소마다 계산하지 않고 Dual.__radd__ 등에게 넘기게 함
+  __array_ufunc__ = None
+
+  value: Any  # 숫자나 numpy 배열
+  derivatives: tuple  # 고른 기호마다의 미분값
+
+  def __init__(self, value, derivatives: tuple):
+    self.value = value
+    self.derivatives = derivatives
+
+  def __repr__(self) -> str:
+    return f'Dual({self.value}, {self.derivatives})'
+
+  def __add__(self, other):
+    return dualAdd(self, other)
+
+  def __radd__(self, other):
+    return dualAdd(other, self)
+
+  def __sub__(self, other):
+    return dualSubtract(self, other)
+
+  def __rsub__(self, other):
+    return dualSubtract(other, self)
+
+  def __mul__(self, other):
+    return dualMultiply(self, other)
+
+  def __rmul__(self, other):
+    return dualMultiply(other, self)
+
+  def __truediv__(self, other):
+    return dualDivide(self, other)
+
+  def __rtruediv__(self, other):
+    return dualDivide(other, self)
+
+  def __mod__(self, other):
+    return dualModulo(self, other)
+
+  def __rmod__(self, other):
+    return dualModulo(other, self)
+
+  def __pow__(self, other):
+    return dualPower(self, other)
+
+  def __rpow__(self, other):
+    return dualPower(other, self)
+
+  def __neg__(self):
+    return dualOf(-self.value, (-1, self))
+
+  def __pos__(self):
+    return self
+
+  # ~x (not x): 참/거짓은 미분할 게 없으니까 값만 봄
+  def __bool__(self):
+    return bool(self.value)
+
+
+def valueOf(value):
+  return value.value if isinstance(value, Dual) else value
+
+
+# 값이 value이고 미분값은 (계수 * 피연산자의 미분값)들의 합인 Dual을 만듦. 연쇄법칙 그 자체
+# 피연산자가 전부 Dual이 아니면 (고른 기호와 상관없는 값이면) 그냥 값을 돌려줌
+def dualOf(value, *terms):
+  derivatives = None
+  for coefficient, operand in terms:
+    if not isinstance(operand, Dual):
+      continue
+    scaled = [coefficient * derivative for derivative in operand.derivatives]
+    if derivatives is None:
+      derivatives = scaled
+    else:
+      derivatives = [a + b for a, b in zip(derivatives, scaled)]
+
+  if derivatives is None:
+    return value
+  return Dual(value, tuple(derivatives))
+
+
+def dualAdd(a, b):
+  return dualOf(valueOf(a) + valueOf(b), (1, a), (1, b))
+
+
+def dualSubtract(a, b):
+  return dualOf(valueOf(a) - valueOf(b), (1, a), (-1, b))
+
+
+def dualMultiply(a, b):
+  x, y = valueOf(a), valueOf(b)
+  return dualOf(x * y, (y, a), (x, b))
+
+
+def dualDivide(a, b):
+  x, y = valueOf(a), valueOf(b)
+  return dualOf(x / y, (1 / y, a), (-x / (y * y), b))
+
+
+# a % b = a - b * floor(a / b)
+def dualModulo(a, b):
+  x, y = valueOf(a), valueOf(b)
+  rest = x % y
+  return dualOf(rest, (1, a), (-(x - rest) / y, b))
+
+
+# a ^ b의 미분: b * a ^ (b - 1) * a' + a ^ b * ln(a) * b'
+# 상수인 쪽의 항은 계산하지 않음 (0 ^ x나 (0 - 2) ^ x에서 쓰지도 않을 0 ^ (x - 1), ln(-2)로 오류가 나지 않게)
+def dualPower(a, b):
+  x, y = valueOf(a), valueOf(b)
+  value = x**y
+  terms = []
+  if isinstance(a, Dual):
+    terms.append((powerSlope(x, y), a))
+  if isinstance(b, Dual):
+    terms.append((powerLogSlope(value, x), b))
+  return dualOf(value, *terms)
+
+
+# x ^ y를 x로 미분한 값: y * x ^ (y - 1). x = 0에서 y < 1이면 (x ^ 0.5 등) 기울기가 끝없이 커지니까 inf
+def powerSlope(x, y):
+  if np is not None and isinstance(x, np.ndarray):
+    with np.errstate(all='ignore'):
+      return y * x**(y - 1)
+  try:
+    return y * x**(y - 1)
+  except ZeroDivisionError:
+    return math.inf
+
+
+# x ^ y를 y로 미분한 값: x ^ y * ln(x). ln(x)가 없는 곳은 오류 대신
+# - x = 0: 0 ^ y는 y > 0에서 계속 0이니까 0 (y = 0이면 끊어지니까 nan)
+# - x < 0: nan
+def powerLogSlope(value, x):
+  if np is not None and isinstance(x, np.ndarray):
+    with np.errstate(all='ignore'):
+      slope = value * np.log(x)
+      return np.where(x == 0, np.where(value == 0, 0.0, np.nan), slope)
+  if x == 0:
+    return 0.0 if value == 0 else math.nan
+  if x < 0:
+    return math.nan
+  return value * math.log(x)
+
+
+# 내장함수 이름 -> 도함수. functions는 backend의 내장함수들 (math나 numpy)
+dualDerivatives = {
+    'sin': lambda functions, x: functions['cos'](x),
+    'cos': lambda functions, x: -functions['sin'](x),
+    'tan': lambda functions, x: 1 / functions['cos'](x)**2,
+    'asin': lambda functions, x: (1 - x * x)**-0.5,
+    'asinh': lambda functions, x: (x * x + 1)**-0.5,
+    'acos': lambda functions, x: -(1 - x * x)**-0.5,
+    'acosh': lambda functions, x: (x * x - 1)**-0.5,
+    'atan': lambda functions, x: 1 / (1 + x * x),
+    'atanh': lambda functions, x: 1 / (1 - x * x),
+    # 계단 모양이라 끊어지는 곳 말고는 기울기가 0
+    'ceil': lambda functions, x: 0 * x,
+    'floor': lambda functions, x: 0 * x,
+    'round': lambda functions, x: 0 * x,
+    'log': lambda functions, x: 1 / (x * math.log(10)),
+    'ln': lambda functions, x: 1 / x,
+}
+
+
+# 인수 하나짜리 내장함수를 이중수로 계산하는 함수 (round(x, 2)의 2처럼 뒤의 인수는 미분하지 않음)
+def dualFunction(functions: dict, name: str):
+  function = functions[name]
+  derivative = dualDerivatives[name]
+
+  def calculate(x, *rest):
+    value = function(valueOf(x), *[valueOf(arg) for arg in rest])
+    if not isinstance(x, Dual):
+      return value
+    return dualOf(value, (derivative(functions, x.value), x))
+
+  return calculate
+
+
+# backend의 내장함수들(builtinCallables 모양)을 이중수용으로 바꿈
+def dualFunctionsOf(functions: dict) -> dict:
+  duals = {name: dualFunction(functions, name) for name in dualDerivatives}
+
+  # ln(x, 밑) = ln(x) / ln(밑)
+  ln = duals['ln']
+  duals['ln'] = lambda x, *base: ln(x) if not base else dualDivide(
+      ln(x), ln(base[0]))
+
+  atan2 = functions['atan2']
+
+  def dualAtan2(a, b):
+    y, x = valueOf(a), valueOf(b)
+    squared = x * x + y * y
+    return dualOf(atan2(y, x), (x / squared, a), (-y / squared, b))
+
+  duals['atan2'] = dualAtan2
+  return duals
+
+
+# 연산자는 Dual이 +, -, *, ... 를 직접 구현하니까 그대로 씀
+dualBackend = Backend('dual', dualFunctionsOf(builtinCallables))
+
+if np is not None:
+  dualNumpyBackend = Backend(
+      'dualNumpy',
+      dualFunctionsOf(numpyBackend.functions),
+      unaryOperators={
+          **compiledUnaryOperators,
+          '~': lambda value: lambda context: np.logical_not(
+              valueOf(value(context)))
+      })
+else:
+  dualNumpyBackend = None
+
+
+# node를 names의 기호들로 미분하는 함수를 만듦: 함수(context) -> (값, {기호: 미분값})
+def gradientOf(node: Node, names: List[str]) -> Callable[[dict], Tuple[Any, dict]]:
+  names = list(names)
+  compiled = {}  # backend 이름 -> 컴파일한 함수 (배열을 처음 받을 때 numpy용을 만듦)
+
+  def gradient(context):
+    context = dict(context)
+    arrays = False
+    for name, value in context.items():
+      if isinstance(value, (list, tuple)) or (np is not None and
+                                              isinstance(value, np.ndarray)):
+        if dualNumpyBackend is None:
+          raise Exception('배열로 미분하려면 numpy가 필요해요. (pip install numpy)')
+        context[name] = np.asarray(value, dtype=float)
+        arrays = True
+    backend = dualNumpyBackend if arrays else dualBackend
+
+    for index, name in enumerate(names):
+      if name not in context:
+        raise Exception(f'{name}라는 기호가 없어요.')
+      if isinstance(context[name], Context):
+        raise Exception(f'미분할 기호에는 숫자나 배열을 넣어야 해요: {name}')
+      seed = [0.0] * len(names)
+      seed[index] = 1.0
+      context[name] = Dual(context[name], tuple(seed))
+
+    if backend.name not in compiled:
+      compiled[backend.name] = compile(node, backend)
+    result = compiled[backend.name](context)
+
+    value = valueOf(result)
+    if isinstance(result, Dual):
+      derivatives = result.derivatives
+    else:  # 고른 기호와 상관없는 값
+      derivatives = [0.0] * len(names)
+    if arrays:  # 미분값도 값과 같은 모양의 배열로
+      derivatives = [np.zeros(np.shape(value)) + d for d in derivatives]
+    return value, dict(zip(names, derivatives))
+
+  return gradient
+
+
+def differentiate(node: Node, context: dict,
+                  names: List[str]) -> Tuple[Any, dict]:
+  return gradientOf(node, names)(context)
+
+
+# %% [markdown]
+# ### 방정식 풀기
+
+# %%
+# x ^ 2 = 2 같은 등식은 interpret()로 계산할 수 없으니까 (= 연산자가 없음), '좌변 - 우변'이 0이 되는 x(근)를 찾음.
+# 1.  근이 있는 구간 [lower, upper] 찾기: 양 끝에서 좌변 - 우변의 부호가 다르면 그 사이에 근이 있음.
+#     구간을 안 주면 guess에서 1, 2, 4, 8, ...만큼 양쪽으로 넓혀가며 부호가 바뀌는 곳을 찾음
+# 2.  구간 안에서 뉴턴 방법: x에서 x - f(x) / f'(x)로 감. 미분값은 이중수로 값과 같이 구함
+#     뉴턴 방법이 구간 밖으로 튀거나, 미분값이 0이거나, 지난번보다 반도 안 줄어들면 그 번에는 구간을 반으로 자름 (이분법)
+#     → 구간이 계속 줄어드니까 반드시 끝나고, 근 근처에서는 뉴턴 방법처럼 빠르게 수렴함
+#
+# solve(parseMathToAst('x ^ 2 = 2'))  # 1.4142135623730951
+# solveMany(parseMathToAst('x ^ 2 = a'), {'a': np.arange(1, 1000)})  # 방정식 999개를 배열째 한꺼번에
+#
+# 닿기만 하고 부호가 바뀌지 않는 근(x ^ 2 = 0에서 guess가 0이 아닐 때 등)은 찾지 못함
+
+
+# Let a = 2, x ^ 2 = a처럼 Let으로 감싼 등식에서 (Let 정의들, 좌변, 우변)을 꺼냄
+def equationOf(node: Node) -> Tuple[dict, Node, Node]:
+  contexts = {}
+  while isinstance(node, (Contexted, Group)):
+    if isinstance(node, Contexted):
+      contexts = {**contexts, **node.contexts}  # 안쪽 정의가 이김 (interpret()와 같음)
+    node = node.node
+
+  if not isinstance(node, BinaryOperator) or node.operator != '=':
+    raise Exception(f'좌변 = 우변 모양의 등식이 아니에요: {node}')
+  return contexts, node.left, node.right
+
+
+# 등식에서 값이 정해지지 않은 이름들 (내장 기호, Let으로 정의한 것, context에 있는 것은 뺌)
+def unknownsOf(node: Node, context: dict) -> Set[str]:
+  contexts, left, right = equationOf(node)
+  bound = set(contexts) | set(context)
+  names = set(freeNamesIn(left, bound)) | set(freeNamesIn(right, bound))
+  for value in contexts.values():
+    if value.body is not None:
+      parameters = value.parameters if isinstance(value, Function) else None
+      names |= freeNamesIn(value.body, bound | set(parameters or []))
+  return names
+
+
+# 미지수 name에 값을 넣으면 (좌변 - 우변, 그 미분값)을 돌려주는 함수를 만듦
+def residualOf(node: Node, context: Optional[dict], name: str,
+               backend: Backend) -> Callable[[Any], Tuple[Any, Any]]:
+  contexts, left, right = equationOf(node)
+  if name in contexts:
+    raise Exception(f'{name}은 Let으로 정의돼 있어서 풀 수 없어요.')
+  left = compile(left, backend)
+  right = compile(right, backend)
+  scope = {**(context or {}), **contexts}
+
+  def residual(x):
+    scope[name] = Dual(x, (1.0,))
+    value = left(scope) - right(scope)
+    if isinstance(value, Dual):
+      return value.value, value.derivatives[0]
+    return value, 0 * value  # 미지수와 상관없는 등식
+
+  return residual
+
+
+def isEquation(node: Node) -> bool:
+  try:
+    equationOf(node)
+  except Exception:
+    return False
+  return True
+
+
+def solve(node: Node,
+          context: Optional[dict] = None,
+          name: str = 'x',
+          lower: Optional[float] = None,
+          upper: Optional[float] = None,
+          guess: float = 0.0,
+          tolerance: float = 1e-12,
+          maxIterations: int = 200) -> float:
+  residual = residualOf(node, context, name, dualBackend)
+
+  # 계산이 안 되는 곳(ln(-1) 등)은 nan으로 보고 넘어감
+  def valueAt(x):
+    try:
+      value = residual(x)[0]
+    except (ArithmeticError, ValueError):
+      return math.nan
+    return value if isinstance(value, (int, float)) else math.nan
+
+  if lower is None or upper is None:
+    lower, upper = bracketOf(valueAt, guess, name)
+
+  fLower = valueAt(lower)
+  fUpper = valueAt(upper)
+  if fLower == 0:
+    return lower
+  if fUpper == 0:
+    return upper
+  if not fLower * fUpper < 0:
+    raise Exception(f'{lower}와 {upper}에서 좌변 - 우변의 부호가 달라야 그 사이에 근이 있어요.')
+  if fLower > 0:  # lower는 좌변 - 우변이 음수인 쪽
+    lower, upper = upper, lower
+  # 1 / (x - 1) = 0처럼 극(pole)을 사이에 두고도 부호가 바뀌니까, 찾은 x에서 |좌변 - 우변|이
+  # 양 끝보다 작아졌는지 다시 봄
+  fStart = min(abs(fLower), abs(fUpper))
+
+  x = (lower + upper) / 2
+  previousStep = abs(upper - lower)
+  for _ in range(maxIterations):
+    try:
+      f, slope = residual(x)
+    except (ArithmeticError, ValueError):
+      raise Exception(f'{name}의 근을 찾지 못했어요. ({name} = {x}에서 계산할 수 없어요)')
+    if f == 0:
+      return x
+    if f < 0:
+      lower = x
+    else:
+      upper = x
+
+    candidate = x - f / slope if slope else math.nan
+    if not min(lower, upper) < candidate < max(lower, upper) or abs(
+        candidate - x) > previousStep / 2:
+      candidate = (lower + upper) / 2  # 이분법
+
+    step = abs(candidate - x)
+    if step <= tolerance * max(1.0, abs(x)):
+      if not abs(valueAt(candidate)) < fStart:
+        raise Exception(f'{name}의 근을 찾지 못했어요. ({name} = {candidate} 근처는 근이 아니라 극이에요)')
+      return candidate
+    x = candidate
+    previousStep = step
+
+  raise Exception(f'{maxIterations}번 안에 {name}의 근을 찾지 못했어요.')
+
+
+# guess에서 양쪽으로 1, 2, 4, ...씩 넓혀가며 부호가 바뀌는 구간을 찾음
+def bracketOf(valueAt, guess: float, name: str, expansions: int = 64):
+  start = valueAt(guess)
+  if start == 0:
+    return guess, guess
+  previous = {1: (guess, start), -1: (guess, start)}
+
+  step = 1.0
+  for _ in range(expansions):
+    for direction in (1, -1):
+      x = guess + direction * step
+      f = valueAt(x)
+      px, pf = previous[direction]
+      if f == 0 or f * pf < 0:
+        return min(px, x), max(px, x)
+      if not math.isnan(f):
+        previous[direction] = (x, f)
+    step *= 2
+
+  raise Exception(f'{name}의 근이 있는 구간을 찾지 못했어요. lower와 upper를 직접 정해주세요.')
+
+
+# 매개변수(context의 배열)마다 다른 방정식 여러 개를 numpy 배열째 한꺼번에 풂.
+# 하는 일은 solve()와 같은데, 원소마다 구간/위치를 따로 들고 있고 다 풀릴 때까지 모두 같이 계산함.
+# 근을 못 찾은 원소는 nan
+def solveMany(node: Node,
+              context: dict,
+              name: str = 'x',
+              lower=None,
+              upper=None,
+              guess=0.0,
+              tolerance: float = 1e-12,
+              maxIterations: int = 200) -> 'np.ndarray':
+  if dualNumpyBackend is None:
+    raise Exception('여러 방정식을 한꺼번에 풀려면 numpy가 필요해요. (pip install numpy)')
+
+  context = {
+      key: np.asarray(value, dtype=float) if isinstance(value,
+                                                        (list, tuple)) else value
+      for key, value in context.items()
+  }
+  residual = residualOf(node, context, name, dualNumpyBackend)
+
+  with np.errstate(all='ignore'):  # 계산이 안 되는 곳은 nan으로 두고 넘어감
+
+    def valuesAt(x):
+      return np.broadcast_to(residual(x)[0], x.shape).astype(float)
+
+    shape = np.broadcast_shapes(
+        np.shape(residual(np.asarray(guess, dtype=float))[0]), np.shape(guess),
+        np.shape(lower), np.shape(upper))
+
+    if lower is None or upper is None:
+      lower, upper = bracketsOf(valuesAt, guess, shape)
+    lower = np.broadcast_to(np.asarray(lower, dtype=float), shape).copy()
+    upper = np.broadcast_to(np.asarray(upper, dtype=float), shape).copy()
+
+    roots = np.full(shape, np.nan)
+    fLower = valuesAt(lower)
+    fUpper = valuesAt(upper)
+    roots[fUpper == 0] = upper[fUpper == 0]
+    roots[fLower == 0] = lower[fLower == 0]
+    active = fLower * fUpper < 0
+    fStart = np.minimum(np.abs(fLower), np.abs(fUpper))  # 극 걸러내기: solve()와 같음
+
+    swap = fLower > 0  # lower는 좌변 - 우변이 음수인 쪽
+    lower, upper = np.where(swap, upper, lower), np.where(swap, lower, upper)
+
+    x = (lower + upper) / 2
+    previousStep = np.abs(upper - lower)
+    for _ in range(maxIterations):
+      if not active.any():
+        break
+      f, slope = residual(x)
+      f = np.broadcast_to(f, shape)
+      slope = np.broadcast_to(slope, shape)
+
+      zero = active & (f == 0)
+      roots[zero] = x[zero]
+      active &= ~zero
+
+      negative = f < 0
+      lower = np.where(active & negative, x, lower)
+      upper = np.where(active & ~negative, x, upper)
+
+      candidate = x - f / slope
+      inside = (np.minimum(lower, upper) < candidate) & (candidate < np.maximum(
+          lower, upper))
+      bisect = ~inside | (np.abs(candidate - x) > previousStep / 2)
+      candidate = np.where(bisect, (lower + upper) / 2, candidate)
+
+      step = np.abs(candidate - x)
+      converged = active & (step <= tolerance * np.maximum(1.0, np.abs(x)))
+      roots[converged] = candidate[converged]
+      active &= ~converged
+      x = np.where(active, candidate, x)
+      previousStep = np.where(active, step, previousStep)
+
+    pole = ~(np.abs(valuesAt(roots)) < fStart) & ~np.isnan(roots)
+    pole &= ~((fLower == 0) | (fUpper == 0))
+    roots[pole] = np.nan
+
+  return roots
+
+
+# bracketOf()를 원소마다 한꺼번에: 못 찾은 원소는 (nan, nan)
+def bracketsOf(valuesAt, guess, shape, expansions: int = 64):
+  guess = np.broadcast_to(np.asarray(guess, dtype=float), shape)
+  lower = np.full(shape, np.nan)
+  upper = np.full(shape, np.nan)
+
+  start = valuesAt(guess)
+  found = start == 0
+  lower[found] = upper[found] = guess[found]
+  previous = {1: (guess.copy(), start.copy()), -1: (guess.copy(), start.copy())}
+
+  step = 1.0
+  for _ in range(expansions):
+    if found.all():
+      break
+    for direction in (1, -1):
+      x = guess + direction * step
+      f = valuesAt(x)
+      px, pf = previous[direction]
+      hit = ~found & ((f == 0) | (f * pf < 0))
+      lower[hit] = np.minimum(px, x)[hit]
+      upper[hit] = np.maximum(px, x)[hit]
+      found |= hit
+      finite = ~np.isnan(f)
+      px[finite] = x[finite]
+      pf[finite] = f[finite]
+    step *= 2
+
+  return lower, upper
+
+
+# %% [markdown]
+# ### 최적화
+
+# %%
+# 받는 수식에는 2 * pi / 360처럼 전부 상수인 부분이나 x * 1, x + 0 같은 쓸데없는 계산이 많은데,
+# interpret()는 이걸 계산할 때마다 매번 다시 계산함.
+# optimize()는 계산하기 전에 트리를 한 번 훑어서
+# - 상수끼리의 연산, pi/e 같은 내장 상수, 상수를 넣은 내장함수(sin(pi / 4) 등)를 미리 계산해서 숫자 하나로 바꾸고
+# - x * 1, 1 * x, x / 1, x + 0, 0 + x, x - 0, x ^ 1, +x, --x를 x로 바꿈
+# 미리 계산한 숫자 노드는 원래 부분의 토큰 범위를 그대로 가지고 있어서 오류 메시지에 쓸 수 있음.
+#
+# 결과는 숫자로서 같음 (== 비교). 단, 1 / 0이나 asin(2)처럼 계산하면 오류가 나는 부분은
+# 그대로 두어서 원래처럼 계산할 때 오류가 나게 함. floor(9) ^ floor(999999999)처럼 값이 float보다 커지는 부분도
+# 미리 계산하다 멈춰버리지 않게 그대로 둠 (계산할 때 Budget으로 막을 수 있게).
+# x * 0 -> 0 같은 건 x가 inf/nan이거나 없는 기호일 때 결과가 달라지니까 하지 않음
+
+
+# 노드 개수: Let으로 정의한 함수의 우변까지 셈
+def countNodes(node: Node) -> int:
+  count = 0
+  stack = [node]
+  while stack:
+    current = stack.pop()
+    count += 1
+    stack.extend(current.children())
+    if isinstance(current, Contexted):
+      for value in current.contexts.values():
+        if value.body is not None:
+          stack.append(value.body)
+    elif isinstance(current, Definition) and current.target.body is not None:
+      stack.append(current.target.body)
+  return count
+
+
+class OptimizeStats:
+  folded: int  # 미리 계산해서 숫자 하나로 바꾼 부분의 개수
+  simplified: int  # x * 1 -> x처럼 없앤 연산의 개수
+  nodesBefore: int
+  nodesAfter: int
+
+  def __init__(self):
+    self.folded = 0
+    self.simplified = 0
+    self.nodesBefore = 0
+    self.nodesAfter = 0
+
+  # 없어진 노드 개수
+  @property
+  def removed(self) -> int:
+    return self.nodesBefore - self.nodesAfter
+
+  def __repr__(self) -> str:
+    return (f'OptimizeStats(folded={self.folded}, simplified={self.simplified}, '
+            f'removed={self.removed}/{self.nodesBefore})')
+
+
+def isNumber(node: Node, value) -> bool:
+  return isinstance(node, Number) and node.number == value
+
+
+# 상수로만 이루어진 노드를 계산해서 숫자 노드로 바꿈. 계산하다 오류가 나거나 값이 너무 크면 그대로 둠
+def fold(node: Node, stats: OptimizeStats) -> Node:
+  try:
+    value = interpret(node, {}, Budget(maxMagnitude=sys.float_info.max))
+  except Exception:
+    return node
+  stats.folded += 1
+  return Number(node.tokens, value)
+
+
+# x * 1처럼 한쪽이 이 숫자면 다른 쪽만 남겨도 되는 경우: 연산자 -> (왼쪽 숫자, 오른쪽 숫자)
+identityOperands = {
+    '+': (0, 0),
+    '-': (None, 0),
+    '*': (1, 1),
+    '/': (None, 1),
+    '^': (None, 1)
+}
+
+
+# Let으로 정의한 함수/기호의 우변만 body로 바꾼 것
+def withBody(value, body: Node):
+  if isinstance(value, Function):
+    return userFunction(value.parameters, body)
+  return userSymbol(body)
+
+
+# 먼저 최적화할 자식 노드들. Let 블록은 안쪽 수식만 (정의들은 안쪽 수식이 숫자가 아닐 때만 최적화함)
+def optimizeChildren(node: Node) -> list:
+  if isinstance(node, (Group, Contexted)):
+    return [node.node]
+  elif isinstance(node, UnaryOperator):
+    return [node.value]
+  elif isinstance(node, BinaryOperator):
+    return [node.left, node.right]
+  elif isinstance(node, FunctionValue):
+    return list(node.args)
+  elif isinstance(node, Definition) and node.target.body is not None:
+    return [node.target.body]
+  return []
+
+
+definitionsTask = object()  # 바로 밑의 Let 블록은 정의들의 우변까지 최적화했으니 합침
+
+
+# 재귀로 돌면 ((((...))))처럼 아주 깊은 수식에서 재귀 한도에 걸리니까 evaluateDeep()처럼 할 일을 tasks에 쌓아두고 돎.
+# 자식들을 먼저 최적화해서 results에 넣어두고, combineTask를 꺼내면 그 노드의 자식들을 results에서 꺼내서 합침
+def optimizeNode(node: Node, stats: OptimizeStats) -> Node:
+  tasks = [node]
+  results = []
+
+  while tasks:
+    node = tasks.pop()
+
+    if node is combineTask:
+      node = tasks.pop()
+      first = len(results) - len(optimizeChildren(node))
+      children = results[first:]
+      del results[first:]
+
+      if isinstance(node, Contexted) and not isinstance(children[0], Number):
+        # 안쪽 수식은 results에 두고 정의들의 우변을 최적화하러 감
+        results.append(children[0])
+        tasks.append(node)
+        tasks.append(definitionsTask)
+        tasks.extend(
+            reversed([
+                value.body for value in node.contexts.values()
+                if value.body is not None
+            ]))
+      else:
+        results.append(optimizeCombine(node, children, stats))
+
+    elif node is definitionsTask:
+      node = tasks.pop()
+      first = len(results) - sum(
+          value.body is not None for value in node.contexts.values())
+      bodies = iter(results[first:])
+      del results[first:]
+      contexts = {
+          name: value if value.body is None else withBody(value, next(bodies))
+          for name, value in node.contexts.items()
+      }
+      results.append(Contexted(node.tokens, contexts, results.pop()))
+
+    elif isinstance(node, Number):
+      results.append(node)
+
+    elif isinstance(node, Symbol):
+      if node.symbol in builtinSymbols:  # pi, e는 context보다 먼저 찾으니까 항상 상수
+        stats.folded += 1
+        results.append(Number(node.tokens, builtinSymbols[node.symbol]))
+      else:
+        results.append(node)
+
+    else:
+      tasks.append(node)
+      tasks.append(combineTask)
+      tasks.extend(reversed(optimizeChildren(node)))
+
+  return results.pop()
+
+
+# 자식들을 최적화한 결과(children)로 노드 하나를 최적화함
+def optimizeCombine(node: Node, children: list, stats: OptimizeStats) -> Node:
+  if isinstance(node, Group):  # 괄호는 트리 모양에 이미 들어있어서 없어도 됨
+    return children[0]
+
+  elif isinstance(node, UnaryOperator):
+    value, = children
+    if isinstance(value, Number):
+      return fold(UnaryOperator(node.tokens, value, node.operator), stats)
+    if node.operator == '+':
+      stats.simplified += 1
+      return value
+    if (node.operator == '-' and isinstance(value, UnaryOperator)
+        and value.operator == '-'):
+      stats.simplified += 2
+      return value.value
+    if value is node.value:
+      return node
+    return UnaryOperator(node.tokens, value, node.operator)
+
+  elif isinstance(node, BinaryOperator):
+    left, right = children
+    operator = node.operator
+    if isinstance(left, Number) and isinstance(right, Number):
+      return fold(BinaryOperator(node.tokens, left, right, operator), stats)
+
+    if operator in identityOperands:
+      leftIdentity, rightIdentity = identityOperands[operator]
+      if rightIdentity is not None and isNumber(right, rightIdentity):
+        stats.simplified += 1
+        return left
+      if leftIdentity is not None and isNumber(left, leftIdentity):
+        stats.simplified += 1
+        return right
+
+    if left is node.left and right is node.right:
+      return node
+    return BinaryOperator(node.tokens, left, right, operator)
+
+  elif isinstance(node, FunctionValue):
+    function = FunctionValue(node.tokens, node.name, children)
+    if node.name in builtinFunctions and all(
+        isinstance(arg, Number) for arg in children):
+      return fold(function, stats)
+    if all(new is old for new, old in zip(children, node.args)):
+      return node
+    return function
+
+  elif isinstance(node, Contexted):  # 정의한 것들을 하나도 안 씀 (안쪽 수식이 숫자)
+    return Number(node.tokens, children[0].number)
+
+  elif isinstance(node, Definition):
+    target = node.target
+    if target.body is not None:
+      target = withBody(target, children[0])
+    return Definition(node.tokens, node.name, target)
+
+  return node
+
+
+def optimize(node: Node, stats: Optional[OptimizeStats] = None) -> Node:
+  if stats is None:
+    stats = OptimizeStats()
+  stats.nodesBefore += countNodes(node)
+  result = optimizeNode(node, stats)
+  stats.nodesAfter += countNodes(result)
+  return result
+
+
+# %% [markdown]
+# ### 같은 부분식 합치기
+
+# %%
+# sin(x) * sin(x) + cos(x) * sin(x)처럼 같은 부분식이 여러 번 나오면 interpret()는 sin(x)를 세 번 계산함.
+# 파서는 트리를 만들기 때문에 같은 모양이어도 노드가 따로따로 있기 때문.
+# ExpressionDag.intern()은 모양이 같은 노드를 하나로 합쳐서 트리를 DAG(여러 부모가 한 노드를 같이 쓰는 그래프)로 만들고,
+# interpretShared()는 한 context 안에서 같은 노드는 한 번만 계산해서 재사용함.
+#
+# 합쳐진 노드는 처음 나온 것의 토큰 범위를 가짐.
+# Let 정의 안과 밖의 x는 같은 노드여도 context가 다르니까 계산 결과는 context마다 따로 기억함.
+class ExpressionDag:
+  # 모양 -> 노드. 자식들은 이미 합쳐져 있으니까 자식 노드의 id만 봐도 모양이 같은지 알 수 있음
+  table: dict
+  visited: int  # intern()이 본 노드 개수
+  shared: int  # 이미 있는 노드로 바꾼 개수
+
+  def __init__(self):
+    self.table = {}
+    self.visited = 0
+    self.shared = 0
+
+  def unique(self, key, node: Node) -> Node:
+    self.visited += 1
+    existing = self.table.get(key)
+    if existing is not None:
+      self.shared += 1
+      return existing
+    self.table[key] = node
+    return node
+
+  # intern()에서 먼저 합칠 자식 노드들. Let 정의의 우변은 안쪽 수식보다 먼저 합침
+  @staticmethod
+  def parts(node: Node) -> list:
+    if isinstance(node, UnaryOperator):
+      return [node.value]
+    elif isinstance(node, BinaryOperator):
+      return [node.left, node.right]
+    elif isinstance(node, FunctionValue):
+      return list(node.args)
+    elif isinstance(node, Contexted):
+      return [
+          value.body
+          for value in node.contexts.values()
+          if value.body is not None
+      ] + [node.node]
+    elif isinstance(node, Definition) and node.target.body is not None:
+      return [node.target.body]
+    return []
+
+  # 아주 깊은 수식도 합칠 수 있게 optimizeNode()처럼 할 일을 tasks에 쌓아두고 돎
+  def intern(self, node: Node) -> Node:
+    tasks = [node]
+    results = []
+
+    while tasks:
+      node = tasks.pop()
+
+      if node is combineTask:
+        node = tasks.pop()
+        first = len(results) - len(self.parts(node))
+        parts = results[first:]
+        del results[first:]
+        results.append(self.combine(node, parts))
+
+      elif isinstance(node, Number):
+        # repr로 비교해야 -0.0과 0.0, True와 1.0이 섞이지 않음
+        results.append(self.unique(('number', repr(node.number)), node))
+
+      elif isinstance(node, Symbol):
+        results.append(self.unique(('symbol', node.symbol), node))
+
+      elif isinstance(node, Group):
+        tasks.append(node.node)
+
+      elif isinstance(node, (UnaryOperator, BinaryOperator, FunctionValue,
+                             Contexted, Definition)):
+        tasks.append(node)
+        tasks.append(combineTask)
+        tasks.extend(reversed(self.parts(node)))
+
+      else:
+        results.append(node)
+
+    return results.pop()
+
+  # 자식들을 합친 결과(parts)로 노드 하나를 합침
+  def combine(self, node: Node, parts: list) -> Node:
+    if isinstance(node, UnaryOperator):
+      value, = parts
+      return self.unique(('unary', node.operator, id(value)),
+                         UnaryOperator(node.tokens, value, node.operator))
+
+    elif isinstance(node, BinaryOperator):
+      left, right = parts
+      return self.unique(
+          ('binary', node.operator, id(left), id(right)),
+          BinaryOperator(node.tokens, left, right, node.operator))
+
+    elif isinstance(node, FunctionValue):
+      return self.unique(('call', node.name, *[id(arg) for arg in parts]),
+                         FunctionValue(node.tokens, node.name, parts))
+
+    elif isinstance(node, Contexted):
+      bodies = iter(parts)
+      contexts = {
+          name: value if value.body is None else withBody(value, next(bodies))
+          for name, value in node.contexts.items()
+      }
+      self.visited += 1
+      return Contexted(node.tokens, contexts, next(bodies))
+
+    else:  # Definition
+      target = node.target
+      if target.body is not None:
+        target = withBody(target, parts[0])
+      self.visited += 1
+      return Definition(node.tokens, node.name, target)
+
+  def stats(self) -> dict:
+    return {
+        'visited': self.visited,
+        'unique': len(self.table),
+        'shared': self.shared,
+        'sharedRatio': self.shared / self.visited if self.visited else 0
+    }
+
+  def __repr__(self) -> str:
+    return f'ExpressionDag({self.stats()})'
+
+
+# 모양이 같은 노드를 합친 새 DAG를 돌려줌
+def shareSubexpressions(node: Node) -> Node:
+  return ExpressionDag().intern(node)
+
+
+# interpret()와 같지만 values에 계산한 노드의 값을 기억해뒀다가 같은 노드를 다시 만나면 재사용함.
+# values는 context 하나에서만 유효해서 Let이나 함수 호출로 context가 바뀌면 새로 만듦.
+# interpret()처럼 recursionRoom()보다 깊으면 sharedDeep()로 계산하고, 정의를 펼치다 깊이가 넘치면 그 몸통부터 sharedDeep()로 계산함
+def interpretShared(node: Node, context: dict, values: Optional[dict] = None):
+  if values is None:
+    values = {}
+  levels = nestingDepth(node)
+  if levels > shallowDepth and levels > recursionRoom():
+    return sharedDeep(node, context, values)
+  return sharedNode(node, context, values, levels)
+
+
+# levels는 evaluateNode()와 같음
+def sharedNode(node: Node, context: dict, values: dict, levels: int):
+  key = id(node)
+  if key in values:
+    return values[key]
+
+  if isinstance(node, Number):
+    return node.number
+
+  elif isinstance(node, BinaryOperator):
+    left = sharedNode(node.left, context, values, levels)
+    right = sharedNode(node.right, context, values, levels)
+    if node.operator not in binaryOperatorFunctions:
+      raise Exception(f'Unknown binary operator {node.operator}')
+    result = binaryOperatorFunctions[node.operator](left, right)
+
+  elif isinstance(node, UnaryOperator):
+    value = sharedNode(node.value, context, values, levels)
+    if node.operator not in unaryOperatorFunctions:
+      raise Exception(f'Unknown unary operator {node.operator}')
+    result = unaryOperatorFunctions[node.operator](value)
+
+  elif isinstance(node, FunctionValue):
+    args = [sharedNode(arg, context, values, levels) for arg in node.args]
+
+    if node.name in builtinFunctions:
+      result = builtinCallables[node.name](*args)
+    elif node.name in context:
+      function = context[node.name]
+      if function.body is None or isinstance(function, MemoizedFunction):
+        result = function.calculate(interpret, args, context)
+      else:
+        inner = {**context, **fromValues(function.parameters, args)}
+        bodyLevels = levels + nestingDepth(function.body)
+        if bodyLevels > shallowDepth and bodyLevels > recursionRoom():
+          result = sharedDeep(function.body, inner, {})
+        else:
+          result = sharedNode(function.body, inner, {}, bodyLevels)
+    else:
+      raise Exception(f'{node.name}이라는 함수가 없어요.')
+
+  elif isinstance(node, Symbol):
+    if node.symbol in builtinSymbols:
+      result = builtinSymbols[node.symbol]
+    elif node.symbol in context:
+      value = context[node.symbol]
+      if not isinstance(value, SymbolValue):
+        result = value
+      elif value.body is None or isinstance(value, ReactiveSymbol):
+        result = value.value(interpret, context)
+      else:
+        bodyLevels = levels + nestingDepth(value.body)
+        if bodyLevels > shallowDepth and bodyLevels > recursionRoom():
+          result = sharedDeep(value.body, context, values)
+        else:
+          result = sharedNode(value.body, context, values, bodyLevels)
+    else:
+      raise Exception(f'{node.symbol}라는 기호가 없어요.')
+
+  elif isinstance(node, Contexted):
+    result = sharedNode(node.node, {**context, **node.contexts}, {}, levels)
+
+  elif isinstance(node, Group):
+    result = sharedNode(node.node, context, values, levels)
+
+  else:
+    raise Exception(f'Unknown node type {type(node)}')
+
+  values[key] = result
+  return result
+
+
+storeTask = object()  # 바로 밑의 노드의 값(results의 맨 위)을 그 노드의 값으로 기억함
+
+
+# interpretShared()를 evaluateDeep()처럼 할 일을 tasks에 쌓아두고 반복문으로 계산함.
+# 재귀 한도가 없는 대신 정의를 펼친 깊이는 defaultMaxDepth까지만 허용함
+def sharedDeep(node: Node, context: dict, values: dict):
+  tasks = []
+  results = []
+  depth = 0  # Let으로 정의한 함수/기호를 펼친 깊이
+
+  while True:
+    # 1. 내려가기: 이미 계산한 노드나 잎 노드를 만날 때까지
+    while True:
+      key = id(node)
+      if key in values:
+        results.append(values[key])
+        break
+
+      if isinstance(node, Number):
+        results.append(node.number)
+        break
+
+      elif isinstance(node, BinaryOperator):
+        tasks.append(node)
+        tasks.append(combineTask)
+        tasks.append(node.right)
+        node = node.left
+
+      elif isinstance(node, UnaryOperator):
+        tasks.append(node)
+        tasks.append(combineTask)
+        node = node.value
+
+      elif isinstance(node, FunctionValue):
+        tasks.append(node)
+        tasks.append(combineTask)
+        if not node.args:
+          break
+        tasks.extend(reversed(node.args))
+        node = tasks.pop()
+
+      elif isinstance(node, Symbol):
+        symbol = node.symbol
+        if symbol in builtinSymbols:
+          result = builtinSymbols[symbol]
+        elif symbol in context:
+          value = context[symbol]
+          if not isinstance(value, SymbolValue):
+            result = value
+          elif value.body is None or isinstance(value, ReactiveSymbol):
+            result = value.value(interpret, context)
+          else:
+            # Let x = ...로 정의한 기호: 같은 context와 values에서 우변을 계산하고 이 노드의 값으로 기억함
+            if depth >= defaultMaxDepth:
+              raise CallDepthExceeded(
+                  f'정의를 {defaultMaxDepth}번 넘게 겹쳐서 펼쳤어요', node.tokens)
+            tasks.extend((node, storeTask, values, context, depth, restoreTask))
+            depth += 1
+            node = value.body
+            continue
+        else:
+          raise Exception(f'{symbol}라는 기호가 없어요.')
+        values[key] = result
+        results.append(result)
+        break
+
+      elif isinstance(node, Contexted):
+        tasks.extend((node, storeTask, values, context, depth, restoreTask))
+        context = {**context, **node.contexts}
+        values = {}
+        node = node.node
+
+      elif isinstance(node, Group):
+        tasks.append(node)
+        tasks.append(storeTask)
+        node = node.node
+
+      else:
+        raise Exception(f'Unknown node type {type(node)}')
+
+    # 2. 올라오기: 자식들을 다 계산한 노드를 계산하다가, 새로 내려갈 노드가 생기면 1로 돌아감
+    while True:
+      if not tasks:
+        return results.pop()
+      node = tasks.pop()
+
+      if node is restoreTask:
+        depth = tasks.pop()
+        context = tasks.pop()
+        values = tasks.pop()
+        continue
+
+      elif node is storeTask:
+        node = tasks.pop()
+        values[id(node)] = results[-1]
+        continue
+
+      elif node is not combineTask:  # 아직 계산 안 한 자식 (오른쪽 피연산자, 다음 인수)
+        break
+
+      node = tasks.pop()
+
+      if isinstance(node, BinaryOperator):
+        right = results.pop()
+        left = results.pop()
+        if node.operator not in binaryOperatorFunctions:
+          raise Exception(f'Unknown binary operator {node.operator}')
+        result = binaryOperatorFunctions[node.operator](left, right)
+
+      elif isinstance(node, UnaryOperator):
+        value = results.pop()
+        if node.operator not in unaryOperatorFunctions:
+          raise Exception(f'Unknown unary operator {node.operator}')
+        result = unaryOperatorFunctions[node.operator](value)
+
+      else:  # FunctionValue
+        first = len(results) - len(node.args)
+        args = results[first:]
+        del results[first:]
+
+        if node.name in builtinFunctions:
+          result = builtinCallables[node.name](*args)
+        elif node.name in context:
+          function = context[node.name]
+          if function.body is None or isinstance(function, MemoizedFunction):
+            result = function.calculate(interpret, args, context)
+          else:
+            # Let f(x) = ...로 정의한 함수: 인수를 넣은 새 context에서 몸통을 계산하고 되돌아옴
+            if depth >= defaultMaxDepth:
+              raise CallDepthExceeded(
+                  f'정의를 {defaultMaxDepth}번 넘게 겹쳐서 펼쳤어요', node.tokens)
+            tasks.extend((node, storeTask, values, context, depth, restoreTask))
+            context = {**context, **fromValues(function.parameters, args)}
+            values = {}
+            depth += 1
+            node = function.body
+            break
+        else:
+          raise Exception(f'{node.name}이라는 함수가 없어요.')
+
+      values[id(node)] = result
+      results.append(result)
+
+
+# %% [markdown]
+# ### 사용자 함수 결과 기억하기
+
+# %%
+# Let f(x) = ...로 정의한 함수는 호출할 때마다 우변을 처음부터 다시 계산함.
+# 재귀 함수나 같은 인수로 자주 부르는 함수라면 memoize(f)로 감싸서 인수 -> 결과를 기억해두면 빠름.
+#
+# 함수의 우변은 인수 말고도 바깥 context의 기호/함수를 쓸 수 있음 (Let f(x) = x * a).
+# 이런 이름(freeNames)들이 가리키는 값이 바뀌면 기억해둔 결과가 틀려지니까,
+# 호출할 때마다 그 이름들의 값을 확인해서 바뀌었으면 기억해둔 걸 다 버림.
+# 바깥 이름이 또 Let으로 정의한 것이라면 그 우변이 쓰는 이름까지 따라가서 확인함.
+#
+# context['f'] = memoize(context['f'], maxSize=1024)
+# context['f'].stats()  # {'hits': .., 'misses': .., ...}
+
+
+# 노드 안에서 바깥 context로부터 찾는 기호/함수 이름들 (내장 기호/함수와 bound에 있는 이름은 뺌)
+def freeNamesIn(node: Node, bound) -> FrozenSet[str]:
+  names = set()
+  stack = [(node, bound)]
+  while stack:
+    current, bound = stack.pop()
+    if isinstance(current, Symbol):
+      if current.symbol not in builtinSymbols and current.symbol not in bound:
+        names.add(current.symbol)
+    elif isinstance(current, FunctionValue):
+      if current.name not in builtinFunctions and current.name not in bound:
+        names.add(current.name)
+    elif isinstance(current, Contexted):
+      # Let 블록 안에서는 거기서 정의한 이름이 항상 바깥 이름을 가림 (Let 정의의 우변에서도)
+      inner = set(bound) | set(current.contexts)
+      for value in current.contexts.values():
+        if value.body is not None:
+          parameters = value.parameters if isinstance(value, Function) else None
+          stack.append((value.body, inner | set(parameters or [])))
+      stack.append((current.node, inner))
+      continue
+    for child in current.children():
+      stack.append((child, bound))
+  return frozenset(names)
+
+
+def freeNamesOf(value) -> FrozenSet[str]:
+  if value.freeNames is None:
+    parameters = value.parameters if isinstance(value, Function) else None
+    value.freeNames = freeNamesIn(value.body, set(parameters or []))
+  return value.freeNames
+
+
+# names가 context에서 지금 가리키는 값들. Let으로 정의한 것은 객체 자체와 그 우변이 쓰는 이름들의 값까지 봄
+def dependencyState(names, context: dict, seen=None) -> tuple:
+  if seen is None:
+    seen = set()
+  state = []
+  for name in sorted(names):
+    value = context.get(name)
+    if isinstance(value, Context):
+      state.append((name, id(value)))
+      if value.body is not None and id(value) not in seen:
+        seen.add(id(value))
+        state.append(dependencyState(freeNamesOf(value), context, seen))
+    else:
+      state.append((name, value))
+  return tuple(state)
+
+
+class MemoizedFunction(Function):
+  function: Function  # 원래 함수
+  maxSize: int
+  hits: int
+  misses: int
+  evictions: int
+  invalidations: int  # 바깥 이름이 바뀌어서 다 버린 횟수
+
+  def __init__(self, function: Function, maxSize: int = 1024):
+    super().__init__(self.call,
+                     parameters=function.parameters,
+                     body=function.body)
+    self.function = function
+    self.maxSize = maxSize
+    self.results = OrderedDict()  # 인수들 -> 결과
+    self.state = None  # 결과들을 기억할 때의 바깥 이름들의 값
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def call(self, interpret, args, context):
+    names = freeNamesOf(self) if self.body is not None else ()
+    if names:
+      # 재귀 호출이면 자기 자신은 항상 같으니까 dependencyState가 알아서 한 번만 봄
+      state = dependencyState(names, context)
+      try:
+        hash(state)
+      except TypeError:  # 바깥 이름이 numpy 배열 등을 가리키면 같은지 비교할 수 없으니까 기억하지 않음
+        self.misses += 1
+        return self.function.calculate(interpret, args, context)
+      if state != self.state:
+        if self.results:
+          self.invalidations += 1
+          self.results.clear()
+        self.state = state
+
+    try:
+      key = tuple(args)
+      hash(key)
+    except TypeError:  # numpy 배열처럼 기억할 수 없는 인수
+      self.misses += 1
+      return self.function.calculate(interpret, args, context)
+
+    if key in self.results:
+      self.results.move_to_end(key)
+      self.hits += 1
+      return self.results[key]
+
+    self.misses += 1
+    result = self.function.calculate(interpret, args, context)
+    self.results[key] = result
+    while len(self.results) > self.maxSize:
+      self.results.popitem(last=False)
+      self.evictions += 1
+    return result
+
+  def clear(self):
+    self.results.clear()
+    self.state = None
+
+  def stats(self) -> dict:
+    return {
+        'size': len(self.results),
+        'maxSize': self.maxSize,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'invalidations': self.invalidations
+    }
+
+  def __repr__(self) -> str:
+    return f'MemoizedFunction({self.function}, {self.stats()})'
+
+
+def memoize(function: Function, maxSize: int = 1024) -> MemoizedFunction:
+  return MemoizedFunction(function, maxSize)
+
+
+# %% [markdown]
+# ### 기호 자리 미리 정하기
+
+# %%
+# interpret()와 compile()은 기호를 읽을 때마다 dict에서 찾고, Let 블록이나 사용자 함수를 부를 때마다
+# {**context, **...}로 dict를 새로 만듦. Let이 깊게 중첩되거나 인수가 많은 함수를 자주 부르면 이게 꽤 큼.
+# resolve()는 트리에 나오는 이름마다 '자리 번호'(slot)를 미리 정해두고, 계산할 때는 dict 대신
+# 리스트 하나(frame)를 frame[번호]로 읽고 씀.
+#
+# 이름을 찾는 규칙은 interpret()와 똑같음: 함수 본문은 '부른 곳'의 context에서 이름을 찾음.
+# 그래서 함수를 부르거나 Let 블록에 들어갈 때 그 자리의 원래 값을 잠깐 빼두고 새 값을 넣었다가,
+# 끝나면 원래 값으로 되돌림. dict를 새로 만들지 않아도 같은 결과가 나옴.
+#
+# evaluate = resolve(parseMathToAst('Let f(a, b) = a * b + x, f(2, 3)'))
+# evaluate({'x': 1})  # 7
+#
+# frame[0]에는 원래 context dict를 둠: 대화형 계산기처럼 context에 직접 넣은 내장함수 등을 부를 때 씀
+
+# 자리에 아무 값도 없음 (context에도 없는 이름)
+unbound = object()
+
+
+class ResolvedFunction:
+  original: Function
+  slots: List[int]  # 인수들이 들어갈 자리
+  body: Callable[[list], Any]
+
+  def __init__(self, original, slots):
+    self.original = original
+    self.slots = slots
+    self.body = None
+
+
+class ResolvedSymbol:
+  original: SymbolValue
+  body: Callable[[list], Any]
+
+  def __init__(self, original):
+    self.original = original
+    self.body = None
+
+
+class Resolver:
+  backend: Backend
+  layout: Dict[str, int]  # 이름 -> 자리 번호
+
+  def __init__(self, backend: Backend = pythonBackend):
+    self.backend = backend
+    self.layout = {}
+    self.externals = {}  # context에 있던 Let 정의 id -> ResolvedFunction/ResolvedSymbol
+
+  def slot(self, name: str) -> int:
+    if name not in self.layout:
+      self.layout[name] = len(self.layout) + 1  # 0번은 context
+    return self.layout[name]
+
+  # frame을 만들 때 쓰는 틀
+  def template(self) -> list:
+    return [None] + [unbound] * len(self.layout)
+
+  # 계산할 때 만났을 때 필요한 모든 이름에 자리를 만들어둠
+  def collect(self, node: Node):
+    stack = [node]
+    while stack:
+      current = stack.pop()
+      if isinstance(current, Symbol) and current.symbol not in builtinSymbols:
+        self.slot(current.symbol)
+      elif isinstance(current, FunctionValue):
+        self.slot(current.name)
+      elif isinstance(current, Contexted):
+        for name, value in current.contexts.items():
+          self.slot(name)
+          if value.body is not None:
+            stack.append(value.body)
+            for parameter in getattr(value, 'parameters', None) or []:
+              self.slot(parameter)
+      stack.extend(current.children())
+
+  # Let 정의를 자리 번호로 바꿈. 사용자 함수가 아니면 그대로 둠
+  def definition(self, value):
+    if value.body is None or isinstance(value, MemoizedFunction):
+      return value
+    self.collect(value.body)
+    if isinstance(value, Function):
+      resolved = ResolvedFunction(
+          value, [self.slot(parameter) for parameter in value.parameters])
+    else:
+      resolved = ResolvedSymbol(value)
+    resolved.body = self.expansion(value.body)
+    return resolved
+
+  # 우변을 펼치는 함수 (compile()의 compiledBody()와 같음). 깊이가 넘치면 frame을 context로 되돌려서 evaluateDeep()로 계산함
+  def expansion(self, body: Node) -> Callable[[list], Any]:
+    layout, backend = self.layout, self.backend
+    compiled = None
+    if nestingDepth(body) <= recursionRoom():
+      compiled = self.compile(body)
+    return expansionOf(
+        body, compiled,
+        lambda frame: evaluateDeep(body, contextOf(frame, layout), backend))
+
+  # context에 있던 값을 frame에 넣을 모양으로 바꿈
+  def external(self, value):
+    if not isinstance(value, (Function, SymbolValue)):
+      return value
+    resolved = self.externals.get(id(value))
+    if resolved is None or resolved.original is not value:
+      resolved = self.definition(value)
+      self.externals[id(value)] = resolved
+    return resolved
+
+  def compile(self, node: Node) -> Callable[[list], Any]:
+    backend = self.backend
+
+    if isinstance(node, Number):
+      number = node.number
+      return lambda frame: number
+
+    elif isinstance(node, BinaryOperator):
+      left = self.compile(node.left)
+      right = self.compile(node.right)
+      if node.operator in backend.binaryOperators:
+        return backend.binaryOperators[node.operator](left, right)
+      return compileError(f'Unknown binary operator {node.operator}')
+
+    elif isinstance(node, UnaryOperator):
+      value = self.compile(node.value)
+      if node.operator in backend.unaryOperators:
+        return backend.unaryOperators[node.operator](value)
+      return compileError(f'Unknown unary operator {node.operator}')
+
+    elif isinstance(node, FunctionValue):
+      return self.compileCall(node)
+
+    elif isinstance(node, Symbol):
+      name = node.symbol
+      if name in builtinSymbols:
+        constant = builtinSymbols[name]
+        return lambda frame: constant
+
+      slot = self.slot(name)
+
+      def symbol(frame):
+        value = frame[slot]
+        if value is unbound:
+          raise Exception(f'{name}라는 기호가 없어요.')
+        if type(value) is ResolvedSymbol:
+          return value.body(frame)
+        if type(value) is ResolvedFunction:
+          return value.original
+        if isinstance(value, SymbolValue):
+          return value.value(interpret, contextOf(frame, self.layout))
+        return value
+
+      return symbol
+
+    elif isinstance(node, Contexted):
+      names = list(node.contexts)
+      slots = [self.slot(name) for name in names]
+      definitions = [
+          self.definition(node.contexts[name]) for name in names
+      ]
+      inner = self.compile(node.node)
+      pairs = list(zip(slots, definitions))
+
+      def contexted(frame):
+        saved = [frame[slot] for slot in slots]
+        for slot, definition in pairs:
+          frame[slot] = definition
+        result = inner(frame)
+        for slot, value in zip(slots, saved):
+          frame[slot] = value
+        return result
+
+      return contexted
+
+    elif isinstance(node, Group):
+      return self.compile(node.node)
+
+    else:
+      return compileError(f'Unknown node type {type(node)}')
+
+  def compileCall(self, node: FunctionValue):
+    name = node.name
+    args = [self.compile(arg) for arg in node.args]
+
+    if name in self.backend.functions:  # 내장함수는 지금 바로 찾아둘 수 있음
+      function = self.backend.functions[name]
+      if len(args) == 1:
+        arg = args[0]
+        return lambda frame: function(arg(frame))
+      return lambda frame: function(*[arg(frame) for arg in args])
+
+    slot = self.slot(name)
+    layout = self.layout
+
+    def call(frame):
+      values = [arg(frame) for arg in args]
+      function = frame[slot]
+      if function is unbound:
+        raise Exception(f'{name}이라는 함수가 없어요.')
+      if type(function) is not ResolvedFunction:
+        return function.calculate(interpret, values, contextOf(frame, layout))
+
+      # 인수 자리에 값을 넣고 본문을 계산한 다음 원래대로 되돌림 (같은 이름이 여러 번이면 뒤의 것)
+      parameters = function.slots
+      if len(values) < len(parameters):  # fromValues()처럼 인수가 모자라면 IndexError
+        fromValues(function.original.parameters, values)
+      saved = [frame[parameter] for parameter in parameters]
+      for parameter, value in zip(parameters, values):
+        frame[parameter] = value
+      result = function.body(frame)
+      for parameter, value in zip(reversed(parameters), reversed(saved)):
+        frame[parameter] = value
+      return result
+
+    return call
+
+
+# frame을 interpret()가 쓰는 context dict로 되돌림 (자리 번호로 못 바꾼 함수를 부를 때만 씀)
+def contextOf(frame: list, layout: Dict[str, int]) -> dict:
+  context = dict(frame[0])
+  for name, slot in layout.items():
+    value = frame[slot]
+    if value is unbound:
+      continue
+    if isinstance(value, (ResolvedFunction, ResolvedSymbol)):
+      value = value.original
+    context[name] = value
+  return context
+
+
+# compile()처럼 recursionRoom()보다 깊은 수식은 자리 번호 없이 evaluateDeep()로 계산함
+class ResolvedExpression:
+  resolver: Resolver
+  node: Node
+  evaluate: Optional[Callable[[list], Any]]  # 너무 깊어서 안 만들었으면 None
+
+  def __init__(self, node: Node, backend: Backend = pythonBackend):
+    self.resolver = Resolver(backend)
+    self.resolver.collect(node)
+    self.node = node
+    self.evaluate = None
+    if nestingDepth(node) <= recursionRoom():
+      self.evaluate = self.resolver.compile(node)
+
+  def __call__(self, context: dict):
+    if self.evaluate is None:
+      return evaluateDeep(self.node, context, self.resolver.backend)
+    return self.evaluateFrame(context)
+
+  def evaluateFrame(self, context: dict):
+    resolver = self.resolver
+    layout = resolver.layout
+    external = resolver.external
+    values = [(name, external(value)) for name, value in context.items()]
+
+    # context의 Let 정의를 바꾸다가 새 이름이 생길 수 있으니까 frame은 그 다음에 만듦
+    frame = resolver.template()
+    frame[0] = context
+    for name, value in values:
+      slot = layout.get(name)
+      if slot is not None:
+        frame[slot] = value
+    return self.evaluate(frame)
+
+
+def resolve(node: Node, backend: Backend = pythonBackend) -> ResolvedExpression:
+  return ResolvedExpression(node, backend)
+
+
+# %% [markdown]
+# ### 정의 기억하기 (바뀐 것만 다시 계산)
+
+# %%
+# 대화형 계산기에서 Let a = ...로 정의한 기호는 읽을 때마다 우변을 처음부터 다시 계산함.
+# 수식에 a가 1000번 나오면 1000번 계산하고, 다음 줄에서 또 쓰면 또 계산함.
+# Definitions는 정의들을 context에 넣으면서
+#   - 정의마다 우변이 쓰는 이름들(freeNamesOf)로 '누가 누구를 쓰는지' 그래프를 만들고
+#   - 기호 값을 한 번 계산하면 기억해뒀다가
+#   - 어떤 이름을 다시 정의하면 그 이름을 (건너건너) 쓰는 정의들의 값만 버림. 버린 값은 다음에 읽을 때 다시 계산함
+#   - 정의가 돌고 돌면 (Let a = b + 1 다음에 Let b = a * 2) 정의할 때 바로 알려줌
+#
+# 이름은 '읽는 곳'의 context에서 찾으니까 (Let x = 3, a처럼 안쪽에서 x를 가리면 a 값도 달라짐),
+# 기억해둔 값은 a가 건너건너 쓰는 이름들이 읽는 곳에서도 Definitions에 넣은 것과 같을 때만 씀.
+# 다르면 예전처럼 그 자리에서 우변을 계산함.
+# context에 직접 넣은 값은 그래프에 안 들어가니까, 나중에 바뀔 값이라면 define()으로 넣어야 함.
+#
+# definitions = Definitions()
+# definitions.define('x', 3)
+# definitions.define('a', parseMathToAst('Let a = x * 2').target)
+# interpret(parseMathToAst('a + a'), definitions.context)  # 12, a는 한 번만 계산함
+# definitions.define('x', 4)  # a 값만 버림
+# definitions.graph()  # {'x': [], 'a': ['x']}
+
+
+# Definitions에 넣은 Let 기호: 읽으면 Definitions가 기억해둔 값을 돌려줌
+class ReactiveSymbol(SymbolValue):
+  definitions: 'Definitions'
+  name: str
+
+  def __init__(self, definitions: 'Definitions', name: str, body: Node):
+    super().__init__(self.read, body=body)
+    self.definitions = definitions
+    self.name = name
+
+  def read(self, interpret, context):
+    return self.definitions.valueOf(self, interpret, context)
+
+  def __repr__(self) -> str:
+    return f'ReactiveSymbol({self.name})'
+
+
+class Definitions:
+  context: dict  # 이름 -> 정의. interpret(node, definitions.context)처럼 씀
+  dependencies: Dict[str, FrozenSet[str]]  # 이름 -> 그 정의의 우변이 쓰는 이름들
+  dependents: Dict[str, Set[str]]  # 이름 -> 그 이름을 우변에서 쓰는 정의들
+  values: dict  # 기억해둔 기호 값들
+  hits: int
+  computations: int
+  invalidations: int  # 다시 정의해서 버린 값 개수
+  fallbacks: int  # 읽는 곳에서 이름이 가려져서 기억해둔 값을 못 쓴 횟수
+
+  def __init__(self, context: Optional[dict] = None):
+    self.context = {} if context is None else context
+    self.dependencies = {}
+    self.dependents = {}
+    self.values = {}
+    self.closures = {}  # 이름 -> 건너건너 쓰는 이름들 (정의가 바뀌면 다 버림)
+    self.hits = 0
+    self.computations = 0
+    self.invalidations = 0
+    self.fallbacks = 0
+
+  # name을 value(Let의 우변으로 만든 Function/SymbolValue나 그냥 값)로 정의함.
+  # 버린 값을 다시 계산해야 하는 정의들(name을 건너건너 쓰는 것들)을 돌려줌
+  def define(self, name: str, value) -> List[str]:
+    if isinstance(value, (Function, SymbolValue)) and value.body is not None:
+      names = freeNamesOf(value)
+    else:
+      names = frozenset()
+    cycle = self.cycleThrough(name, names)
+    if cycle is not None:
+      raise Exception(f'정의가 돌고 돌아요: {" -> ".join(cycle)}')
+
+    for dependency in self.dependencies.get(name, ()):
+      self.dependents[dependency].discard(name)
+    self.dependencies[name] = names
+    for dependency in names:
+      self.dependents.setdefault(dependency, set()).add(name)
+
+    if isinstance(value, SymbolValue) and value.body is not None:
+      symbol = ReactiveSymbol(self, name, value.body)
+      symbol.freeNames = names
+      value = symbol
+    self.context[name] = value
+    self.closures.clear()
+
+    affected = self.dependentsOf(name)
+    for changed in [name] + affected:
+      if changed in self.values:
+        del self.values[changed]
+        self.invalidations += 1
+    return affected
+
+  # name이 names를 쓰게 되면 생기는 순환: [name, ..., name] (없으면 None)
+  def cycleThrough(self, name: str, names) -> Optional[List[str]]:
+    previous = {}  # 이름 -> 그 이름까지 찾아온 바로 앞 이름 (name이 바로 쓰는 이름이면 None)
+    stack = []
+    for dependency in sorted(names):
+      previous[dependency] = None
+      stack.append(dependency)
+    while stack:
+      current = stack.pop()
+      if current == name:
+        path = []
+        while current is not None:
+          path.append(current)
+          current = previous[current]
+        path.append(name)
+        path.reverse()
+        return path
+      for dependency in sorted(self.dependencies.get(current, ())):
+        if dependency not in previous:
+          previous[dependency] = current
+          stack.append(dependency)
+    return None
+
+  # name을 건너건너 쓰는 정의들 (가까운 것부터)
+  def dependentsOf(self, name: str) -> List[str]:
+    found = []
+    seen = {name}
+    queue = deque([name])
+    while queue:
+      current = queue.popleft()
+      for dependent in sorted(self.dependents.get(current, ())):
+        if dependent not in seen:
+          seen.add(dependent)
+          found.append(dependent)
+          queue.append(dependent)
+    return found
+
+  # name의 값이 건너건너 쓰는 이름들
+  def closureOf(self, name: str) -> FrozenSet[str]:
+    closure = self.closures.get(name)
+    if closure is None:
+      names = set()
+      stack = [name]
+      while stack:
+        for dependency in self.dependencies.get(stack.pop(), ()):
+          if dependency not in names:
+            names.add(dependency)
+            stack.append(dependency)
+      closure = self.closures[name] = frozenset(names)
+    return closure
+
+  # 읽는 곳의 context에서도 name의 값이 쓰는 이름들이 전부 Definitions에 넣은 그대로인지
+  def sameNames(self, name: str, context: dict) -> bool:
+    if context is self.context:
+      return True
+    own = self.context
+    return all(
+        context.get(dependency) is own.get(dependency)
+        for dependency in self.closureOf(name))
+
+  def valueOf(self, symbol: ReactiveSymbol, interpret, context: dict):
+    name = symbol.name
+    if self.context.get(name) is not symbol or not self.sameNames(
+        name, context):
+      self.fallbacks += 1
+      return interpret(symbol.body, context)
+
+    if name in self.values:
+      self.hits += 1
+      return self.values[name]
+    self.computations += 1
+    value = interpret(symbol.body, self.context)
+    self.values[name] = value
+    return value
+
+  # 이름 -> 그 정의의 우변이 쓰는 이름들 (정의한 순서대로)
+  def graph(self) -> Dict[str, List[str]]:
+    return {name: sorted(names) for name, names in self.dependencies.items()}
+
+  def stats(self) -> dict:
+    return {
+        'definitions': len(self.dependencies),
+        'cached': len(self.values),
+        'hits': self.hits,
+        'computations': self.computations,
+        'invalidations': self.invalidations,
+        'fallbacks': self.fallbacks
+    }
+
+  def __repr__(self) -> str:
+    return f'Definitions({self.stats()})'
+
+
+# %% [markdown]
+# ### 정의 저장하고 불러오기 (스냅샷)
+
+# %%
+# 공통으로 쓰는 Let 정의가 수백 개면, 시작할 때마다 글자를 토큰으로 나누고 파싱하고 최적화하는 데 몇 초씩 걸림.
+# saveSnapshot()은 Definitions에 넣은 정의들을 '이미 파싱하고 최적화한 트리' 그대로 바이너리 파일에 저장하고,
+# loadSnapshot()은 그 파일을 메모리에 매핑(mmap)해서 토큰 나누기/파싱 없이 바로 트리를 다시 만듦.
+#
+# 파일 모양 (전부 little endian, 칸마다 8바이트 단위로 맞춤):
+#   머리     'CALCSNAP', 버전, 칸마다 개수
+#   문자열   이름/연산자들을 이어 붙인 글자와, 글자마다 시작 위치
+#   숫자     float64 배열 (복소수는 실수부, 허수부 두 칸)
+#   노드     노드 하나에 24바이트: 종류, 토큰 시작/끝, a, b, c (종류마다 뜻이 다름). 자식이 항상 부모보다 앞에 있음
+#   링크     uint32 배열: 함수 인수 목록, Let 정의들, 함수 인수 이름 등 길이가 정해지지 않은 것들
+#   정의     세션에 정의된 이름마다 링크에서의 위치
+#   토큰     TokenBuffer의 배열들(종류, 시작, 끝, 우선순위)과 수식 글자
+#
+# 노드의 토큰 범위는 그대로 저장해둬서 불러온 노드도 node.tokens를 쓸 수 있음.
+# 토큰 배열들은 매핑한 파일에서 칸째로 한 번에 복사해 오고, 다 읽으면 매핑을 닫음
+# (파일을 계속 매핑해두면 Windows에서는 saveSnapshot()이 같은 파일을 바꿔치기하지 못함).
+# 파일 모양이 바뀌면 snapshotVersion을 올려서, 예전 파일을 잘못 읽지 않고 오류를 냄.
+#
+# saveSnapshot(definitions, 'session.snapshot')
+# definitions = loadSnapshot('session.snapshot')  # 다시 파싱하지 않음
+
+snapshotMagic = b'CALCSNAP'
+snapshotVersion = 2
+
+# 표시, 버전, 빈칸, 문자열 개수, 문자열 글자 수, 숫자 개수, 노드 개수, 링크 개수, 정의 개수, 토큰 개수, 수식 바이트 수
+snapshotHeader = struct.Struct('<8sHHIIIIIIII')
+# 종류, 토큰 시작, 토큰 끝, a, b, c (숫자 노드는 a가 숫자 번호, b가 복소수인지)
+snapshotNode = struct.Struct('<B3xIIIII')
+
+# 노드 종류 번호 (파일에 담는 번호라서 순서를 바꾸면 안 됨)
+snapshotNodeTypes = (Number, Symbol, BinaryOperator, UnaryOperator, Group,
+                     FunctionValue, Contexted, Definition)
+
+# 링크에 담는 값 종류 (숫자면 그 뒤의 칸이 숫자 번호, 복소수인지)
+snapshotNumber, snapshotSymbol, snapshotFunction = 0, 1, 2
+
+# (칸 이름, 한 칸의 바이트 수, 머리에서 개수가 있는 자리)
+snapshotSections = [('stringOffsets', 4, 0), ('strings', 1, 1),
+                    ('numbers', 8, 2), ('nodes', snapshotNode.size, 3),
+                    ('links', 4, 4), ('entries', 4, 5), ('kinds', 1, 6),
+                    ('starts', 4, 6), ('ends', 4, 6), ('precedences', 2, 6),
+                    ('code', 1, 7)]
+
+
+# 칸 이름 -> (파일에서의 시작 위치, 바이트 수)
+def snapshotLayout(counts) -> Dict[str, Tuple[int, int]]:
+  layout = {}
+  offset = snapshotHeader.size
+  for name, itemSize, countIndex in snapshotSections:
+    count = counts[countIndex] + (1 if name == 'stringOffsets' else 0)
+    offset = (offset + 7) // 8 * 8
+    layout[name] = (offset, count * itemSize)
+    offset += count * itemSize
+  return layout
+
+
+def littleEndianBytes(values) -> bytes:
+  if isinstance(values, array) and sys.byteorder != 'little':
+    values = array(values.typecode, values)
+    values.byteswap()
+  return bytes(values)
+
+
+# 파일의 바이트들을 typecode 배열처럼 읽음. little endian 컴퓨터라면 복사하지 않음
+def littleEndianView(view: memoryview, typecode: str):
+  if sys.byteorder == 'little':
+    return view.cast(typecode)
+  values = array(typecode, bytes(view))
+  values.byteswap()
+  return values
+
+
+# 파일의 바이트들을 typecode 배열로 복사함 (매핑을 닫은 뒤에도 쓰는 것)
+def littleEndianArray(view: memoryview, typecode: str) -> array:
+  values = array(typecode)
+  values.frombytes(view)
+  if sys.byteorder != 'little':
+    values.byteswap()
+  return values
+
+
+class SnapshotWriter:
+
+  def __init__(self):
+    self.strings = []
+    self.stringIndices = {}
+    self.numbers = array('d')
+    self.nodes = bytearray()
+    self.nodeIndices = {}  # id(노드) -> 번호 (같은 노드를 여러 곳에서 쓰면 한 번만 저장함)
+    self.links = array('I')
+    self.entries = array('I')
+    self.tokens = TokenBuffer('')
+    self.code = []
+    self.codeLength = 0
+    self.tokenBases = {}  # id(토큰 목록) -> 저장한 토큰들에서의 시작 번호
+    self.keep = []  # id()를 쓰는 동안 노드와 토큰 목록이 사라지지 않게 잡아둠
+    self.name = None  # 지금 쓰는 정의의 이름 (오류 메시지용)
+
+  def string(self, text: str) -> int:
+    if text not in self.stringIndices:
+      self.stringIndices[text] = len(self.strings)
+      self.strings.append(text)
+    return self.stringIndices[text]
+
+  # 숫자를 저장하고 (번호, 복소수인지)를 돌려줌. 복소수는 실수부, 허수부를 이어서 저장함
+  def number(self, value) -> Tuple[int, int]:
+    try:
+      if isinstance(value, complex):
+        self.numbers.extend([value.real, value.imag])
+        return len(self.numbers) - 2, 1
+      self.numbers.append(value)
+    except (TypeError, OverflowError):  # float64로 담을 수 없는 값 (아주 큰 정수 등)
+      raise Exception(f'{self.name}은(는) 스냅샷에 저장할 수 없어요: {value}')
+    return len(self.numbers) - 1, 0
+
+  # 토큰 목록(Token 목록이나 TokenBuffer)을 통째로 저장하고 시작 번호를 돌려줌
+  def tokenBase(self, allTokens) -> int:
+    key = id(allTokens)
+    if key not in self.tokenBases:
+      self.keep.append(allTokens)
+      tokens = self.tokens
+      self.tokenBases[key] = len(tokens)
+      for index in range(len(allTokens)):
+        token = allTokens[index]
+        tokens.kinds.append(tKindIndices[token.kind])
+        tokens.starts.append(self.codeLength)
+        tokens.ends.append(self.codeLength + len(token.code))
+        tokens.precedences.append(token.precedence)
+        self.code.append(token.code)
+        self.codeLength += len(token.code) + 1
+    return self.tokenBases[key]
+
+  # 노드를 (자식들부터) 저장하고 번호를 돌려줌
+  def node(self, root: Node) -> int:
+    stack = [(root, False)]
+    while stack:
+      node, ready = stack.pop()
+      if id(node) in self.nodeIndices:
+        continue
+      if not ready:
+        stack.append((node, True))
+        for child in reversed(self.nodesIn(node)):
+          stack.append((child, False))
+        continue
+      self.keep.append(node)
+      self.nodeIndices[id(node)] = self.write(node)
+    return self.nodeIndices[id(root)]
+
+  # 저장하기 전에 먼저 저장해야 하는 노드들: 자식들과 Let 정의들의 우변
+  def nodesIn(self, node: Node) -> List[Node]:
+    if isinstance(node, Contexted):
+      return [value.body for value in node.contexts.values()] + [node.node]
+    if isinstance(node, Definition):
+      return [node.target.body]
+    return node.children()
+
+  def write(self, node: Node) -> int:
+    kind = next(index for index, cls in enumerate(snapshotNodeTypes)
+                if isinstance(node, cls))
+    a = b = c = 0
+    if isinstance(node, Number):
+      a, b = self.number(node.number)
+    elif isinstance(node, Symbol):
+      a = self.string(node.symbol)
+    elif isinstance(node, BinaryOperator):
+      a, b = self.nodeIndices[id(node.left)], self.nodeIndices[id(node.right)]
+      c = self.string(node.operator)
+    elif isinstance(node, UnaryOperator):
+      a, c = self.nodeIndices[id(node.value)], self.string(node.operator)
+    elif isinstance(node, Group):
+      a = self.nodeIndices[id(node.node)]
+    elif isinstance(node, FunctionValue):
+      a, b, c = self.string(node.name), len(self.links), len(node.args)
+      self.links.extend(self.nodeIndices[id(arg)] for arg in node.args)
+    elif isinstance(node, Contexted):
+      a, b, c = self.nodeIndices[id(node.node)], len(self.links), len(
+          node.contexts)
+      for name, value in node.contexts.items():
+        self.links.append(self.string(name))
+        self.value(name, value)
+    elif isinstance(node, Definition):
+      a, b = self.string(node.name), len(self.links)
+      self.value(node.name, node.target)
+
+    base = self.tokenBase(node.allTokens)
+    self.nodes += snapshotNode.pack(kind, base + node.start, base + node.end,
+                                    a, b, c)
+    return len(self.nodes) // snapshotNode.size - 1
+
+  # 링크에 값 하나를 씀: [종류, 숫자 번호나 우변 노드 번호, 인수 개수, 인수 이름들...]
+  # 우변 노드는 미리 저장해둬야 함 (아니면 우변의 링크가 이 값 중간에 끼어듦)
+  def value(self, name: str, value):
+    if isinstance(value, (int, float, complex)) and not isinstance(value, bool):
+      self.links.extend([snapshotNumber, *self.number(value)])
+    elif isinstance(value, Function) and value.body is not None:
+      self.links.extend(
+          [snapshotFunction,
+           self.node(value.body),
+           len(value.parameters)])
+      self.links.extend(self.string(parameter) for parameter in value.parameters)
+    elif isinstance(value, SymbolValue) and value.body is not None:
+      self.links.extend([snapshotSymbol, self.node(value.body), 0])
+    else:
+      raise Exception(f'{name}은(는) 스냅샷에 저장할 수 없어요: {value}')
+
+  # 세션의 정의 하나: [이름, 값..., 우변이 쓰는 이름 개수, 이름들...]
+  def entry(self, name: str, value):
+    self.name = name
+    if isinstance(value, (Function, SymbolValue)) and value.body is not None:
+      freeNames = sorted(freeNamesOf(value))
+      self.node(value.body)  # 우변의 노드들이 링크를 쓰니까 정의를 쓰기 시작하기 전에 먼저 저장함
+    else:
+      freeNames = []
+    self.entries.append(len(self.links))
+    self.links.append(self.string(name))
+    self.value(name, value)
+    self.links.append(len(freeNames))
+    self.links.extend(self.string(freeName) for freeName in freeNames)
+
+  def toBytes(self) -> bytes:
+    strings = ''.join(self.strings)
+    stringOffsets = array('I', [0])
+    for text in self.strings:
+      stringOffsets.append(stringOffsets[-1] + len(text))
+    code = ' '.join(self.code).encode('utf-8')
+    tokens = self.tokens
+    sections = {
+        'stringOffsets': littleEndianBytes(stringOffsets),
+        'strings': strings.encode('utf-8'),
+        'numbers': littleEndianBytes(self.numbers),
+        'nodes': bytes(self.nodes),
+        'links': littleEndianBytes(self.links),
+        'entries': littleEndianBytes(self.entries),
+        'kinds': littleEndianBytes(tokens.kinds),
+        'starts': littleEndianBytes(tokens.starts),
+        'ends': littleEndianBytes(tokens.ends),
+        'precedences': littleEndianBytes(tokens.precedences),
+        'code': code
+    }
+    counts = (len(self.strings), len(sections['strings']), len(self.numbers),
+              len(self.nodes) // snapshotNode.size, len(self.links),
+              len(self.entries), len(tokens), len(code))
+    output = bytearray(
+        snapshotHeader.pack(snapshotMagic, snapshotVersion, 0, *counts))
+    for name, (offset, size) in snapshotLayout(counts).items():
+      output += bytes(offset - len(output))
+      output += sections[name]
+    return bytes(output)
+
+
+class SnapshotReader:
+  definitions: 'Definitions'
+
+  def __init__(self, view: memoryview, path: str = '스냅샷'):
+    if len(view) < snapshotHeader.size:
+      raise Exception(f'스냅샷 파일이 아니에요: {path}')
+    magic, version, _, *counts = snapshotHeader.unpack_from(view, 0)
+    if magic != snapshotMagic:
+      raise Exception(f'스냅샷 파일이 아니에요: {path}')
+    if version != snapshotVersion:
+      raise Exception(
+          f'스냅샷 버전이 달라요: {version} (읽을 수 있는 버전: {snapshotVersion}) {path}')
+    layout = snapshotLayout(counts)
+    end = max(offset + size for offset, size in layout.values())
+    if len(view) < end:
+      raise Exception(f'스냅샷 파일이 잘렸어요: {len(view)}바이트 (필요한 크기: {end}) {path}')
+
+    def section(name, typecode=None):
+      offset, size = layout[name]
+      part = view[offset:offset + size]
+      return part if typecode is None else littleEndianView(part, typecode)
+
+    text = bytes(section('strings')).decode('utf-8')
+    offsets = section('stringOffsets', 'I')
+    self.strings = [
+        text[offsets[index]:offsets[index + 1]]
+        for index in range(len(offsets) - 1)
+    ]
+    self.numbers = section('numbers', 'd')
+    self.links = section('links', 'I')
+
+    # 토큰 배열들은 불러온 노드들이 계속 쓰니까 복사해둠 (나머지 칸은 노드를 만들 때만 읽음)
+    tokens = TokenBuffer(bytes(section('code')).decode('utf-8'))
+    tokens.kinds = littleEndianArray(section('kinds'), 'b')
+    tokens.starts = littleEndianArray(section('starts'), 'I')
+    tokens.ends = littleEndianArray(section('ends'), 'I')
+    tokens.precedences = littleEndianArray(section('precedences'), 'h')
+
+    self.nodes = []
+    self.readNodes(section('nodes'), tokens)
+
+    self.definitions = Definitions()
+    for position in section('entries', 'I'):
+      name = self.strings[self.links[position]]
+      value, position = self.value(position + 1)
+      count = self.links[position]
+      names = self.links[position + 1:position + 1 + count]
+      if isinstance(value, Context):
+        value.freeNames = frozenset(self.strings[index] for index in names)
+      self.definitions.define(name, value)
+
+  def readNodes(self, data: memoryview, tokens: TokenBuffer):
+    nodes, strings, numbers, links = self.nodes, self.strings, self.numbers, self.links
+    # 노드를 만들 때 토큰 범위만 읽어가니까 TokenReference 하나를 계속 고쳐 씀
+    reference = TokenReference(tokens, 0, 0)
+    for kind, start, end, a, b, c in snapshotNode.iter_unpack(data):
+      reference.start = start
+      reference.end = end
+      cls = snapshotNodeTypes[kind]
+      if cls is Number:
+        node = Number(reference,
+                      complex(numbers[a], numbers[a + 1]) if b else numbers[a])
+      elif cls is Symbol:
+        node = Symbol(reference, strings[a])
+      elif cls is BinaryOperator:
+        node = BinaryOperator(reference, nodes[a], nodes[b], strings[c])
+      elif cls is UnaryOperator:
+        node = UnaryOperator(reference, nodes[a], strings[c])
+      elif cls is Group:
+        node = Group(reference, nodes[a])
+      elif cls is FunctionValue:
+        node = FunctionValue(reference, strings[a],
+                             [nodes[index] for index in links[b:b + c]])
+      elif cls is Contexted:
+        contexts = {}
+        position = b
+        for _ in range(c):
+          name = strings[links[position]]
+          contexts[name], position = self.value(position + 1)
+        node = Contexted(reference, contexts, nodes[a])
+      else:
+        node = Definition(reference, strings[a], self.value(b)[0])
+      nodes.append(node)
+
+  # 링크의 position에서 값 하나를 읽음: (값, 다음 위치)
+  def value(self, position: int):
+    links = self.links
+    kind, payload, count = links[position], links[position + 1], links[position
+                                                                         + 2]
+    position += 3
+    if kind == snapshotNumber:
+      if count:  # 복소수
+        return complex(self.numbers[payload], self.numbers[payload + 1]), position
+      return self.numbers[payload], position
+    if kind == snapshotSymbol:
+      return userSymbol(self.nodes[payload]), position
+    parameters = [self.strings[index] for index in links[position:position + count]]
+    return userFunction(parameters, self.nodes[payload]), position + count
+
+
+# Definitions(나 정의들이 담긴 context dict)의 정의들을 path에 저장함.
+# 다른 프로세스가 읽는 중이어도 괜찮게 옆 파일에 다 쓴 다음 바꿔치기함
+def saveSnapshot(definitions: Union['Definitions', dict], path: str):
+  context = definitions.context if isinstance(definitions,
+                                              Definitions) else definitions
+  writer = SnapshotWriter()
+  for name, value in context.items():
+    writer.entry(name, value)
+  data = writer.toBytes()
+
+  temporary = f'{path}.{os.getpid()}.tmp'
+  with open(temporary, 'wb') as file:
+    file.write(data)
+  os.replace(temporary, path)
+
+
+def loadSnapshot(path: str) -> 'Definitions':
+  with open(path, 'rb') as file:
+    if os.fstat(file.fileno()).st_size == 0:
+      raise Exception(f'스냅샷 파일이 아니에요: {path}')
+    mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    return SnapshotReader(memoryview(mapping), path).definitions
+  finally:
+    try:
+      mapping.close()
+    except BufferError:  # 읽다가 오류가 나면 traceback이 아직 파일을 가리키는 view를 잡고 있음. 그때는 GC가 닫음
+      pass
+
+
+# %% [markdown]
+# ### 스크립트 실행
+
+# %%
+# .calc 파일처럼 여러 줄짜리 수식 스크립트를 처음부터 끝까지 계산함.
+# 파일 전체를 한 번에 읽지 않고 조금씩(chunk) 읽으면서
+#   글자 조각들 -> 문장(토큰 목록)들 -> 파싱 -> 계산 -> 결과 출력
+# 을 generator로 줄줄이 이어서 처리하기 때문에, 스크립트가 아무리 커도 메모리는 문장 하나만큼만 씀.
+#
+# 문장은 줄바꿈이나 괄호 밖의 '.'/','(tTerminators)로 나눔.
+# Let으로 정의한 것은 대화형 계산기(main)처럼 context에 쌓여서 다음 문장부터 쓸 수 있음.
+#
+#   Let f(x) = x ^ 2 + 1
+#   Let a = f(2), a * 3     <- 15
+#   f(a)                    <- 26
+
+
+spacePattern = re.compile(r'\s+')
+longestFixedToken = max(len(code) for code in fixedTokens)  # '!='
+
+
+# 파일을 size글자씩 읽어서 돌려줌
+def readChunks(file, size: int = 1 << 16):
+  while True:
+    chunk = file.read(size)
+    if not chunk:
+      return
+    yield chunk
+
+
+# 글자 조각들을 토큰으로 나누면서 문장 단위로 묶어줌: (문장이 시작하는 줄 번호, 토큰 목록)
+def scriptStatements(chunks):
+  buffer = ''
+  offset = 0  # buffer[0]이 스크립트 전체에서 몇 번째 글자인지 (오류 메시지용)
+  line = 1
+  statementLine = 1
+  statement = []
+  depth = 0  # 괄호 깊이. 괄호 안의 ','는 함수 인수를 나누는 것이니까 문장을 나누지 않음
+
+  chunks = iter(chunks)
+  final = False
+  while not final:
+    chunk = next(chunks, None)
+    if chunk is None:
+      final = True
+    else:
+      buffer += chunk
+
+    position = 0
+    while position < len(buffer):
+      # 토큰 앞의 띄어쓰기
+      space = spacePattern.match(buffer, position)
+      if space is not None:
+        if space.end() == len(buffer) and not final:
+          break  # 띄어쓰기가 다음 조각으로 이어질 수도 있음
+        newlines = space.group().count('\n')
+        position = space.end()
+        if newlines:
+          line += newlines
+          if depth == 0 and statement:
+            yield statementLine, statement
+            statement = []
+        continue
+
+      match = tokenPattern.match(buffer, position)
+      if match is None:
+        # '!='이 '!'와 '='로 나뉘어서 '!'까지만 온 것일 수도 있으니까 끝부분이면 다음 조각을 기다림
+        if not final and len(buffer) - position < longestFixedToken:
+          break
+        c = buffer[position]
+        raise Exception(
+            f'Malformed expression: {c} at {offset + position} ({line}번째 줄)')
+      kind = match.lastgroup
+      if match.end(kind) == len(buffer) and not final:
+        break  # '12' 다음 조각이 '3.5'일 수도 있으니까 다음 조각과 합쳐서 다시 봄
+
+      code = match.group(kind)
+      token = fixedTokens.get(code)
+      if token is None:
+        token = Token(kind=kind, code=code, precedence=tKindPrecedences[kind])
+
+      if kind == 'group':
+        depth += 1
+      elif kind == 'group_close':
+        # 그냥 두면 depth가 음수가 돼서 그 뒤로는 줄바꿈에서 문장이 안 나뉨
+        if depth == 0:
+          raise Exception(
+              f'여는 괄호 없이 닫는 괄호가 왔어요: ) at {offset + position} ({line}번째 줄)')
+        depth -= 1
+      position = match.end(kind)
+
+      if kind == 'terminator' and depth == 0:
+        if statement:
+          yield statementLine, statement
+          statement = []
+        continue
+
+      if not statement:
+        statementLine = line
+      statement.append(token)
+
+    buffer = buffer[position:]
+    offset += position
+
+  if statement:
+    yield statementLine, statement
+
+
+# 문장들을 하나씩 파싱하고 계산함: (줄 번호, 노드, 값) 정의라면 값은 None
+# context는 dict나 Definitions (loadSnapshot()으로 불러온 정의들에 이어서 계산할 때)
+def evaluateStatements(statements, context: Union[dict, 'Definitions']):
+  definitions = context if isinstance(context,
+                                      Definitions) else Definitions(context)
+  for line, tokens in statements:
+    node = optimize(parseToAst(tokens, 0, len(tokens)))
+    if isinstance(node, Definition):
+      definitions.define(node.name, node.target)
+      yield line, node, None
+    else:
+      yield line, node, interpret(node, definitions.context)
+
+
+# 스크립트 파일을 계산하면서 결과를 바로바로 output에 씀
+def runScript(file,
+              output=sys.stdout,
+              context: Union[dict, 'Definitions', None] = None):
+  if context is None:
+    context = {}
+
+  statements = scriptStatements(readChunks(file))
+  for line, node, value in evaluateStatements(statements, context):
+    if not isinstance(node, Definition):
+      output.write(f'{line}: {value}\n')
+      output.flush()
+
+  return context
+
+
+# %% [markdown]
+# ### 여러 수식 한꺼번에 계산하기 (batch)
+
+# %%
+# 대화형 계산기나 스크립트는 한 줄씩 코어 하나로 계산함. 수식이 수십만 개라면 느리니까
+# 서로 상관없는 수식들을 여러 프로세스에 나눠서 계산하고, 결과를 입력 순서대로 JSONL로 씀.
+#
+# 1.  수식 파일: 한 줄에 수식 하나. 줄마다 따로 계산함 (Let은 같은 줄 안에서만 씀: Let a = 2, a * 3)
+#     python 최종결과.py --batch 수식들.txt
+#     {"line": 1, "value": 6.0}
+# 2.  수식 하나 + 변수 값 CSV: 첫 줄은 변수 이름, 그 다음 줄부터 한 줄이 한 번의 계산
+#     python 최종결과.py --expression 'x ^ 2 + y' --bindings 값들.csv
+#     {"row": 1, "value": 5.0}
+# 계산하다 오류가 나면 그 줄만 {"line": 3, "error": "..."}가 되고 나머지는 계속 계산함.
+#
+# 줄을 하나씩 다른 프로세스로 보내면 주고받는 비용이 계산보다 커서, chunkSize줄씩 묶어서 보냄.
+# 결과도 프로세스 안에서 미리 JSON 글자로 만들어서 돌려주니까, 원래 프로세스는 받아서 쓰기만 함.
+
+
+# 계산 결과를 JSON에 넣을 수 있는 값으로 바꿈 (inf/nan은 표준 JSON에 없으니까 글자로)
+def jsonValue(value):
+  if isinstance(value, bool):
+    return value
+  if isinstance(value, (int, float)):
+    return value if math.isfinite(value) else repr(float(value))
+  return str(value)
+
+
+def jsonLine(record: dict) -> str:
+  return json.dumps(record, ensure_ascii=False) + '\n'
+
+
+# 수식 여러 줄을 하나씩 계산해서 JSONL 글자로 돌려줌. lines: [(줄 번호, 수식)]
+def evaluateLines(lines) -> str:
+  results = []
+  for line, code in lines:
+    try:
+      node = optimize(parseMathToAst(code))
+      if isinstance(node, Definition):
+        raise Exception(f'정의만 있는 줄은 다음 줄로 이어지지 않아요. Let a = 2, a * 3처럼 한 줄에 써주세요.')
+      results.append(jsonLine({'line': line, 'value': jsonValue(interpret(node, {}))}))
+    except Exception as e:
+      results.append(jsonLine({'line': line, 'error': str(e)}))
+  return ''.join(results)
+
+
+# 프로세스마다 수식을 한 번만 컴파일해두고 계속 씀
+compiledBatchExpressions = {}
+
+
+# 수식 하나를 변수 값 여러 줄로 계산해서 JSONL 글자로 돌려줌. rows: [(줄 번호, [값, ...])]
+def evaluateBindings(expression: str, names: List[str], rows) -> str:
+  compiled = compiledBatchExpressions.get(expression)
+  if compiled is None:
+    compiled = compile(optimize(parseMathToAst(expression)))
+    compiledBatchExpressions[expression] = compiled
+
+  results = []
+  for row, cells in rows:
+    try:
+      if len(cells) != len(names):
+        raise Exception(f'값이 {len(names)}개여야 하는데 {len(cells)}개예요.')
+      context = {}
+      for name, cell in zip(names, cells):
+        try:
+          context[name] = float(cell)
+        except ValueError:
+          raise Exception(f'{name}의 값이 숫자가 아니에요: {cell!r}')
+      results.append(jsonLine({'row': row, 'value': jsonValue(compiled(context))}))
+    except Exception as e:
+      results.append(jsonLine({'row': row, 'error': str(e)}))
+  return ''.join(results)
+
+
+# items를 size개씩 묶음
+def chunked(items, size: int):
+  chunk = []
+  for item in items:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+# function(*task)들을 jobs개의 프로세스에서 계산하고 결과를 tasks 순서대로 돌려줌.
+# executor.map()은 입력을 처음에 다 읽어버리니까, 한 번에 프로세스당 몇 개씩만 맡겨서 메모리를 아낌
+def orderedMap(function, tasks, jobs: int):
+  if jobs == 1:
+    for task in tasks:
+      yield function(*task)
+    return
+
+  with ProcessPoolExecutor(max_workers=jobs) as executor:
+    pending = deque()
+    for task in tasks:
+      pending.append(executor.submit(function, *task))
+      if len(pending) >= jobs * 4:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+
+def writeResults(results, output):
+  for text in results:
+    output.write(text)
+  output.flush()
+
+
+# 수식 파일의 줄들을 계산함 (빈 줄은 건너뛰지만 줄 번호는 셈)
+def batchExpressions(file,
+                     output=sys.stdout,
+                     jobs: Optional[int] = None,
+                     chunkSize: int = 1000):
+  lines = ((number, code.strip()) for number, code in enumerate(file, 1)
+           if code.strip())
+  tasks = ((chunk,) for chunk in chunked(lines, chunkSize))
+  writeResults(orderedMap(evaluateLines, tasks, jobs or os.cpu_count()), output)
+
+
+# CSV의 줄마다 변수 값을 넣어서 수식 하나를 계산함
+def batchBindings(expression: str,
+                  file,
+                  output=sys.stdout,
+                  jobs: Optional[int] = None,
+                  chunkSize: int = 1000):
+  parseMathToAst(expression)  # 수식이 잘못됐다면 줄마다 오류를 내는 대신 바로 알려줌
+
+  reader = csv.reader(file)
+  names = [name.strip() for name in next(reader, [])]
+  rows = ((number, row) for number, row in enumerate(reader, 1) if row)
+  tasks = ((expression, names, chunk) for chunk in chunked(rows, chunkSize))
+  writeResults(orderedMap(evaluateBindings, tasks, jobs or os.cpu_count()),
+               output)
+
+
+# %% [markdown]
+# ### 격자 위에서 함수 값 표 만들기
+
+# %%
+# Let f(x, y) = ...를 4096x4096 격자 같은 곳에서 표로 만들 때, 점마다 interpret()를 부르면 1600만 번임.
+# evaluateGrid()는 격자를 tileSize x tileSize 조각(tile)으로 나눠서 여러 프로세스가 나눠 계산함.
+# 조각 하나는 vectorize()로 numpy 배열째 한 번에 계산하고,
+# 결과는 공유 메모리(shared_memory)에 바로 써서 원래 프로세스로 pickle해서 돌려보내지 않음.
+#
+# with evaluateGrid('Let f(x, y) = sin(x) * cos(y)', xs, ys) as grid:
+#   grid.values[i, j]  # f(xs[j], ys[i])
+#
+# code는 x, y로 된 수식(sin(x) * y)이나 인수가 두 개인 함수 정의(Let f(a, b) = ...)를 받음.
+# progress(끝난 조각 개수, 전체 조각 개수)는 조각이 끝날 때마다 불림.
+# cancel(threading.Event 등)이 set되면 아직 시작 안 한 조각은 취소하고 GridCancelled를 냄.
+
+
+class GridCancelled(Exception):
+  pass
+
+
+# 공유 메모리 위의 2차원 float 배열. 다 쓰면 close()로 메모리를 돌려줘야 함 (with를 쓰면 알아서 함)
+# close() 뒤에도 값이 필요하면 grid.values.copy()로 복사해두기
+class Grid:
+  memory: Optional[shared_memory.SharedMemory]
+  values: Optional['np.ndarray']  # values[행(y), 열(x)]
+
+  def __init__(self, shape: Tuple[int, int]):
+    self.memory = shared_memory.SharedMemory(create=True,
+                                             size=max(1, shape[0] * shape[1] * 8))
+    self.values = np.ndarray(shape, dtype=np.float64, buffer=self.memory.buf)
+
+  def close(self):
+    if self.memory is None:
+      return
+    self.values = None
+    self.memory.close()
+    self.memory.unlink()
+    self.memory = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *error):
+    self.close()
+
+  def __repr__(self) -> str:
+    shape = None if self.values is None else self.values.shape
+    return f'Grid(shape={shape})'
+
+
+# 프로세스마다 수식을 한 번만 vectorize해둠: code -> (계산 함수, (가로 이름, 세로 이름))
+vectorizedGridExpressions = {}
+
+
+def gridExpression(code: str):
+  expression = vectorizedGridExpressions.get(code)
+  if expression is None:
+    node = optimize(parseMathToAst(code))
+    names = ('x', 'y')
+    if isinstance(node, Definition):
+      target = node.target
+      if not isinstance(target, Function) or target.parameters is None or len(
+          target.parameters) != 2:
+        raise Exception(f'격자에서 계산하려면 인수가 두 개인 함수를 정의해야 해요: {code}')
+      node = target.body
+      names = tuple(target.parameters)
+    expression = vectorize(node), names
+    vectorizedGridExpressions[code] = expression
+  return expression
+
+
+# 격자 한 조각(xs x ys)을 계산해서 공유 메모리의 (top, left) 위치에 씀
+def evaluateTile(name: str, shape: Tuple[int, int], code: str, xs, ys, top: int,
+                 left: int):
+  evaluate, (xName, yName) = gridExpression(code)
+  x, y = np.meshgrid(xs, ys)
+  with np.errstate(all='ignore'):  # 0으로 나누기 등은 표에 inf/nan으로 남김
+    values = evaluate({xName: x, yName: y})
+
+  memory = shared_memory.SharedMemory(name=name)
+  try:
+    grid = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+    grid[top:top + len(ys), left:left + len(xs)] = values
+    del grid
+  finally:
+    memory.close()
+
+
+def evaluateGrid(code: str,
+                 xs,
+                 ys,
+                 jobs: Optional[int] = None,
+                 tileSize: int = 256,
+                 progress: Optional[Callable[[int, int], Any]] = None,
+                 cancel=None) -> Grid:
+  if np is None:
+    raise Exception('격자에서 계산하려면 numpy가 필요해요. (pip install numpy)')
+  gridExpression(code)  # 수식이 잘못됐다면 프로세스를 띄우기 전에 바로 알려줌
+
+  xs = np.asarray(xs, dtype=np.float64)
+  ys = np.asarray(ys, dtype=np.float64)
+  tiles = [(top, left) for top in range(0, len(ys), tileSize)
+           for left in range(0, len(xs), tileSize)]
+
+  grid = Grid((len(ys), len(xs)))
+  name = grid.memory.name
+  shape = grid.values.shape
+
+  def task(tile):
+    top, left = tile
+    return (name, shape, code, xs[left:left + tileSize], ys[top:top + tileSize],
+            top, left)
+
+  try:
+    jobs = jobs or os.cpu_count()
+    if jobs == 1:
+      for done, tile in enumerate(tiles, 1):
+        if cancel is not None and cancel.is_set():
+          raise GridCancelled(f'{len(tiles)}조각 중 {done - 1}조각 계산하고 취소됐어요.')
+        evaluateTile(*task(tile))
+        if progress is not None:
+          progress(done, len(tiles))
+      return grid
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+      futures = [executor.submit(evaluateTile, *task(tile)) for tile in tiles]
+      try:
+        for done, future in enumerate(as_completed(futures), 1):
+          future.result()
+          if progress is not None:
+            progress(done, len(tiles))
+          if cancel is not None and cancel.is_set() and done < len(tiles):
+            raise GridCancelled(f'{len(tiles)}조각 중 {done}조각 계산하고 취소됐어요.')
+      except BaseException:
+        for future in futures:
+          future.cancel()
+        raise
+    return grid
+
+  except BaseException:
+    grid.close()
+    raise
+
+
+# %% [markdown]
+# ### 계산 서버
+
+# %%
+# 다른 프로그램에서 계산기를 쓸 수 있게 TCP나 유닉스 소켓으로 요청을 받는 asyncio 서버.
+#   python 최종결과.py --serve 127.0.0.1:8765
+#   python 최종결과.py --serve unix:/tmp/calc.sock --jobs 4 --timeout 2 --snapshot 정의.snap
+#
+# 프로토콜: 한 줄에 요청 하나, 한 줄에 응답 하나 (JSON Lines)
+#   {"id": 1, "expression": "x ^ 2 + y", "bindings": {"x": 3, "y": 1}}  ->  {"id": 1, "value": 10.0}
+#   {"id": 2, "expression": "1 / 0", "timeout": 0.5}                     ->  {"id": 2, "error": "float division by zero"}
+#   sin(pi / 2)                                                          ->  {"id": 3, "value": 1.0}
+# JSON이 아닌 줄은 수식 그 자체로 봄. 응답은 계산이 끝난 순서대로 오니까 id로 짝을 맞춤
+# (id를 안 주면 그 연결에서 몇 번째 줄인지). timeout(초)은 서버의 timeout보다 짧게만 줄 수 있음.
+# --snapshot으로 정의를 불러두면 모든 요청에서 그 정의들을 쓸 수 있음 (bindings가 같은 이름을 가림).
+#
+# - 계산은 jobs개의 프로세스(jobs가 1이면 스레드 하나)에서 하고, 이벤트 루프는 요청을 읽고 응답을 쓰기만 함
+# - 같은 수식이 bindings만 바뀌어서 batchDelay초 안에 여러 번 오면 모아서 한 번에 보냄 (micro-batching).
+#   프로세스에 한 번만 보내고, 파싱/최적화도 한 번만 한 다음 bindings마다 계산만 함
+# - 계산 중이거나 기다리는 요청이 maxPending개가 되면 자리가 날 때까지 새 요청을 읽지 않음 (backpressure).
+#   그러면 소켓 버퍼가 차서 클라이언트도 보내기를 기다리게 됨. 응답도 drain()으로 쓸 수 있을 때까지 기다림
+# - timeout초 안에 계산이 안 끝나면 그 요청은 오류로 답함. 프로세스에서 돌고 있는 계산도 남은 시간을
+#   Budget의 timeLimit으로 줘서 같이 멈춤. maxSteps, maxDepth, maxMagnitude도 요청마다 Budget으로 넘김
+#   (maxMagnitude의 기본값은 float의 최댓값: floor(9) ^ floor(999999999) 같은 정수 거듭제곱은 시간 한도로도 못 멈추니까)
+
+# 계산하는 프로세스(스레드)마다 한 번 불러두는 정의들 (--snapshot)
+serverDefinitions: Optional[Definitions] = None
+
+
+def loadServerDefinitions(path: Optional[str]):
+  global serverDefinitions
+  serverDefinitions = None if path is None else loadSnapshot(path)
+
+
+# 같은 수식을 bindings 여러 개로 계산함. requests: [(bindings, 답해야 하는 time.time())]
+# limits: Budget에 넘길 maxSteps 등. 결과: 요청마다 ('value', 값)이나 ('error', 오류 메시지)
+def evaluateRequests(expression: str, requests: List[Tuple[dict, float]],
+                     limits: dict) -> List[tuple]:
+  try:
+    node = optimize(parseMathToAstCached(expression))
+    if isinstance(node, Definition):
+      raise Exception(f'정의만 있는 요청은 계산할 게 없어요. Let a = 2, a * 3처럼 보내주세요.')
+  except Exception as e:
+    return [('error', str(e))] * len(requests)
+
+  base = {} if serverDefinitions is None else serverDefinitions.context
+  budget = Budget(**limits)  # 요청마다 restart()로 되돌려 씀
+  results = []
+  for bindings, deadline in requests:
+    remaining = deadline - time.time()
+    if remaining <= 0:  # 기다리다가 시간이 다 됨. 서버에서 이미 오류로 답했을 거라 계산하지 않음
+      results.append(('error', '계산할 시간이 없어요.'))
+      continue
+    try:
+      results.append(('value',
+                      jsonValue(
+                          interpret(node, {
+                              **base,
+                              **bindings
+                          }, budget.restart(remaining)))))
+    except TimeLimitExceeded as e:  # timeLimit은 기다리고 남은 시간이라 숫자는 빼고 말함
+      results.append(
+          ('error', f'시간 안에 계산이 끝나지 않았어요. (계산하던 부분: {spanText(e.tokens)})'))
+    except Exception as e:
+      results.append(('error', str(e)))
+  return results
+
+
+# 'unix:/tmp/calc.sock' -> '/tmp/calc.sock', '127.0.0.1:8765' -> ('127.0.0.1', 8765), ':8765' -> ('127.0.0.1', 8765)
+def parseAddress(address: str) -> Union[str, Tuple[str, int]]:
+  if address.startswith('unix:'):
+    return address[len('unix:'):]
+  host, separator, port = address.rpartition(':')
+  if not separator or not port.isdigit():
+    raise Exception(f'주소는 호스트:포트나 unix:경로로 써주세요: {address}')
+  return host or '127.0.0.1', int(port)
+
+
+# 요청 한 줄을 (id, 수식, bindings, timeout)으로 읽음
+def parseRequest(text: str, number: int, timeout: float):
+  if not text.startswith('{'):
+    return number, text, {}, timeout
+
+  request = json.loads(text)
+  if not isinstance(request, dict):
+    raise Exception('요청은 JSON 객체여야 해요.')
+  requestId = request.get('id', number)
+  expression = request.get('expression')
+  if not isinstance(expression, str):
+    raise Exception('expression에 수식을 글자로 넣어주세요.')
+
+  given = request.get('bindings') or {}
+  if not isinstance(given, dict):
+    raise Exception('bindings는 {"이름": 값, ...} 모양이어야 해요.')
+  bindings = {}
+  for name, value in given.items():
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+      raise Exception(f'{name}의 값이 숫자가 아니에요: {value!r}')
+    bindings[name] = float(value)
+
+  if 'timeout' in request:
+    timeout = min(timeout, float(request['timeout']))
+  return requestId, expression, bindings, timeout
+
+
+class CalculatorServer:
+  jobs: int
+  maxPending: int  # 계산 중이거나 기다리는 요청이 이만큼 되면 더 읽지 않음
+  timeout: float  # 요청 하나를 기다리는 최대 시간(초)
+  batchDelay: float  # 같은 수식을 모으는 시간(초). 0이면 모으지 않음
+  maxBatch: int  # 이만큼 모이면 batchDelay를 기다리지 않고 바로 보냄
+  snapshot: Optional[str]
+  maxLineBytes: int  # 요청 한 줄의 최대 길이
+  limits: dict  # 요청마다 만드는 Budget의 maxSteps, maxDepth, maxMagnitude
+
+  def __init__(self,
+               jobs: Optional[int] = None,
+               maxPending: int = 1024,
+               timeout: float = 5.0,
+               batchDelay: float = 0.002,
+               maxBatch: int = 256,
+               snapshot: Optional[str] = None,
+               maxLineBytes: int = 1 << 24,
+               maxSteps: Optional[int] = None,
+               maxDepth: Optional[int] = None,
+               maxMagnitude: Optional[float] = sys.float_info.max):
+    self.jobs = jobs or os.cpu_count()
+    self.maxPending = maxPending
+    self.timeout = timeout
+    self.batchDelay = batchDelay
+    self.maxBatch = maxBatch
+    self.snapshot = snapshot
+    self.maxLineBytes = maxLineBytes
+    self.limits = {
+        'maxSteps': maxSteps,
+        'maxDepth': maxDepth,
+        'maxMagnitude': maxMagnitude
+    }
+    self.server = None
+    self.path = None  # 유닉스 소켓이라면 그 파일 경로
+    self.executor = None
+    self.slots = None
+    self.batches = {}  # 수식 -> ([(bindings, future)], batchDelay 타이머)
+    self.connections = set()  # 열려있는 연결들의 StreamWriter
+    self.handlers = set()  # 연결마다 도는 handle() 태스크
+    self.requests = 0
+    self.sentBatches = 0
+    self.largestBatch = 0
+    self.timeouts = 0
+    self.errors = 0
+    self.pending = 0
+
+  async def start(self, address: str):
+    where = parseAddress(address)
+    self.slots = asyncio.Semaphore(self.maxPending)
+    if self.jobs == 1:  # 프로세스를 따로 띄우지 않고 스레드 하나에서 계산
+      self.executor = ThreadPoolExecutor(max_workers=1,
+                                         initializer=loadServerDefinitions,
+                                         initargs=(self.snapshot,))
+    else:
+      self.executor = ProcessPoolExecutor(max_workers=self.jobs,
+                                          initializer=loadServerDefinitions,
+                                          initargs=(self.snapshot,))
+
+    if isinstance(where, str):
+      self.path = where
+      self.server = await asyncio.start_unix_server(self.handle,
+                                                    path=where,
+                                                    limit=self.maxLineBytes)
+    else:
+      host, port = where
+      self.server = await asyncio.start_server(self.handle,
+                                               host,
+                                               port,
+                                               limit=self.maxLineBytes)
+    return self.server
+
+  # 실제로 듣고 있는 주소 (포트를 0으로 줬다면 운영체제가 고른 포트)
+  def address(self) -> str:
+    name = self.server.sockets[0].getsockname()
+    if isinstance(name, str):
+      return f'unix:{name}'
+    return f'{name[0]}:{name[1]}'
+
+  # 새 연결을 그만 받고, 기다리던 요청들에 답한 다음 연결들을 닫음
+  async def close(self):
+    if self.server is not None:
+      self.server.close()
+    for requests, timer in self.batches.values():
+      if timer is not None:
+        timer.cancel()
+      self.fail(requests, '서버를 닫는 중이에요')
+    self.batches.clear()
+    if self.executor is not None:
+      self.executor.shutdown(wait=False, cancel_futures=True)
+    for writer in list(self.connections):
+      writer.close()
+    if self.handlers:
+      await asyncio.wait(self.handlers)
+    if self.server is not None:
+      await self.server.wait_closed()
+    if self.path is not None and os.path.exists(self.path):  # 유닉스 소켓 파일은 직접 지워야 함
+      os.unlink(self.path)
+      self.path = None
+
+  # 연결 하나: 자리(slot)가 날 때마다 한 줄씩 읽어서 따로 답함
+  async def handle(self, reader: asyncio.StreamReader,
+                   writer: asyncio.StreamWriter):
+    self.handlers.add(asyncio.current_task())
+    self.connections.add(writer)
+    responses = set()
+    number = 0
+    try:
+      while True:
+        await self.slots.acquire()
+        try:
+          line = await reader.readline()
+        except ValueError:  # 한 줄이 maxLineBytes보다 김: 이어지는 줄을 알 수 없어서 연결을 끊음
+          self.slots.release()
+          self.errors += 1
+          writer.write(
+              jsonLine({
+                  'id': number + 1,
+                  'error': f'요청 한 줄이 {self.maxLineBytes}바이트보다 길어요.'
+              }).encode('utf-8'))
+          break
+        text = line.decode('utf-8', errors='replace').strip()
+        if not text:
+          self.slots.release()
+          if not line:  # 연결이 끝남
+            break
+          continue
+
+        number += 1
+        response = asyncio.create_task(self.respond(text, number, writer))
+        responses.add(response)
+        response.add_done_callback(responses.discard)
+
+      if responses:
+        await asyncio.gather(*responses)
+      await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      for response in responses:
+        response.cancel()
+      writer.close()
+      self.connections.discard(writer)
+      self.handlers.discard(asyncio.current_task())
+
+  async def respond(self, text: str, number: int, writer: asyncio.StreamWriter):
+    self.pending += 1
+    try:
+      record = await self.answer(text, number)
+      if 'error' in record:
+        self.errors += 1
+      writer.write(jsonLine(record).encode('utf-8'))
+      await writer.drain()
+    finally:
+      self.pending -= 1
+      self.slots.release()
+
+  async def answer(self, text: str, number: int) -> dict:
+    self.requests += 1
+    requestId = number
+    try:
+      requestId, expression, bindings, timeout = parseRequest(
+          text, number, self.timeout)
+    except Exception as e:
+      return {'id': requestId, 'error': f'요청이 잘못됐어요: {e}'}
+
+    try:
+      kind, value = await asyncio.wait_for(
+          self.submit(expression, bindings, time.time() + timeout), timeout)
+    except asyncio.TimeoutError:
+      self.timeouts += 1
+      return {'id': requestId, 'error': f'{timeout}초 안에 계산이 끝나지 않았어요.'}
+    return {'id': requestId, kind: value}
+
+  # 같은 수식을 기다리는 묶음에 넣음. 묶음이 처음 생기면 batchDelay 뒤에 보냄
+  # deadline: 이 요청에 답해야 하는 time.time() (프로세스에서 계산할 때 남은 시간을 셈)
+  def submit(self, expression: str, bindings: dict,
+             deadline: float) -> asyncio.Future:
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    batch = self.batches.get(expression)
+    if batch is None:
+      timer = None
+      if self.batchDelay > 0:
+        timer = loop.call_later(self.batchDelay, self.flush, expression)
+      batch = self.batches[expression] = ([], timer)
+    batch[0].append((bindings, deadline, future))
+    if self.batchDelay <= 0 or len(batch[0]) >= self.maxBatch:
+      self.flush(expression)
+    elif self.pending >= self.maxPending:  # 자리가 다 차서 더 올 요청이 없으니 기다리지 않고 다 보냄
+      for waiting in list(self.batches):
+        self.flush(waiting)
+    return future
+
+  # 모아둔 묶음을 계산하는 곳으로 보냄 (시간이 다 돼서 이미 취소된 요청은 빼고)
+  def flush(self, expression: str):
+    requests, timer = self.batches.pop(expression, ([], None))
+    if timer is not None:
+      timer.cancel()
+    requests = [(bindings, deadline, future)
+                for bindings, deadline, future in requests
+                if not future.done()]
+    if not requests:
+      return
+
+    self.sentBatches += 1
+    self.largestBatch = max(self.largestBatch, len(requests))
+    loop = asyncio.get_running_loop()
+    try:
+      done = loop.run_in_executor(
+          self.executor, evaluateRequests, expression,
+          [(bindings, deadline) for bindings, deadline, _ in requests],
+          self.limits)
+    except Exception as e:  # 프로세스가 죽었거나 서버를 닫는 중
+      self.fail(requests, e)
+      return
+    done.add_done_callback(lambda done: self.finish(requests, done))
+
+  def finish(self, requests, done: asyncio.Future):
+    if done.cancelled():
+      self.fail(requests, '서버를 닫는 중이에요')
+    elif done.exception() is not None:
+      self.fail(requests, done.exception())
+    else:
+      for (_, _, future), result in zip(requests, done.result()):
+        if not future.done():  # 시간이 다 돼서 이미 답한 건 건너뜀
+          future.set_result(result)
+
+  def fail(self, requests, error):
+    for _, _, future in requests:
+      if not future.done():
+        future.set_result(('error', f'계산하는 곳에서 오류가 났어요: {error}'))
+
+  def stats(self) -> dict:
+    return {
+        'requests': self.requests,
+        'batches': self.sentBatches,
+        'largestBatch': self.largestBatch,
+        'timeouts': self.timeouts,
+        'errors': self.errors,
+        'pending': self.pending
+    }
+
+  def __repr__(self) -> str:
+    return f'CalculatorServer({self.stats()})'
+
+
+# 서버를 띄우고 끝날 때까지(Ctrl+C) 돌림
+def serve(address: str, **options):
+
+  async def run():
+    server = CalculatorServer(**options)
+    await server.start(address)
+    print(f'계산 서버: {server.address()}에서 기다리는 중 (프로세스 {server.jobs}개)',
+          file=sys.stderr)
+    try:
+      await server.server.serve_forever()
+    finally:
+      await server.close()
+
+  try:
+    asyncio.run(run())
+  except KeyboardInterrupt:
+    pass
+
+
+# %% [markdown]
+# ### 어디서 시간이 걸리는지 재기 (프로파일)
+
+# %%
+# 느린 수식이 토큰 나누기, 파싱, 계산 중 어디서 시간을 쓰는지 보려고 재는 기능.
+# with profiling() as profile: 안에서 계산하면 profile에
+#   - 단계별(lex, parse, compile, evaluate) 횟수와 시간
+#   - 노드 종류별 계산 횟수와 시간 (자식 노드까지 포함한 시간과, 자식 노드를 뺀 시간)
+#   - 내장함수/사용자 함수별 호출 횟수
+# 가 쌓임. 명령줄에서는 --profile로 켜면 끝날 때 표준에러에 보고서를 씀.
+#
+# 재는 코드를 interpret() 안에 넣으면 안 잴 때도 노드마다 '재는 중인가?'를 확인해야 하니까,
+# 누가 profiling() 안에 있는 동안만 모듈의 interpret/evaluateNode/tokenize/parseToAst 등을 재는 함수로 바꿔치기하고
+# 아무도 안 재면 되돌림 (freeze()가 얼릴 때만 클래스를 바꿔치기하는 것과 같은 이유).
+# interpret()가 노드마다 부르는 evaluateNode()는 안쪽 노드를 계산할 때 모듈의 evaluateNode 이름으로 다시 부르니까
+# 안쪽 노드들도 전부 잼. 안 잴 때는 원래 함수 그대로라 느려지지 않음.
+# 재는 함수는 지금 스레드의 Profile(currentProfile)에만 더하니까 여러 스레드에서 각자 profiling()을 써도 섞이지 않음
+# (그동안 profiling() 밖의 스레드는 재지 않고 원래 함수를 부르지만, 노드마다 한 번 확인하는 만큼 느려짐). 대신
+#   - Profile 하나를 여러 스레드에서 같이 쓰면 안 되고
+#   - compile()/resolve()로 만든 함수나, 너무 깊어서 evaluateDeep()로 계산한 수식(이나 펼친 정의)은 노드별로 안 셈
+#     (시간은 evaluate 단계에 들어감)
+#
+# with profiling() as profile:
+#   interpret(parseMathToAst('sin(x) * 2'), {'x': 1})
+# print(profile.report())
+# profile.stats()  # {'phases': {'lex': {'count': 1, 'seconds': ...}, ...}, 'nodes': {...}, ...}
+
+
+class Profile:
+  phases: Dict[str, list]  # 단계 이름 -> [횟수, 시간]
+  nodes: Dict[str, list]  # 노드 종류 -> [횟수, 자식까지 포함한 시간, 자식을 뺀 시간]
+  builtinCalls: Dict[str, int]  # 내장함수 이름 -> 호출 횟수
+  userCalls: Dict[str, int]  # 사용자 함수 이름 -> 호출 횟수
+
+  def __init__(self):
+    self.phases = {}
+    self.nodes = {}
+    self.builtinCalls = {}
+    self.userCalls = {}
+    self.childTimes = [0.0]  # 계산 중인 노드마다 그 자식 노드들에 쓴 시간
+    self.active = set()  # 지금 재고 있는 단계들 (안에서 같은 단계를 또 부르면 바깥 것만 잼)
+
+  def addPhase(self, name: str, seconds: float):
+    entry = self.phases.get(name)
+    if entry is None:
+      entry = self.phases[name] = [0, 0.0]
+    entry[0] += 1
+    entry[1] += seconds
+
+  def stats(self) -> dict:
+    return {
+        'phases': {
+            name: {
+                'count': count,
+                'seconds': seconds
+            } for name, (count, seconds) in self.phases.items()
+        },
+        'nodes': {
+            kind: {
+                'count': count,
+                'seconds': seconds,
+                'selfSeconds': selfSeconds
+            } for kind, (count, seconds, selfSeconds) in self.nodes.items()
+        },
+        'builtinCalls': dict(self.builtinCalls),
+        'userCalls': dict(self.userCalls)
+    }
+
+  # 사람이 읽을 보고서. 노드 종류는 자기 시간(자식을 뺀 시간)이 큰 것부터
+  def report(self) -> str:
+    lines = ['단계          횟수      시간(ms)']
+    for name, (count, seconds) in self.phases.items():
+      lines.append(f'{name:10} {count:8} {seconds * 1e3:12.3f}')
+
+    lines.append('')
+    lines.append('노드 종류             횟수   전체(ms)   자기(ms)')
+    for kind, (count, seconds, selfSeconds) in sorted(
+        self.nodes.items(), key=lambda item: -item[1][2]):
+      lines.append(
+          f'{kind:16} {count:10} {seconds * 1e3:10.3f} {selfSeconds * 1e3:10.3f}')
+
+    for title, calls in [('내장함수', self.builtinCalls),
+                         ('사용자 함수', self.userCalls)]:
+      if calls:
+        lines.append('')
+        lines.append(f'{title} 호출: ' + ', '.join(
+            f'{name} {count}번'
+            for name, count in sorted(calls.items(), key=lambda item: -item[1])))
+    return '\n'.join(lines)
+
+  def __repr__(self) -> str:
+    return f'Profile({self.stats()})'
+
+
+# 지금 스레드(contextvars의 컨텍스트)에서 재고 있는 Profile. profiling() 밖이면 None
+currentProfile: contextvars.ContextVar = contextvars.ContextVar(
+    'currentProfile', default=None)
+
+
+# function이 걸린 시간을 지금 재고 있는 Profile의 name 단계에 더하는 함수
+def timedPhase(name: str, function):
+
+  def timed(*args, **kwargs):
+    profile = currentProfile.get()
+    if profile is None or name in profile.active:
+      return function(*args, **kwargs)
+    profile.active.add(name)
+    start = time.perf_counter()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      profile.active.discard(name)
+      profile.addPhase(name, time.perf_counter() - start)
+
+  return timed
+
+
+# generator 함수용: 값을 하나씩 꺼낼 때마다 걸린 시간을 더함 (스크립트의 문장 나누기처럼 계산과 번갈아 도는 것)
+def timedIterator(name: str, function):
+
+  def timed(*args, **kwargs):
+    profile = currentProfile.get()
+    if profile is None:
+      yield from function(*args, **kwargs)
+      return
+    iterator = iter(function(*args, **kwargs))
+    while True:
+      start = time.perf_counter()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        profile.addPhase(name, time.perf_counter() - start)
+      yield item
+
+  return timed
+
+
+# 노드마다 횟수와 시간을 세는 evaluateNode. 걸린 시간은 interpret()를 감싼 timedPhase가 evaluate 단계에 더함
+def profiledEvaluateNode(evaluateNode):
+  perfCounter = time.perf_counter
+
+  def timed(node: Node, context: dict, budget: Optional[Budget], levels: int):
+    profile = currentProfile.get()
+    if profile is None:
+      return evaluateNode(node, context, budget, levels)
+    if isinstance(node, FunctionValue):
+      calls = profile.builtinCalls if node.name in builtinFunctions else profile.userCalls
+      calls[node.name] = calls.get(node.name, 0) + 1
+
+    childTimes = profile.childTimes
+    depth = len(childTimes)
+    childTimes.append(0.0)
+    start = perfCounter()
+    try:
+      return evaluateNode(node, context, budget, levels)
+    finally:
+      elapsed = perfCounter() - start
+      # pop() 대신 자기 자리까지 지움: 오류로 풀려나올 때 안쪽의 finally가 중간에 멈췄을 수 있음 (재귀 한도 등)
+      children = childTimes[depth]
+      del childTimes[depth:]
+      childTimes[-1] += elapsed
+      kind = type(node).__name__
+      entry = profile.nodes.get(kind)
+      if entry is None:
+        entry = profile.nodes[kind] = [0, 0.0, 0.0]
+      entry[0] += 1
+      entry[1] += elapsed
+      entry[2] += elapsed - children
+
+  return timed
+
+
+# 재는 동안 바꿔치기하는 모듈 이름들
+profiledNames = ('tokenize', 'scriptStatements', 'parseToAst', 'compile',
+                 'interpret', 'evaluateNode')
+profilingLock = threading.Lock()
+profilingUsers = 0  # 지금 profiling() 안에 있는 곳 개수. 0이 되면 원래 함수로 되돌림
+originalFunctions: Dict[str, Callable] = {}
+
+
+@contextmanager
+def profiling(profile: Optional[Profile] = None):
+  global profilingUsers
+  if profile is None:
+    profile = Profile()
+  with profilingLock:
+    if profilingUsers == 0:
+      namespace = globals()
+      originalFunctions.update(
+          {name: namespace[name] for name in profiledNames})
+      namespace['tokenize'] = timedPhase('lex', originalFunctions['tokenize'])
+      namespace['scriptStatements'] = timedIterator(
+          'lex', originalFunctions['scriptStatements'])
+      namespace['parseToAst'] = timedPhase('parse',
+                                           originalFunctions['parseToAst'])
+      namespace['compile'] = timedPhase('compile', originalFunctions['compile'])
+      # 너무 깊어서 evaluateDeep()로 계산하는 것까지 evaluate 단계에 들어가게 interpret()를 잼
+      namespace['interpret'] = timedPhase('evaluate',
+                                          originalFunctions['interpret'])
+      # evaluateNode()는 안쪽 노드도 모듈의 evaluateNode 이름으로 다시 부르니까 노드마다 잴 수 있음
+      namespace['evaluateNode'] = profiledEvaluateNode(
+          originalFunctions['evaluateNode'])
+    profilingUsers += 1
+  token = currentProfile.set(profile)
+  try:
+    yield profile
+  finally:
+    currentProfile.reset(token)
+    with profilingLock:
+      profilingUsers -= 1
+      if profilingUsers == 0:
+        globals().update(originalFunctions)
+        originalFunctions.clear()
+
+
+# %% [markdown]
+# ### 명령줄
+
+# %%
+def repl(definitions: Optional[Definitions] = None):
+  if definitions is None:
+    definitions = Definitions()
+  context = definitions.context
 
   while True:
     line = input('수식 계산기> ')
-    node = parseMathToAst(line)
+    command = line.strip()
+    if command == ':graph':  # 정의들이 어떤 이름을 쓰는지 보여줌
+      for name, names in definitions.graph().items():
+        print(f'{name} <- {", ".join(names) or "(없음)"}')
+      continue
+    if command.startswith(':save '):  # :save 파일 -> 지금까지의 정의들을 스냅샷으로 저장
+      path = command[len(':save '):].strip()
+      try:
+        saveSnapshot(definitions, path)
+      except Exception as e:  # 저장하지 못했다고 지금까지의 정의들을 잃으면 안 되니까 계속함
+        print(f'저장하지 못했어요: {e}')
+        continue
+      print(f'정의 {len(context)}개를 {path}에 저장했어요')
+      continue
+    node = optimize(parseMathToAstCached(line))
 
     if isinstance(node, Definition):
-      context[node.name] = node.target  # repr mode, preserve locals
+      affected = definitions.define(node.name, node.target)
+      if affected:
+        print(f'다시 계산할 정의: {", ".join(affected)}')
+    elif isEquation(node):  # x ^ 2 = 2: 모르는 기호 하나를 찾음
+      unknowns = unknownsOf(node, context)
+      if len(unknowns) != 1:
+        raise Exception(f'모르는 기호가 하나여야 풀 수 있어요: {sorted(unknowns)}')
+      name = unknowns.pop()
+      print(f'계산결과: {name} = {solve(node, context, name)}')
     else:
       value = interpret(node, context)
       print(f'계산결과: {value}')
 
 
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='고급 수식 계산기')
+  parser.add_argument('script',
+                      nargs='?',
+                      help='계산할 스크립트 파일 (.calc). -면 표준입력에서 읽음. 없으면 대화형으로 실행')
+  parser.add_argument('--batch',
+                      metavar='FILE',
+                      help='한 줄에 수식 하나씩 있는 파일을 줄마다 따로 계산해서 JSONL로 씀. -면 표준입력')
+  parser.add_argument('--expression', help='--bindings의 줄마다 계산할 수식')
+  parser.add_argument('--bindings',
+                      metavar='CSV',
+                      help='첫 줄은 변수 이름, 그 다음 줄부터는 변수 값인 CSV 파일. -면 표준입력')
+  parser.add_argument('--jobs',
+                      type=int,
+                      default=None,
+                      help='계산할 프로세스 개수 (기본: CPU 코어 개수)')
+  parser.add_argument('--chunk-size',
+                      type=int,
+                      default=1000,
+                      help='프로세스에 한 번에 보낼 줄 개수 (기본: 1000)')
+  parser.add_argument('--output',
+                      metavar='FILE',
+                      help='JSONL 결과를 쓸 파일 (기본: 표준출력)')
+  parser.add_argument('--snapshot',
+                      metavar='FILE',
+                      help='시작할 때 불러올 정의 스냅샷 (saveSnapshot()이나 대화형 계산기의 :save로 만든 것)')
+  parser.add_argument('--save-snapshot',
+                      metavar='FILE',
+                      help='스크립트를 다 계산한 다음 정의들을 스냅샷으로 저장할 파일')
+  parser.add_argument('--profile',
+                      action='store_true',
+                      help='토큰 나누기/파싱/계산에 걸린 시간을 재서 끝날 때 표준에러에 씀')
+  parser.add_argument('--serve',
+                      metavar='ADDRESS',
+                      help='계산 서버를 띄울 주소 (호스트:포트나 unix:경로). 요청은 한 줄에 하나씩 JSON으로')
+  parser.add_argument('--timeout',
+                      type=float,
+                      default=5.0,
+                      help='계산 서버에서 요청 하나를 기다리는 최대 시간(초) (기본: 5)')
+  parser.add_argument('--max-pending',
+                      type=int,
+                      default=1024,
+                      help='계산 서버가 한꺼번에 받아두는 요청 개수. 넘으면 새 요청을 읽지 않음 (기본: 1024)')
+  args = parser.parse_args(argv)
+
+  if (args.expression is None) != (args.bindings is None):
+    parser.error('--expression과 --bindings는 같이 써야 해요')
+  if args.batch is not None and args.bindings is not None:
+    parser.error('--batch와 --bindings는 같이 쓸 수 없어요')
+  if args.script is not None and (args.batch or args.bindings):
+    parser.error('스크립트 파일과 --batch/--bindings는 같이 쓸 수 없어요')
+  if args.jobs is not None and args.jobs < 1:
+    parser.error('--jobs는 1 이상이어야 해요')
+  if args.chunk_size < 1:
+    parser.error('--chunk-size는 1 이상이어야 해요')
+  if (args.snapshot or args.save_snapshot) and (args.batch or args.bindings):
+    parser.error('--snapshot/--save-snapshot과 --batch/--bindings는 같이 쓸 수 없어요')
+  if args.save_snapshot is not None and args.script is None:
+    parser.error('--save-snapshot은 스크립트 파일과 같이 써야 해요 (대화형 계산기에서는 :save 파일)')
+  if args.profile and (args.batch or args.bindings) and args.jobs not in (None,
+                                                                         1):
+    parser.error('--profile은 batch 계산을 이 프로세스에서만 할 때 잴 수 있어요 (--jobs 1)')
+  if args.serve is not None:
+    if args.script is not None or args.batch or args.bindings:
+      parser.error('--serve는 스크립트 파일이나 --batch/--bindings와 같이 쓸 수 없어요')
+    if args.save_snapshot is not None or args.profile:
+      parser.error('--serve는 --save-snapshot/--profile과 같이 쓸 수 없어요')
+    try:
+      parseAddress(args.serve)
+    except Exception as e:
+      parser.error(str(e))
+  if args.timeout <= 0:
+    parser.error('--timeout은 0보다 커야 해요')
+  if args.max_pending < 1:
+    parser.error('--max-pending은 1 이상이어야 해요')
+  if args.expression is not None:
+    try:
+      parseMathToAst(args.expression)
+    except Exception as e:
+      parser.error(f'수식이 잘못됐어요: {e}')
+
+  if not args.profile:
+    runCommand(args)
+    return
+  args.jobs = 1  # 다른 프로세스에서 계산한 건 못 잼
+  with profiling() as profile:
+    try:
+      runCommand(args)
+    finally:
+      print(profile.report(), file=sys.stderr)
+
+
+# main()에서 확인한 명령줄 인수대로 실행함
+def runCommand(args):
+  if args.serve is not None:
+    serve(args.serve,
+          jobs=args.jobs,
+          timeout=args.timeout,
+          maxPending=args.max_pending,
+          snapshot=args.snapshot)
+    return
+
+  if args.batch is not None or args.bindings is not None:
+    path = args.batch if args.batch is not None else args.bindings
+    source = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+    output = sys.stdout if args.output is None else open(
+        args.output, 'w', encoding='utf-8')
+    try:
+      if args.batch is not None:
+        batchExpressions(source, output, args.jobs, args.chunk_size)
+      else:
+        batchBindings(args.expression, source, output, args.jobs,
+                      args.chunk_size)
+    finally:
+      if source is not sys.stdin:
+        source.close()
+      if output is not sys.stdout:
+        output.close()
+    return
+
+  definitions = Definitions(
+  ) if args.snapshot is None else loadSnapshot(args.snapshot)
+  if args.script is None:
+    repl(definitions)
+    return
+  if args.script == '-':
+    runScript(sys.stdin, context=definitions)
+  else:
+    with open(args.script, encoding='utf-8') as file:
+      runScript(file, context=definitions)
+  if args.save_snapshot is not None:
+    saveSnapshot(definitions, args.save_snapshot)
+
+
 if __name__ == '__main__':
   main()